@@ -14,6 +14,14 @@ import torchvision.datasets as dset
 from torch.utils.data.dataset import Dataset
 
 VALID_PARTITIONS = {'train': 0, 'val': 1, 'test': 2}
+PARTITION_FILE = './data/Eval/list_eval_partition.txt'
+ATTR_FILE = './data/Anno/list_attr_celeba.txt'
+# parsed (paths, attrs) of each partition, see load_partition
+CACHE_PATH = './data/Anno/attr_%s.npz'
+IMAGE_DIR = './data/img_align_celeba/'
+IMAGE_SIZE = 64
+# decoded, resized and cropped images of each partition, see prepare_images.py
+STORE_PATH = './data/img_celeba_%d_%s.npy'
 ATTR_TO_IX_DICT = {'Sideburns': 30, 'Black_Hair': 8, 'Wavy_Hair': 33, 'Young': 39, 'Heavy_Makeup': 18, 
                    'Blond_Hair': 9, 'Attractive': 2, '5_o_Clock_Shadow': 0, 'Wearing_Necktie': 38, 
                    'Blurry': 10, 'Double_Chin': 14, 'Brown_Hair': 11, 'Mouth_Slightly_Open': 21, 
@@ -36,8 +44,9 @@ class CelebAttributes(Dataset):
         self.attr_transform = attr_transform
         
         assert partition in VALID_PARTITIONS.keys()
-        self.image_paths = load_eval_partition(partition)
-        self.attr_data = load_attributes(self.image_paths, partition)
+        self.image_paths, attr_data = load_partition(partition)
+        attr_data = torch.from_numpy(attr_data.astype(np.float32))
+        self.attr_data = attr_data[:, ATTR_IX_TO_KEEP]
         self.size = int(len(self.image_paths))
 
     def __getitem__(self, index):
@@ -47,7 +56,7 @@ class CelebAttributes(Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        image_path = os.path.join('./data/img_align_celeba/', self.image_paths[index])
+        image_path = os.path.join(IMAGE_DIR, self.image_paths[index])
         attr = self.attr_data[index]
 
         # open PIL Image
@@ -66,35 +75,135 @@ class CelebAttributes(Dataset):
         return self.size
 
 
-def load_eval_partition(partition):
-    eval_data = []
-    with open('./data/Eval/list_eval_partition.txt') as fp:
-        rows = fp.readlines()
-        for row in rows:
-            path, label = row.strip().split(' ')
-            label = int(label)
-            if label == VALID_PARTITIONS[partition]:
-                eval_data.append(path)
-    return eval_data
+def load_partition(partition):
+    """Return the image paths of a partition and their attributes as an 
+    N x 40 int8 array of 0/1, aligned row by row. Both annotation files
+    are parsed once per partition and the result is saved next to them;
+    the saved arrays are only used while the size and modification time
+    of both source files are unchanged.
+    """
+    cache_path = CACHE_PATH % partition
+    stamps = source_stamps()
+    if os.path.isfile(cache_path):
+        cache = np.load(cache_path)
+        if np.array_equal(cache['stamps'], stamps):
+            return cache['paths'].tolist(), cache['attrs']
+
+    paths, attrs = parse_partition(partition)
+    tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        np.savez(fp, paths=np.array(paths), attrs=attrs, stamps=stamps)
+    os.rename(tmp_path, cache_path)
+    return paths, attrs
+
+
+def parse_partition(partition):
+    """Parse the partition and attribute files; the attributes of a path
+    are found through a dict from path to row."""
+    with open(PARTITION_FILE) as fp:
+        rows = [row.split() for row in fp if row.strip()]
+    paths = [path for path, label in rows if int(label) == VALID_PARTITIONS[partition]]
+
+    with open(ATTR_FILE) as fp:
+        rows = [row.split() for row in fp.readlines()[2:] if row.strip()]
+    row_of = {row[0]: i for i, row in enumerate(rows)}
+    attrs = np.array([rows[row_of[path]][1:] for path in paths], dtype=np.int8)
+    attrs[attrs < 0] = 0
+    return paths, attrs
+
+
+def source_stamps():
+    """(size, mtime) of the partition and attribute files."""
+    stamps = []
+    for path in [PARTITION_FILE, ATTR_FILE]:
+        stat = os.stat(path)
+        stamps.append([stat.st_size, int(stat.st_mtime)])
+    return np.array(stamps, dtype=np.int64)
+
+
+def load_image(path, size=IMAGE_SIZE):
+    """Decode an image and apply transforms.Scale(size) followed by
+    transforms.CenterCrop(size), as a 3 x size x size uint8 array.
+    """
+    image = Image.open(path).convert('RGB')
+    w, h = image.size
+    if w < h:
+        ow, oh = size, int(size * h / w)
+    else:
+        ow, oh = int(size * w / h), size
+    if (ow, oh) != (w, h):
+        image = image.resize((ow, oh), Image.BILINEAR)
+    x, y = int(round((ow - size) / 2.)), int(round((oh - size) / 2.))
+    image = image.crop((x, y, x + size, y + size))
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
 
 
-def load_attributes(paths, partition):
-    if os.path.isfile('./data/Anno/attr_%s.npy' % partition):
-        attr_data = np.load('./data/Anno/attr_%s.npy' % partition)
-    else:
-        attr_data = []
-        with open('./data/Anno/list_attr_celeba.txt') as fp:
-            rows = fp.readlines()
-            for ix, row in enumerate(rows[2:]):
-                row = row.strip().split()
-                path, attrs = row[0], row[1:]
-                if path in paths:
-                    attrs = np.array(attrs).astype(int)
-                    attrs[attrs < 0] = 0
-                attr_data.append(attrs)
-        attr_data = np.vstack(attr_data).astype(np.int64)
-    attr_data = torch.from_numpy(attr_data).float()
-    return attr_data[:, ATTR_IX_TO_KEEP]
+def store_path(partition, size=IMAGE_SIZE):
+    return STORE_PATH % (size, partition)
+
+
+def done_path(partition, size=IMAGE_SIZE):
+    """Chunks of a store that are written; only exists while it is built."""
+    return store_path(partition, size) + '.done.npy'
+
+
+def load_image_store(partition, size=IMAGE_SIZE):
+    """Memory-map the N x 3 x size x size uint8 images of a partition,
+    row i being image i of load_partition(partition).
+    """
+    path = store_path(partition, size)
+    if not os.path.isfile(path) or os.path.isfile(done_path(partition, size)):
+        raise IOError('Image store %s not found or incomplete. Run prepare_images.py '
+                      'to build it.' % path)
+    images = np.load(path, mmap_mode='r')
+    if images.shape[0] != len(load_partition(partition)[0]):
+        raise ValueError('%s does not match the %s partition; rebuild it with '
+                         'prepare_images.py' % (path, partition))
+    return images
+
+
+class BatchLoader(object):
+    """Iterates over (image, attrs) batches like DataLoader(CelebAttributes(
+    partition, image_transform=<Scale, CenterCrop, ToTensor>), batch_size,
+    shuffle), but reads every batch out of the memory-mapped image store:
+    in order, a batch is a slice of it (no copy until the float conversion);
+    shuffled, its rows are gathered in sorted order.
+
+    :param images: N x 3 x H x W uint8 array (see load_image_store)
+    :param attrs: N x D FloatTensor
+    :param batch_size: number of examples per batch (default: 1)
+    :param shuffle: if True, reshuffle the examples every epoch
+    :param dataset: object reported as loader.dataset (for len())
+    """
+    def __init__(self, images, attrs, batch_size=1, shuffle=False, dataset=None):
+        self.images = images
+        self.attrs = attrs
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = dataset if dataset is not None else images
+
+    def __iter__(self):
+        n = self.images.shape[0]
+        order = np.random.permutation(n) if self.shuffle else None
+        for start in xrange(0, n, self.batch_size):
+            if self.shuffle:
+                index = np.sort(order[start:start + self.batch_size])
+                image, attrs = self.images[index], self.attrs[torch.from_numpy(index)]
+            else:
+                end = min(start + self.batch_size, n)
+                image, attrs = self.images[start:end], self.attrs[start:end]
+            image = torch.from_numpy(np.asarray(image)).float().div_(255)
+            yield image, attrs
+
+    def __len__(self):
+        return (self.images.shape[0] + self.batch_size - 1) // self.batch_size
+
+
+def celeba_loader(partition='train', batch_size=1, shuffle=False):
+    """BatchLoader over the image store and attributes of a partition."""
+    dataset = CelebAttributes(partition=partition)
+    return BatchLoader(load_image_store(partition), dataset.attr_data,
+                       batch_size=batch_size, shuffle=shuffle, dataset=dataset)
 
 
 def tensor_to_attributes(tensor):
@@ -56,6 +56,64 @@ class MultimodalVAE(nn.Module):
         attrs_recon = self.attrs_decoder(z)
         return image_recon, attrs_recon, mu, logvar
 
+    def forward_subsets(self, image, attrs):
+        """Equivalent to calling forward with (image, attrs), (image) and
+        (attrs) but each encoder runs only once and the latents of all
+        three subsets are decoded together as one concatenated batch.
+
+        :param image: batch of images
+        :param attrs: batch of attributes
+        :return: list of (image_recon, attrs_recon, mu, logvar) tuples for
+                 the joint, image-only and attrs-only subsets (in that order)
+        """
+        batch_size = image.size(0)
+        image_mu, image_logvar = self.image_encoder(image)
+        attrs_mu, attrs_logvar = self.attrs_encoder(attrs)
+        # product of experts for every subset of modalities; shares the
+        # encoder outputs rather than recomputing them per subset
+        mu = torch.stack((image_mu, attrs_mu), dim=0)
+        logvar = torch.stack((image_logvar, attrs_logvar), dim=0)
+        joint_mu, joint_logvar = self.experts(mu, logvar)
+        image_mu, image_logvar = self.experts(image_mu.unsqueeze(0),
+                                              image_logvar.unsqueeze(0))
+        attrs_mu, attrs_logvar = self.experts(attrs_mu.unsqueeze(0),
+                                              attrs_logvar.unsqueeze(0))
+        mu = torch.cat((joint_mu, image_mu, attrs_mu), dim=0)
+        logvar = torch.cat((joint_logvar, image_logvar, attrs_logvar), dim=0)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # one decoder call per modality over all subsets at once
+        image_recon = torch.split(self.image_decoder(z), batch_size, dim=0)
+        attrs_recon = torch.split(self.attrs_decoder(z), batch_size, dim=0)
+        mu = torch.split(mu, batch_size, dim=0)
+        logvar = torch.split(logvar, batch_size, dim=0)
+        return list(zip(image_recon, attrs_recon, mu, logvar))
+
+    def forward_masked(self, image, attrs, image_mask, attrs_mask, prior_expert=False):
+        """Like forward but each example chooses which modalities enter the
+        product of experts, so a single batch can mix paired, image-only 
+        and attrs-only examples in one pass.
+
+        :param image: batch of images; ignored where image_mask is 0
+        :param attrs: batch of attributes; ignored where attrs_mask is 0
+        :param image_mask: B float tensor; 1 if the image is observed
+        :param attrs_mask: B float tensor; 1 if the attributes are observed
+        :param prior_expert: if True, add p(z) as an expert (default: False)
+        """
+        image_mu, image_logvar = self.image_encoder(image)
+        attrs_mu, attrs_logvar = self.attrs_encoder(attrs)
+        mu = torch.stack((image_mu, attrs_mu), dim=0)
+        logvar = torch.stack((image_logvar, attrs_logvar), dim=0)
+        mask = torch.stack((image_mask, attrs_mask), dim=0)
+        # product of the observed experts only
+        mu, logvar = self.experts(mu, logvar, mask=mask, prior_expert=prior_expert)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # reconstruct inputs based on that gaussian
+        image_recon = self.image_decoder(z)
+        attrs_recon = self.attrs_decoder(z)
+        return image_recon, attrs_recon, mu, logvar
+
 
 class ImageVAE(nn.Module):
     def __init__(self, n_latents=20):
@@ -200,14 +258,45 @@ class ProductOfExperts(nn.Module):
     """Return parameters for product of independent experts.
     See https://arxiv.org/pdf/1410.7827.pdf for equations.
 
-    :param mu: M x D for M experts
-    :param logvar: M x D for M experts
+    The product is precision-weighted and computed in log space, 
+    so a missing expert can be dropped per example via the mask.
+
+    :param mu: M x B x D for M experts
+    :param logvar: M x B x D for M experts
+    :param mask: M x B; 1 if the expert is observed for that example,
+                 0 if it should be left out of the product; an example 
+                 with no observed expert gets the prior p(z) = N(0, I)
+                 (default: None)
+    :param prior_expert: if True, add p(z) = N(0, I) as an extra expert;
+                         regularizes for missing modalities (default: False)
     """
-    def forward(self, mu, logvar, eps=1e-8):
-        var = torch.exp(logvar) + eps
-        pd_mu = torch.sum(mu * var, dim=0) / torch.sum(var, dim=0)
-        pd_var = 1 / torch.sum(1 / var, dim=0)
-        pd_logvar = torch.log(pd_var)
+    def forward(self, mu, logvar, mask=None, prior_expert=False):
+        if prior_expert or mask is not None:
+            prior_size = (1, mu.size(1), mu.size(2))
+            prior_mu = Variable(mu.data.new(*prior_size).zero_())
+            prior_logvar = Variable(logvar.data.new(*prior_size).zero_())
+            mu = torch.cat((mu, prior_mu), dim=0)
+            logvar = torch.cat((logvar, prior_logvar), dim=0)
+            if mask is not None:
+                if prior_expert:
+                    prior_mask = Variable(mask.data.new(1, mask.size(1)).fill_(1))
+                else:
+                    # only examples with no observed expert use the prior
+                    prior_mask = mask.sum(0, keepdim=True).eq(0).float()
+                mask = torch.cat((mask, prior_mask), dim=0)
+
+        # log precision is log(1 / var) = -logvar
+        log_precision = -logvar
+        if mask is not None:
+            mask = mask.unsqueeze(2).expand_as(logvar)
+            # missing experts get a vanishing precision
+            log_precision = log_precision * mask + (mask - 1) * 1e10
+        # logsumexp over experts: sum of precisions is the product precision
+        max_log_precision = torch.max(log_precision, dim=0, keepdim=True)[0]
+        weights = torch.exp(log_precision - max_log_precision)
+        sum_weights = torch.sum(weights, dim=0)
+        pd_mu = torch.sum(mu * weights, dim=0) / sum_weights
+        pd_logvar = -(max_log_precision.squeeze(0) + torch.log(sum_weights))
         return pd_mu, pd_logvar
 
 
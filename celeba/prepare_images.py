@@ -0,0 +1,83 @@
+"""Decode, resize and center-crop every CelebA image of a partition once
+and pack them into a single uint8 array, read by datasets.celeba_loader.
+Chunks are decoded in a process pool and written as they finish; an
+interrupted build picks up at the chunks that were not written yet.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import numpy as np
+from multiprocessing import Pool
+
+from datasets import (VALID_PARTITIONS, IMAGE_DIR, IMAGE_SIZE, load_partition,
+                      load_image, store_path, done_path)
+
+
+def _load_chunk(job):
+    chunk, paths, size = job
+    return chunk, np.stack([load_image(os.path.join(IMAGE_DIR, path), size)
+                            for path in paths])
+
+
+def build_image_store(partition, size=IMAGE_SIZE, chunk_size=1000, n_workers=None):
+    """Write the images of a partition, in load_partition order, to an
+    N x 3 x size x size uint8 .npy file. Progress is kept in a mask of
+    written chunks next to it, removed once the store is complete.
+
+    :return: number of chunks written by this call
+    """
+    paths = load_partition(partition)[0]
+    path, mask_path = store_path(partition, size), done_path(partition, size)
+    shape = (len(paths), 3, size, size)
+    n_chunks = (len(paths) + chunk_size - 1) // chunk_size
+
+    images = None
+    if os.path.isfile(path):
+        images = np.load(path, mmap_mode='r+')
+        if images.shape != shape:
+            images = None
+        elif not os.path.isfile(mask_path):
+            return 0  # complete
+    if images is None:
+        np.save(mask_path, np.zeros(n_chunks, dtype=bool))
+        images = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=shape)
+    done = np.load(mask_path)
+    if len(done) != n_chunks:  # resumed with another chunk_size
+        done = np.zeros(n_chunks, dtype=bool)
+
+    jobs = [(chunk, paths[chunk * chunk_size:(chunk + 1) * chunk_size], size)
+            for chunk in xrange(n_chunks) if not done[chunk]]
+    pool = Pool(n_workers)
+    try:
+        for i, (chunk, chunk_images) in enumerate(pool.imap_unordered(_load_chunk, jobs)):
+            start = chunk * chunk_size
+            images[start:start + len(chunk_images)] = chunk_images
+            images.flush()
+            done[chunk] = True
+            np.save(mask_path, done)
+            print('Packed %s chunk [%d/%d]' % (partition, n_chunks - len(jobs) + i + 1, n_chunks))
+    finally:
+        pool.terminate()
+    del images
+    os.remove(mask_path)
+    return len(jobs)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--partitions', type=str, nargs='+',
+                        default=['train', 'val', 'test'], choices=VALID_PARTITIONS.keys(),
+                        help='partitions to pack [default: all]')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='images per unit of work [default: 1000]')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='decoding processes [default: one per CPU]')
+    args = parser.parse_args()
+
+    for partition in args.partitions:
+        build_image_store(partition, chunk_size=args.chunk_size, n_workers=args.n_workers)
+        print('Packed %s images into %s.' % (partition, store_path(partition)))
@@ -11,7 +11,6 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms
 from torchvision.utils import save_image
 
 import datasets
@@ -99,19 +98,11 @@ if __name__ == "__main__":
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
-    preprocess_data = transforms.Compose([transforms.Scale(64),
-                                          transforms.CenterCrop(64),
-                                          transforms.ToTensor()])
-
-    # create loaders for CelebA
-    train_loader = torch.utils.data.DataLoader(
-        datasets.CelebAttributes(partition='train',
-                                 image_transform=preprocess_data),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.CelebAttributes(partition='val',
-                                 image_transform=preprocess_data),
-        batch_size=args.batch_size, shuffle=True)
+    # create loaders over the packed images (see prepare_images.py)
+    train_loader = datasets.celeba_loader(partition='train', batch_size=args.batch_size,
+                                          shuffle=True)
+    test_loader = datasets.celeba_loader(partition='val', batch_size=args.batch_size,
+                                         shuffle=True)
 
     # load multimodal VAE
     vae = MultimodalVAE(args.n_latents, use_cuda=args.cuda)
@@ -135,9 +126,10 @@ if __name__ == "__main__":
     
             # for each batch, use 3 types of examples (joint, image-only, and attrs-only)
             # this way, we can hope to reconstruct both modalities from one
-            recon_image_1, recon_attrs_1, mu_1, logvar_1 = vae(image=image, attrs=attrs)
-            recon_image_2, recon_attrs_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_attrs_3, mu_3, logvar_3 = vae(attrs=attrs)
+            outputs = vae.forward_subsets(image, attrs)
+            recon_image_1, recon_attrs_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_attrs_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_attrs_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_x=recon_image_1, x=image, 
                                    recon_y=recon_attrs_1, y=attrs)
@@ -175,9 +167,10 @@ if __name__ == "__main__":
             image = Variable(image, volatile=True)
             attrs = Variable(attrs, volatile=True)
                 
-            recon_image_1, recon_attrs_1, mu_1, logvar_1 = vae(image=image, attrs=attrs)
-            recon_image_2, recon_attrs_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_attrs_3, mu_3, logvar_3 = vae(attrs=attrs)
+            outputs = vae.forward_subsets(image, attrs)
+            recon_image_1, recon_attrs_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_attrs_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_attrs_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_x=recon_image_1, x=image, 
                                    recon_y=recon_attrs_1, y=attrs)
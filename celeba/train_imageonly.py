@@ -11,7 +11,6 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms
 from torchvision.utils import save_image
 
 import datasets
@@ -82,18 +81,11 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/image_only'):
         os.makedirs('./results/image_only')
 
-    preprocess_data = transforms.Compose([transforms.Scale(64),
-                                          transforms.CenterCrop(64),
-                                          transforms.ToTensor()])
-
-    train_loader = torch.utils.data.DataLoader(
-        datasets.CelebAttributes(partition='train', 
-                                 image_transform=preprocess_data),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.CelebAttributes(partition='val',
-                                 image_transform=preprocess_data),
-        batch_size=args.batch_size, shuffle=True)
+    # create loaders over the packed images (see prepare_images.py)
+    train_loader = datasets.celeba_loader(partition='train', batch_size=args.batch_size,
+                                          shuffle=True)
+    test_loader = datasets.celeba_loader(partition='val', batch_size=args.batch_size,
+                                         shuffle=True)
 
     vae = ImageVAE(n_latents=args.n_latents)
     vae.weight_init(mean=0.0, std=0.02)
@@ -0,0 +1,329 @@
+"""COCO captions with the captions pre-tokenized into GloVe store ids, so
+no tokenization or embedding lookup happens per sample, and batch loading
+of small COCO images without decoding them at full resolution.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import random
+import numpy as np
+from PIL import Image
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+import torch
+import torchvision.datasets as dset
+
+from glove import load_glove
+from utils import MAX_WORDS, GLOVE_PATH, tokenize
+
+# id of padding positions and of words that are not in the GloVe store;
+# both are looked up as a zero vector (see model.WordEmbedding)
+PAD = -1
+# side of the images the models are trained on
+IMAGE_SIZE = 32
+# images per file of an image store, see build_image_store
+SHARD_SIZE = 1000
+
+
+class CocoCaptionIds(dset.CocoCaptions):
+    """Like datasets.CocoCaptions, but the target is one caption of the
+    image as a MAX_WORDS IntTensor of GloVe store rows, read from a cache
+    built by build_caption_cache. Embed it with MultimodalVAE.embed_text.
+
+    :param root: folder of COCO images
+    :param annFile: COCO captions annotation file
+    :param cache_dir: folder written by build_caption_cache for annFile
+    :param transform: transform for the image
+    :param deterministic: if True, always take the 1st caption.
+                          if False, randomly choose a caption.
+    :param glove_path: GloVe store the cache was built with
+    """
+    def __init__(self, root, annFile, cache_dir, transform=None,
+                 deterministic=False, glove_path=GLOVE_PATH):
+        super(CocoCaptionIds, self).__init__(root, annFile, transform=transform)
+        self.deterministic = deterministic
+        cache = load_caption_cache(cache_dir)
+        self.tokens = cache['tokens']
+        self.caption_offsets = cache['caption_offsets']
+        self.image_offsets = cache['image_offsets']
+        if cache['vocab_size'] != len(load_glove(glove_path).itos):
+            raise ValueError('%s was built with another GloVe store; rebuild it '
+                             'with datasets.py' % cache_dir)
+        row_of = {image_id: i for i, image_id in enumerate(cache['image_ids'])}
+        self.rows = [row_of[image_id] for image_id in self.ids]
+
+    def __getitem__(self, index):
+        img_id = self.ids[index]
+        path = self.coco.loadImgs(img_id)[0]['file_name']
+        image = Image.open(os.path.join(self.root, path)).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.caption(index)
+
+    def caption(self, index):
+        """Caption ids of image index, without loading the image."""
+        row = self.rows[index]
+        caption = self.image_offsets[row]
+        if not self.deterministic:
+            caption = random.randrange(caption, self.image_offsets[row + 1])
+        start, end = self.caption_offsets[caption], self.caption_offsets[caption + 1]
+        text = np.full(MAX_WORDS, PAD, dtype=np.int32)
+        text[:end - start] = self.tokens[start:end]
+        return torch.from_numpy(text)
+
+
+class CocoImageLoader(object):
+    """Iterates over (image, text) batches of a CocoCaptions dataset like
+    DataLoader(dataset, batch_size, shuffle) with a Scale(size),
+    CenterCrop(size), ToTensor() transform. Images are read from the store
+    built by build_image_store if store_dir holds one, and otherwise
+    decoded with load_image in a pool of processes, a few batches ahead.
+    text is the batch of caption ids for a CocoCaptionIds dataset and None
+    for any other dataset. The pool is started on the first epoch and
+    kept until close() (or the end of a with block).
+
+    :param dataset: datasets.CocoCaptions or CocoCaptionIds, no transform
+    :param batch_size: number of examples per batch (default: 1)
+    :param shuffle: if True, reshuffle the examples every epoch
+    :param size: side of the images (default: IMAGE_SIZE)
+    :param store_dir: image store of the dataset, used if it exists
+    :param n_workers: decoding processes (default: one per CPU)
+    :param transform: function applied to each float image batch
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False, size=IMAGE_SIZE,
+                 store_dir=None, n_workers=None, transform=None):
+        self.pool = None
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.size = size
+        self.n_workers = n_workers or cpu_count()
+        self.transform = transform
+        self.store = None
+        if store_dir is not None and os.path.isfile(os.path.join(store_dir, 'meta.json')):
+            self.store = load_image_store(store_dir)
+            if self.store['size'] != size:
+                raise ValueError('%s holds %dpx images, not %dpx' % (
+                    store_dir, self.store['size'], size))
+            row_of = {image_id: i for i, image_id in enumerate(self.store['image_ids'])}
+            self.rows = [row_of[image_id] for image_id in dataset.ids]
+
+    def __iter__(self):
+        n = len(self.dataset)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        batches = [order[start:start + self.batch_size]
+                   for start in xrange(0, n, self.batch_size)]
+        for i, image in enumerate(self._images(batches)):
+            image = torch.from_numpy(image).float().div_(255)
+            if self.transform is not None:
+                image = self.transform(image)
+            text = None
+            if isinstance(self.dataset, CocoCaptionIds):
+                text = torch.stack([self.dataset.caption(index) for index in batches[i]])
+            yield image, text
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def close(self):
+        """Stop the decoding processes, if any were started."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _images(self, batches):
+        """uint8 image arrays of the batches, in order."""
+        if self.store is not None:
+            shards = self.store['shards']
+            for batch in batches:
+                rows = [self.rows[index] for index in batch]
+                yield np.stack([shards[row // SHARD_SIZE][row % SHARD_SIZE] for row in rows])
+            return
+
+        if self.pool is None:
+            self.pool = Pool(self.n_workers)
+        pending = deque()
+        for batch in batches:
+            paths = [image_path(self.dataset, index) for index in batch]
+            pending.append(self.pool.apply_async(_load_images, ((paths, self.size),)))
+            if len(pending) > 2 * self.n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def image_path(dataset, index):
+    """File of image index of a CocoCaptions dataset."""
+    path = dataset.coco.loadImgs(dataset.ids[index])[0]['file_name']
+    return os.path.join(dataset.root, path)
+
+
+def load_image(path, size=IMAGE_SIZE):
+    """Decode an image and apply transforms.Scale(size) followed by
+    transforms.CenterCrop(size), as a 3 x size x size uint8 array. For a
+    JPEG, draft() has libjpeg scale it down by up to 8 while decoding,
+    keeping both sides at least size, so only a fraction of the pixels
+    of the full image are ever decoded.
+    """
+    image = Image.open(path)
+    image.draft('RGB', (size, size))
+    image = image.convert('RGB')
+    w, h = image.size
+    if w < h:
+        ow, oh = size, int(size * h / w)
+    else:
+        ow, oh = int(size * w / h), size
+    if (ow, oh) != (w, h):
+        image = image.resize((ow, oh), Image.BILINEAR)
+    x, y = int(round((ow - size) / 2.)), int(round((oh - size) / 2.))
+    image = image.crop((x, y, x + size, y + size))
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def _load_images(job):
+    paths, size = job
+    return np.stack([load_image(path, size) for path in paths])
+
+
+def build_image_store(root, annFile, store_dir, size=IMAGE_SIZE, n_workers=None):
+    """Decode every image of a COCO split with load_image and save them in
+    store_dir, SHARD_SIZE images per file:
+
+        image_ids.npy: COCO id of image i
+        images_<k>.npy: uint8, images k * SHARD_SIZE to (k + 1) * SHARD_SIZE
+        meta.json: side of the images, written once all shards are
+
+    Shards that are already saved are kept, so an interrupted build
+    resumes where it stopped.
+
+    :return: number of shards written
+    """
+    dataset = dset.CocoCaptions(root, annFile)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, 'image_ids.npy'), np.array(dataset.ids, dtype=np.int64))
+
+    n_shards = (len(dataset) + SHARD_SIZE - 1) // SHARD_SIZE
+    shards = [shard for shard in xrange(n_shards) if not os.path.isfile(
+        os.path.join(store_dir, 'images_%d.npy' % shard))]
+    jobs = [([image_path(dataset, index) for index in
+              xrange(shard * SHARD_SIZE, min((shard + 1) * SHARD_SIZE, len(dataset)))], size)
+            for shard in shards]
+    pool = Pool(n_workers)
+    try:
+        for i, images in enumerate(pool.imap(_load_images, jobs)):
+            shard_path = os.path.join(store_dir, 'images_%d.npy' % shards[i])
+            with open(shard_path + '.tmp', 'wb') as fp:
+                np.save(fp, images)
+            os.rename(shard_path + '.tmp', shard_path)
+            print('Saved image shard [%d/%d]' % (n_shards - len(shards) + i + 1, n_shards))
+    finally:
+        pool.terminate()
+
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as fp:
+        json.dump({'size': size, 'n_images': len(dataset)}, fp)
+    return len(shards)
+
+
+def load_image_store(store_dir):
+    """Memory-map the shards written by build_image_store."""
+    with open(os.path.join(store_dir, 'meta.json')) as fp:
+        store = json.load(fp)
+    store['image_ids'] = np.load(os.path.join(store_dir, 'image_ids.npy'))
+    n_shards = (store['n_images'] + SHARD_SIZE - 1) // SHARD_SIZE
+    store['shards'] = [np.load(os.path.join(store_dir, 'images_%d.npy' % shard), mmap_mode='r')
+                       for shard in xrange(n_shards)]
+    return store
+
+
+def build_caption_cache(annotation_path, cache_dir, glove_path=GLOVE_PATH):
+    """Tokenize every caption of a COCO captions annotation file and save
+    them as GloVe store rows in cache_dir:
+
+        tokens.npy: int32, the captions one after another
+        caption_offsets.npy: caption i is tokens[offsets[i]:offsets[i + 1]]
+        image_offsets.npy: image j has captions offsets[j]:offsets[j + 1]
+        image_ids.npy: COCO id of image j
+        meta.json: size of the GloVe vocabulary used
+
+    :return: number of captions
+    """
+    glove = load_glove(glove_path)
+    with open(annotation_path) as fp:
+        annotations = json.load(fp)
+    captions = {}
+    for annotation in annotations['annotations']:
+        captions.setdefault(annotation['image_id'], []).append(annotation['caption'])
+    image_ids = [image['id'] for image in annotations['images']]
+
+    tokens, caption_lengths, image_lengths = [], [], []
+    for image_id in image_ids:
+        for caption in captions.get(image_id, []):
+            ids = [glove.stoi.get(word, PAD) for word in tokenize(caption)]
+            tokens.extend(ids)
+            caption_lengths.append(len(ids))
+        image_lengths.append(len(captions.get(image_id, [])))
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    offsets = lambda lengths: np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    np.save(os.path.join(cache_dir, 'tokens.npy'), np.array(tokens, dtype=np.int32))
+    np.save(os.path.join(cache_dir, 'caption_offsets.npy'), offsets(caption_lengths))
+    np.save(os.path.join(cache_dir, 'image_offsets.npy'), offsets(image_lengths))
+    np.save(os.path.join(cache_dir, 'image_ids.npy'), np.array(image_ids, dtype=np.int64))
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as fp:
+        json.dump({'vocab_size': len(glove.itos)}, fp)
+    return len(caption_lengths)
+
+
+def load_caption_cache(cache_dir):
+    """Memory-map the arrays written by build_caption_cache."""
+    if not os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+        raise IOError('Caption cache %s not found. Run datasets.py to build it.' % cache_dir)
+    cache = {}
+    for name in ['tokens', 'caption_offsets', 'image_offsets', 'image_ids']:
+        cache[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+    with open(os.path.join(cache_dir, 'meta.json')) as fp:
+        cache.update(json.load(fp))
+    return cache
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--glove_path', type=str, default=GLOVE_PATH,
+                        help='GloVe store to take word ids from (default: %s)' % GLOVE_PATH)
+    parser.add_argument('--images', action='store_true', default=False,
+                        help='also save the images of each split, see build_image_store')
+    parser.add_argument('--image_size', type=int, default=IMAGE_SIZE,
+                        help='side of the saved images (default: %d)' % IMAGE_SIZE)
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='image decoding processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    for split in ['train2014', 'val2014']:
+        n_captions = build_caption_cache(
+            './data/coco/annotations/captions_%s.json' % split,
+            './data/coco/captions_%s' % split, glove_path=args.glove_path)
+        print('Cached %d %s captions.' % (n_captions, split))
+        if args.images:
+            store_dir = './data/coco/images%d_%s' % (args.image_size, split)
+            build_image_store('./data/coco/%s' % split,
+                              './data/coco/annotations/captions_%s.json' % split,
+                              store_dir, size=args.image_size, n_workers=args.n_workers)
+            print('Saved %s images to %s.' % (split, store_dir))
@@ -8,68 +8,77 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import io
+import os
+import numpy as np
+
 import torch
 from torch.autograd import Variable
 import torchtext.vocab as vocab
 
 
 class GloVe(object):
-    def __init__(self):
+    """
+    :param store_path: if given, read a vocabulary-restricted store 
+                       written by build_store instead of the full 
+                       840B table; the vectors are memory-mapped 
+                       read-only (default: None)
+    :param index_path: if given and the file exists, load an approximate
+                       IVF index from it for nearest-word search; build 
+                       one with build_index (default: None)
+    :param memory_mb: memory budget for exact nearest-word search
+                      (default: 256)
+    """
+    def __init__(self, store_path=None, index_path=None, memory_mb=256):
         super(GloVe, self).__init__()
-        self.glove = vocab.GloVe(name='840B', dim=300)
+        if store_path is not None:
+            self.itos, self.vectors = load_store(store_path)
+        else:
+            glove = vocab.GloVe(name='840B', dim=300)
+            self.itos, self.vectors = glove.itos, glove.vectors.numpy()
+        self.stoi = {word: i for i, word in enumerate(self.itos)}
+        if index_path is not None and os.path.isfile(index_path):
+            self.index = IVFIndex.load(index_path, self.vectors)
+        else:
+            self.index = ExactIndex(self.vectors, memory_mb=memory_mb)
 
     def get_word(self, word):
-        if word in self.glove.stoi:
-            return self.glove.vectors[self.glove.stoi[word]]
+        if word in self.stoi:
+            vec = np.array(self.vectors[self.stoi[word]], dtype=np.float32)
+            return torch.from_numpy(vec)
         return None
 
+    def build_index(self, index_path, **kwargs):
+        """Build an approximate IVF index over the vocabulary, save it
+        to index_path and use it for all later searches. Keyword 
+        arguments are passed to IVFIndex.build."""
+        self.index = IVFIndex.build(self.vectors, **kwargs)
+        self.index.save(index_path)
+
     def closest(self, vec, n=10):
         """
-        Find the closest words for a given vector; this is a 
-        naive implementation that goes through each word in the
-        dictionary. 
+        Find the closest words for a given vector.
 
         :param vec: PyTorch vector
                     size 300
         :param n: number of "close-by" vectors to return
                   (default: 10)
+        :return: list of (word, distance) sorted by distance
         """
-        all_dists = [(w, torch.dist(vec, self.get_word(w))) 
-                     for w in self.glove.itos]
-        return sorted(all_dists, key=lambda t: t[1])[:n]
+        dists, ixs = self.index.search(to_numpy(vec).reshape(1, -1), k=n)
+        return [(self.itos[ix], dist) for ix, dist in zip(ixs[0], dists[0])]
 
     def closest_batch(self, vec_batch):
-        """Find closest words for a batch of vectors. This 
-        loops through all glove training vectors once.
+        """Find closest words for a batch of vectors.
 
         :param vec: PyTorch vector
                     size N x 300
+        :return: list of N words
         """
-        batch_size = len(vec_batch)
-        dict_size = len(self.glove.itos)
-        all_dists = torch.zeros((batch_size, dict_size))
-        use_cuda = vec_batch.is_cuda
-
-        for iw, word in enumerate(self.glove.itos):
-            for iv, vec in enumerate(vec_batch):
-                word_vec = self.get_word(word)
-                if use_cuda:
-                    word_vec = word_vec.cuda()
-                word_vec = Variable(word_vec)
-                dist = torch.dist(vec, word_vec)
-                all_dists[iv, iw] = dist.data[0]
-
-        top_dist = torch.zeros(batch_size)
-        for ix in xrange(batch_size):
-            top_dist[ix] = torch.sort(all_dists[ix, :], dim=1)[1][0]
-
-        words = []
-        for ix in xrange(batch_size):
-            words.append(self.glove.itos[top_dist[ix]])
-
-        return words
-
-    def analogy(w1, w2, w3, n=5, filter_given=True):
+        _, ixs = self.index.search(to_numpy(vec_batch), k=1)
+        return [self.itos[ix] for ix in ixs[:, 0]]
+
+    def analogy(self, w1, w2, w3, n=5, filter_given=True):
         """Return 4th word in a 4 word analogy game.
 
         :param w1: string
@@ -84,10 +93,261 @@ class GloVe(object):
         # w2 - w1 + w3 = w4
         closest_words = self.closest(self.get_word(w2) - 
                                      self.get_word(w1) + 
-                                     self.get_word(w3))
+                                     self.get_word(w3), n=n + 3)
         
         # Optionally filter out given words
-        if self.filter_given:
+        if filter_given:
             closest_words = [t for t in closest_words if t[0] not in [w1, w2, w3]]
             
         return closest_words[:n]
+
+
+class ExactIndex(object):
+    """Exact nearest-neighbour search by euclidean distance. Distances
+    come from matrix products, ||q||^2 - 2 q.v + ||v||^2, over chunks of 
+    the vocabulary sized so that a chunk's float32 vectors and distances
+    take at most memory_mb at once; only the running top-k is kept 
+    between chunks. The squared norms of the vectors are computed on the
+    first search.
+
+    :param vectors: V x D numpy array (may be a memmap)
+    :param memory_mb: memory budget for a chunk of vectors and distances
+                      (default: 256)
+    """
+    def __init__(self, vectors, memory_mb=256):
+        self.vectors = vectors
+        self.memory_mb = memory_mb
+        self._sq_norms = None
+
+    @property
+    def sq_norms(self):
+        if self._sq_norms is None:
+            vectors = self.vectors
+            sq_norms = np.zeros(len(vectors), dtype=np.float32)
+            chunk_size = self.chunk_size(0)
+            for start in xrange(0, len(vectors), chunk_size):
+                chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+                sq_norms[start:start + chunk_size] = np.einsum('ij,ij->i', chunk, chunk)
+            self._sq_norms = sq_norms
+        return self._sq_norms
+
+    def chunk_size(self, n_queries):
+        """Rows per chunk: each takes 4 bytes per query for its distances
+        and 4 per dimension for its float32 copy."""
+        row_bytes = 4 * (n_queries + self.vectors.shape[1])
+        return max(1, int(self.memory_mb * 2 ** 20 // row_bytes))
+
+    def search(self, queries, k=1):
+        """
+        :param queries: Q x D numpy array
+        :param k: number of neighbours per query
+        :return dists: Q x k numpy array of distances, nearest first
+        :return ixs: Q x k numpy array of row indices into vectors
+        """
+        return self.search_rows(queries, k=k)
+
+    def search_rows(self, queries, k=1, rows=None):
+        """Like search, but only over the given subset of rows (numpy 
+        array of indices; default: all rows)."""
+        queries = np.asarray(queries, dtype=np.float32)
+        n_queries = queries.shape[0]
+        n_rows = len(self.vectors) if rows is None else len(rows)
+        k = min(k, n_rows)
+        q_sq_norms = np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+        q_ix = np.arange(n_queries)[:, np.newaxis]
+
+        best_dists = np.zeros((n_queries, 0), dtype=np.float32)
+        best_ixs = np.zeros((n_queries, 0), dtype=np.int64)
+        sq_norms = self.sq_norms
+        chunk_size = max(k, self.chunk_size(n_queries))
+        for start in xrange(0, n_rows, chunk_size):
+            if rows is None:
+                chunk_ixs = np.arange(start, min(start + chunk_size, n_rows))
+                chunk = np.asarray(self.vectors[start:start + chunk_size], dtype=np.float32)
+            else:
+                chunk_ixs = rows[start:start + chunk_size]
+                chunk = np.asarray(self.vectors[chunk_ixs], dtype=np.float32)
+            dists = q_sq_norms - 2 * queries.dot(chunk.T) + sq_norms[chunk_ixs]
+            # keep only the k best of this chunk before merging
+            if dists.shape[1] > k:
+                top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+                dists, ixs = dists[q_ix, top], chunk_ixs[top]
+            else:
+                ixs = np.tile(chunk_ixs, (n_queries, 1))
+            best_dists = np.concatenate((best_dists, dists), axis=1)
+            best_ixs = np.concatenate((best_ixs, ixs), axis=1)
+            if best_dists.shape[1] > k:
+                top = np.argpartition(best_dists, k - 1, axis=1)[:, :k]
+                best_dists, best_ixs = best_dists[q_ix, top], best_ixs[q_ix, top]
+
+        order = np.argsort(best_dists, axis=1)
+        best_dists, best_ixs = best_dists[q_ix, order], best_ixs[q_ix, order]
+        return np.sqrt(np.maximum(best_dists, 0)), best_ixs
+
+
+class IVFIndex(object):
+    """Approximate nearest-neighbour search with an inverted file: every
+    vector is bucketed under its nearest k-means centroid, and a query 
+    only scans the buckets of its n_probe nearest centroids exactly.
+
+    :param vectors: V x D numpy array the index was built over
+    :param centroids: n_lists x D numpy array of k-means centroids
+    :param list_ixs: V numpy array of row indices sorted by bucket
+    :param list_offsets: n_lists + 1 numpy array; bucket i holds 
+                         list_ixs[list_offsets[i]:list_offsets[i + 1]]
+    :param n_probe: number of buckets to scan per query (default: 8)
+    """
+    def __init__(self, vectors, centroids, list_ixs, list_offsets, n_probe=8):
+        self.exact = ExactIndex(vectors)
+        self.coarse = ExactIndex(centroids)
+        self.centroids = centroids
+        self.list_ixs = list_ixs
+        self.list_offsets = list_offsets
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, vectors, n_lists=1024, n_iter=10, n_train=100000, 
+              n_probe=8, seed=0):
+        """Run k-means on a random sample of n_train vectors, then 
+        assign every vector to its nearest centroid."""
+        rs = np.random.RandomState(seed)
+        train_ixs = rs.choice(len(vectors), min(n_train, len(vectors)), replace=False)
+        train = np.asarray(vectors[np.sort(train_ixs)], dtype=np.float32)
+        centroids = train[rs.choice(len(train), n_lists, replace=False)]
+        for _ in xrange(n_iter):
+            _, assign = ExactIndex(centroids).search(train, k=1)
+            assign = assign[:, 0]
+            counts = np.bincount(assign, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            # empty buckets keep their previous centroid
+            nonempty = counts > 0
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+
+        _, assign = ExactIndex(centroids).search(vectors, k=1)
+        assign = assign[:, 0]
+        list_ixs = np.argsort(assign, kind='mergesort')
+        counts = np.bincount(assign, minlength=n_lists)
+        list_offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls(vectors, centroids, list_ixs, list_offsets, n_probe=n_probe)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_ixs=self.list_ixs,
+                 list_offsets=self.list_offsets)
+
+    @classmethod
+    def load(cls, path, vectors, n_probe=8):
+        data = np.load(path)
+        return cls(vectors, data['centroids'], data['list_ixs'], 
+                   data['list_offsets'], n_probe=n_probe)
+
+    def search(self, queries, k=1):
+        """Same interface as ExactIndex.search."""
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        _, probes = self.coarse.search(queries, k=n_probe)
+        dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ixs = np.zeros((len(queries), k), dtype=np.int64)
+        for i in xrange(len(queries)):
+            rows = np.concatenate([self.list_ixs[self.list_offsets[p]:self.list_offsets[p + 1]]
+                                   for p in probes[i]])
+            q_dists, q_ixs = self.exact.search_rows(queries[i:i + 1], k=k, rows=rows)
+            dists[i, :q_dists.shape[1]] = q_dists[0]
+            ixs[i, :q_ixs.shape[1]] = q_ixs[0]
+        return dists, ixs
+
+
+_loaded = {}
+
+
+def load_glove(store_path=None):
+    """Return the GloVe instance for store_path, creating it on first
+    use so every consumer in a process shares one table. If store_path
+    does not exist yet, fall back to the full 840B table.
+    """
+    if store_path is not None and not os.path.isfile(store_path):
+        print('GloVe store %s not found; loading the full table. '
+              'Run prepare_glove.py to build it.' % store_path)
+        store_path = None
+    if store_path not in _loaded:
+        _loaded[store_path] = GloVe(store_path=store_path)
+    return _loaded[store_path]
+
+
+def vocab_path(store_path):
+    return os.path.splitext(store_path)[0] + '.vocab'
+
+
+def build_store(store_path, words, required=(), dtype='float32', seed=0):
+    """Write the GloVe vectors of the given words to store_path (a .npy
+    matrix) and their order to a .vocab file next to it, one word per 
+    line; the line number is the row of the word. Words that are not in
+    GloVe are dropped, except the required ones (e.g. SOS and EOS), which
+    come first and get a fixed random vector of typical norm if missing.
+
+    :param store_path: path of the .npy file to write
+    :param words: iterable of words
+    :param required: words that always get a row (default: ())
+    :param dtype: float32 or float16 (default: float32)
+    :param seed: random seed for the vectors of missing required words
+    :return: number of words in the store
+    """
+    glove = vocab.GloVe(name='840B', dim=300)
+    itos = list(required)
+    itos += sorted(set(w for w in words if w in glove.stoi) - set(required))
+
+    vectors = np.lib.format.open_memmap(store_path, mode='w+', dtype=dtype,
+                                        shape=(len(itos), glove.dim))
+    found = [i for i, w in enumerate(itos) if w in glove.stoi]
+    rows = torch.LongTensor([glove.stoi[itos[i]] for i in found])
+    vectors[found] = glove.vectors.index_select(0, rows).numpy()
+    missing = [i for i, w in enumerate(itos) if w not in glove.stoi]
+    if len(missing) > 0:
+        norm = np.linalg.norm(np.asarray(vectors[found], dtype=np.float32), axis=1).mean()
+        random = np.random.RandomState(seed).randn(len(missing), glove.dim)
+        random *= norm / np.linalg.norm(random, axis=1, keepdims=True)
+        vectors[missing] = random
+    vectors.flush()
+    del vectors
+
+    with io.open(vocab_path(store_path), 'w', encoding='utf-8') as fp:
+        for word in itos:
+            fp.write(u'%s\n' % word)
+    return len(itos)
+
+
+def load_store(store_path):
+    """Open a store written by build_store.
+
+    :return itos: list of words
+    :return vectors: V x 300 read-only numpy memmap
+    """
+    with io.open(vocab_path(store_path), encoding='utf-8') as fp:
+        itos = fp.read().split('\n')[:-1]
+    vectors = np.load(store_path, mmap_mode='r')
+    assert len(itos) == len(vectors), 'vocab and vectors of %s differ' % store_path
+    return itos, vectors
+
+
+def to_numpy(vec):
+    if isinstance(vec, Variable):
+        vec = vec.data
+    return vec.cpu().numpy()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index_path', type=str, default='./data/glove_ivf.npz',
+                        help='where to save the IVF index (default: ./data/glove_ivf.npz)')
+    parser.add_argument('--store_path', type=str, default=None,
+                        help='if given, index this GloVe store instead of the full table')
+    parser.add_argument('--n_lists', type=int, default=1024,
+                        help='number of k-means buckets (default: 1024)')
+    parser.add_argument('--n_iter', type=int, default=10,
+                        help='number of k-means iterations (default: 10)')
+    args = parser.parse_args()
+
+    glove = GloVe(store_path=args.store_path)
+    glove.build_index(args.index_path, n_lists=args.n_lists, n_iter=args.n_iter)
+    print('Saved IVF index to %s' % args.index_path)
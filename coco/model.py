@@ -15,8 +15,8 @@ from torch.nn import functional as F
 from torch.nn.parameter import Parameter
 
 import numpy as np
-from glove import GloVe
-from utils import MAX_WORDS, SOS, EOS
+from glove import load_glove, to_numpy
+from utils import MAX_WORDS, SOS, EOS, GLOVE_PATH
 
 
 class MultimodalVAE(nn.Module):
@@ -26,6 +26,7 @@ class MultimodalVAE(nn.Module):
         self.image_decoder = ImageDecoder(n_latents)
         self.text_encoder = TextEncoder(n_latents)
         self.text_decoder = TextDecoder(n_latents, use_cuda=use_cuda)
+        self.word_embedding = WordEmbedding(self.text_decoder.glove)
         self.experts = ProductOfExperts()
 
     def reparametrize(self, mu, logvar):
@@ -42,11 +43,14 @@ class MultimodalVAE(nn.Module):
     def decode_image(self, z):
         return self.image_decoder(z)
 
+    def embed_text(self, ids):
+        return self.word_embedding(ids)
+
     def encode_text(self, x):
         return self.text_encoder(x)
 
-    def decode_text(self, z):
-        return self.text_decoder(z)
+    def decode_text(self, z, text=None):
+        return self.text_decoder(z, text=text)
 
     def prior(self, size, use_cuda=False):
         mu = Variable(torch.zeros(size))
@@ -57,7 +61,7 @@ class MultimodalVAE(nn.Module):
 
         return mu, logvar
 
-    def forward(self, image=None, text=None):
+    def forward(self, image=None, text=None, teacher_forcing=False):
         # can't just put nothing
         assert image is not None or text is not None
         if image is not None and text is not None:
@@ -85,8 +89,72 @@ class MultimodalVAE(nn.Module):
         z = self.reparametrize(mu, logvar)
         # reconstruct inputs based on that gaussian
         image_recon = self.decode_image(z)
-        text_recon = self.decode_text(z)
+        text_recon = self.decode_text(z, text=text if teacher_forcing else None)
+
+        return image_recon, text_recon, mu, logvar
 
+    def forward_subsets(self, image, text, teacher_forcing=False):
+        """Equivalent to calling forward with (image, text), (image) and
+        (text) but each encoder runs only once and the latents of all
+        three subsets are decoded together as one concatenated batch.
+
+        :param image: batch of images
+        :param text: batch of texts
+        :param teacher_forcing: if True, decode text with the ground truth
+                                as input (default: False)
+        :return: list of (image_recon, text_recon, mu, logvar) tuples for
+                 the joint, image-only and text-only subsets (in that order)
+        """
+        batch_size = image.size(0)
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        # product of experts for every subset of modalities; shares the
+        # encoder outputs rather than recomputing them per subset
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        joint_mu, joint_logvar = self.experts(mu, logvar)
+        image_mu, image_logvar = self.experts(image_mu.unsqueeze(0),
+                                              image_logvar.unsqueeze(0))
+        text_mu, text_logvar = self.experts(text_mu.unsqueeze(0),
+                                            text_logvar.unsqueeze(0))
+        mu = torch.cat((joint_mu, image_mu, text_mu), dim=0)
+        logvar = torch.cat((joint_logvar, image_logvar, text_logvar), dim=0)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # one decoder call per modality over all subsets at once
+        image_recon = torch.split(self.decode_image(z), batch_size, dim=0)
+        text_in = torch.cat((text, text, text), dim=0) if teacher_forcing else None
+        text_recon = torch.split(self.decode_text(z, text=text_in), batch_size, dim=0)
+        mu = torch.split(mu, batch_size, dim=0)
+        logvar = torch.split(logvar, batch_size, dim=0)
+        return list(zip(image_recon, text_recon, mu, logvar))
+
+    def forward_masked(self, image, text, image_mask, text_mask, prior_expert=False,
+                       teacher_forcing=False):
+        """Like forward but each example chooses which modalities enter the
+        product of experts, so a single batch can mix paired, image-only 
+        and text-only examples in one pass.
+
+        :param image: batch of images; ignored where image_mask is 0
+        :param text: batch of texts; ignored where text_mask is 0
+        :param image_mask: B float tensor; 1 if the image is observed
+        :param text_mask: B float tensor; 1 if the text is observed
+        :param prior_expert: if True, add p(z) as an expert (default: False)
+        :param teacher_forcing: if True, decode text with the ground truth
+                                as input (default: False)
+        """
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        mask = torch.stack((image_mask, text_mask), dim=0)
+        # product of the observed experts only
+        mu, logvar = self.experts(mu, logvar, mask=mask, prior_expert=prior_expert)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # reconstruct inputs based on that gaussian
+        image_recon = self.decode_image(z)
+        text_recon = self.decode_text(z, text=text if teacher_forcing else None)
         return image_recon, text_recon, mu, logvar
 
 
@@ -122,8 +190,12 @@ class TextVAE(nn.Module):
         super(TextVAE, self).__init__()
         self.encoder = TextEncoder(n_latents)
         self.decoder = TextDecoder(n_latents, use_cuda=use_cuda)
+        self.word_embedding = WordEmbedding(self.decoder.glove)
         self.n_latents = n_latents
 
+    def embed(self, ids):
+        return self.word_embedding(ids)
+
     def encode(self, x):
         return self.encoder(x)
 
@@ -135,13 +207,13 @@ class TextVAE(nn.Module):
         else:  # return mean during inference
             return mu
 
-    def decode(self, z):
-        return self.decoder(z)
+    def decode(self, z, x=None):
+        return self.decoder(z, text=x)
 
-    def forward(self, x):
+    def forward(self, x, teacher_forcing=False):
         mu, logvar = self.encode(x)
         z = self.reparametrize(mu, logvar)
-        return self.decode(z), mu, logvar
+        return self.decode(z, x if teacher_forcing else None), mu, logvar
 
 
 class ImageEncoder(nn.Module):
@@ -242,6 +314,39 @@ class TextEncoder(nn.Module):
         return x[:, :n_latents], x[:, n_latents:]
 
 
+class WordEmbedding(nn.Module):
+    """Frozen lookup from GloVe store rows (see datasets.CocoCaptionIds)
+    to GloVe vectors for a whole batch. Negative ids (padding and unknown
+    words) become zero vectors. The table is not a parameter, so it is 
+    neither trained nor saved in checkpoints. On the CPU, only the rows 
+    a batch needs are read from the (shared, read-only) GloVe memmap; 
+    the full table is copied only when moved to the GPU.
+
+    :param glove: GloVe instance whose rows the ids index
+    """
+    def __init__(self, glove):
+        super(WordEmbedding, self).__init__()
+        self.vectors = glove.vectors
+        self.weight = None  # full table, on the GPU only
+        self.n_embedding = self.vectors.shape[1]
+
+    def forward(self, ids):
+        # ids is a (batch, seq_len) Variable of int ids
+        volatile = ids.volatile
+        ids = ids.data.long()
+        known = ids.ge(0).unsqueeze(2).float()
+        if ids.is_cuda:
+            if self.weight is None:
+                self.weight = torch.from_numpy(
+                    np.array(self.vectors, dtype=np.float32)).cuda()
+            x = self.weight.index_select(0, ids.clamp(min=0).view(-1))
+        else:
+            rows = np.take(self.vectors, ids.clamp(min=0).view(-1).numpy(), axis=0)
+            x = torch.from_numpy(np.asarray(rows, dtype=np.float32))
+        x = x.view(ids.size(0), ids.size(1), self.n_embedding) * known
+        return Variable(x, volatile=volatile)
+
+
 class TextDecoder(nn.Module):
     """GRU for text decoding. 
 
@@ -249,19 +354,28 @@ class TextDecoder(nn.Module):
     :param n_embedding: size of GloVe embedding
                         (default: 300)
     :param use_cuda: whether to use cuda tensors
+    :param glove_path: GloVe store to read embeddings from; falls back
+                       to the full table if missing (default: GLOVE_PATH)
     """
-    def __init__(self, n_latents, n_embedding=300, n_hiddens=200,  use_cuda=False):
+    def __init__(self, n_latents, n_embedding=300, n_hiddens=200,  use_cuda=False,
+                 glove_path=GLOVE_PATH):
         super(TextDecoder, self).__init__()
         self.z2h = nn.Linear(n_latents, n_hiddens)
         self.gru = nn.GRU(n_embedding + n_latents, n_hiddens, 2, dropout=0.1)
         self.h2o = nn.Linear(n_hiddens + n_latents, n_embedding)
-        self.glove = GloVe()
+        self.glove = load_glove(glove_path)
         self.use_cuda = use_cuda
         self.n_latents = n_latents
         self.n_embedding = n_embedding
         self.n_hiddens = n_hiddens
 
-    def forward(self, z):
+    def forward(self, z, text=None):
+        """Free-running decoding where each step is fed the previous 
+        step's output vector. If text is given, decode with teacher 
+        forcing instead (see forward_teacher)."""
+        if text is not None:
+            return self.forward_teacher(z, text)
+
         n_latents = self.n_latents
         batch_size = z.size(0)
         # when generating, first word is always SOS - get GloVe embedding for it
@@ -285,24 +399,114 @@ class TextDecoder(nn.Module):
 
         return sentence  # (batch_size, seq_len, ...)
 
+    def forward_teacher(self, z, text):
+        """Teacher-forced decoding for training: the ground truth shifted
+        right by one (starting with SOS) is the input at every position,
+        so the whole sentence runs through the GRU in a single call. 
+        Matches step() applied position by position to the same inputs.
+
+        :param z: batch_size x n_latents
+        :param text: batch_size x seq_len x n_embedding ground truth
+        """
+        batch_size, seq_len = text.size(0), text.size(1)
+        sos = self.glove.get_word(SOS)
+        w_sos = Variable(sos.repeat(batch_size).view(batch_size, 1, self.n_embedding))
+        if self.use_cuda:
+            w_sos = w_sos.cuda()
+        w_in = torch.cat((w_sos, text[:, :-1]), dim=1)
+        z_seq = z.unsqueeze(1).expand(batch_size, seq_len, z.size(1))
+        w_in = torch.cat((w_in, z_seq), dim=2)  # n_embedding + n_latents
+        w_in = w_in.transpose(0, 1)  # GRU expects (seq_len, batch, ...)
+        # get initial hiddens from latents
+        h = self.z2h(z).unsqueeze(0).repeat(2, 1, 1)
+        w_out, _ = self.gru(w_in, h)
+        w_out = w_out.transpose(0, 1)
+        w_out = torch.cat((w_out, z_seq), dim=2).contiguous()
+        w_out = self.h2o(w_out.view(batch_size * seq_len, -1))
+        return w_out.view(batch_size, seq_len, self.n_embedding)
+
     def generate(self, z):
-        words = self.forward(z)  # shape is (batch_size, seq_len, n_embedding)
-        words = words.view(-1, self.n_embedding)
-        # this returns a list of strings of shape |batch_size * seq_len|
-        strings = self.glove.closest_batch(words)
-        # reshape this back into a list of size batch_size with space separated
-        # words.
+        # only the words before each sentence's EOS are kept
+        _, ixs, lengths = self.generate_packed(z)
+        # reshape the packed words back into a list of size batch_size 
+        # with space separated words.
         reshape = []
-        for i in xrange(words.size(0)):
-            sentence = []
-            for j in xrange(words.size(1)):
-                ix = i * words.size(0) + j
-                sentence.append(strings[ix])
-            sentence = ' '.join(sentence)
+        offset = 0
+        for length in lengths:
+            sentence = ' '.join(self.glove.itos[ix] for ix in ixs[offset:offset + length])
             reshape.append(sentence)
+            offset += length
 
         return reshape
 
+    def generate_packed(self, z, max_words=MAX_WORDS):
+        """Generate sentences, ending each one as soon as it emits EOS.
+        Every output vector is mapped to its nearest GloVe word, as 
+        glove.closest_batch does when decoding, and a sentence ends when
+        that word is EOS. Finished sentences are dropped from the active
+        batch, and decoding stops once every one is done.
+
+        :param z: batch_size x n_latents
+        :param max_words: most words to generate (default: MAX_WORDS)
+        :return words: (sum(lengths), n_embedding) tensor of the generated
+                       word vectors, packed one sentence after another 
+                       (EOS is dropped); None if every sentence is empty
+        :return ixs: list of the GloVe rows nearest to each of words
+        :return lengths: list of length batch_size with the number of 
+                         words in each sentence
+        """
+        batch_size = z.size(0)
+        sos = self.glove.get_word(SOS)
+        eos_ix = self.glove.stoi[EOS]
+        # indices (into the batch) of the sentences still being generated
+        active = torch.arange(0, batch_size).long()
+        w_in = Variable(sos.repeat(batch_size).view(batch_size, self.n_embedding))
+        if self.use_cuda:
+            active = active.cuda()
+            w_in = w_in.cuda()
+        h = self.z2h(z).unsqueeze(0).repeat(2, 1, 1)
+        # (step, sentence) buffers of the words; EOS and the steps after 
+        # a sentence ended keep -1 as their row
+        words = w_in.data.new(max_words, batch_size, self.n_embedding).zero_()
+        ixs = torch.LongTensor(max_words, batch_size).fill_(-1)
+        n_steps = 0
+
+        for i in xrange(max_words):
+            w_out, h = self.step(i, z, w_in, h)
+            _, step_ixs = self.glove.index.search(to_numpy(w_out), k=1)
+            step_ixs = torch.from_numpy(step_ixs[:, 0]).long()
+            running = step_ixs.ne(eos_ix)
+            words[i].index_copy_(0, active, w_out.data)
+            ixs[i].index_copy_(0, active.cpu(), step_ixs.masked_fill_(step_ixs.eq(eos_ix), -1))
+            n_steps = i + 1
+
+            n_running = running.sum()
+            if n_running == 0:
+                break
+            if n_running < active.size(0):
+                # shrink the active batch to the unfinished sentences
+                keep = running.nonzero().view(-1)
+                if self.use_cuda:
+                    keep = keep.cuda()
+                active = active[keep]
+                z = z.index_select(0, Variable(keep))
+                h = h.index_select(1, Variable(keep))
+                w_out = w_out.index_select(0, Variable(keep))
+            w_in = w_out
+
+        # sentence-major, then keep the words before each EOS
+        ixs = ixs[:n_steps].t().contiguous()
+        kept = ixs.ge(0)
+        lengths = kept.long().sum(1).tolist()
+        if not any(lengths):
+            return None, [], lengths
+        ixs = ixs.masked_select(kept).tolist()
+        if self.use_cuda:
+            kept = kept.cuda()
+        words = words[:n_steps].transpose(0, 1)
+        words = words.masked_select(kept.unsqueeze(2).expand_as(words))
+        return words.view(-1, self.n_embedding), ixs, lengths
+
     def generate_vector(self, z):
         return self.forward(z)
 
@@ -321,14 +525,45 @@ class ProductOfExperts(nn.Module):
     """Return parameters for product of independent experts.
     See https://arxiv.org/pdf/1410.7827.pdf for equations.
 
-    :param mu: M x D for M experts
-    :param logvar: M x D for M experts
+    The product is precision-weighted and computed in log space, 
+    so a missing expert can be dropped per example via the mask.
+
+    :param mu: M x B x D for M experts
+    :param logvar: M x B x D for M experts
+    :param mask: M x B; 1 if the expert is observed for that example,
+                 0 if it should be left out of the product; an example 
+                 with no observed expert gets the prior p(z) = N(0, I)
+                 (default: None)
+    :param prior_expert: if True, add p(z) = N(0, I) as an extra expert;
+                         regularizes for missing modalities (default: False)
     """
-    def forward(self, mu, logvar, eps=1e-8):
-        var = torch.exp(logvar) + eps
-        pd_mu = torch.sum(mu * var, dim=0) / torch.sum(var, dim=0)
-        pd_var = 1 / torch.sum(1 / var, dim=0)
-        pd_logvar = torch.log(pd_var)
+    def forward(self, mu, logvar, mask=None, prior_expert=False):
+        if prior_expert or mask is not None:
+            prior_size = (1, mu.size(1), mu.size(2))
+            prior_mu = Variable(mu.data.new(*prior_size).zero_())
+            prior_logvar = Variable(logvar.data.new(*prior_size).zero_())
+            mu = torch.cat((mu, prior_mu), dim=0)
+            logvar = torch.cat((logvar, prior_logvar), dim=0)
+            if mask is not None:
+                if prior_expert:
+                    prior_mask = Variable(mask.data.new(1, mask.size(1)).fill_(1))
+                else:
+                    # only examples with no observed expert use the prior
+                    prior_mask = mask.sum(0, keepdim=True).eq(0).float()
+                mask = torch.cat((mask, prior_mask), dim=0)
+
+        # log precision is log(1 / var) = -logvar
+        log_precision = -logvar
+        if mask is not None:
+            mask = mask.unsqueeze(2).expand_as(logvar)
+            # missing experts get a vanishing precision
+            log_precision = log_precision * mask + (mask - 1) * 1e10
+        # logsumexp over experts: sum of precisions is the product precision
+        max_log_precision = torch.max(log_precision, dim=0, keepdim=True)[0]
+        weights = torch.exp(log_precision - max_log_precision)
+        sum_weights = torch.sum(weights, dim=0)
+        pd_mu = torch.sum(mu * weights, dim=0) / sum_weights
+        pd_logvar = -(max_log_precision.squeeze(0) + torch.log(sum_weights))
         return pd_mu, pd_logvar
 
 
@@ -382,33 +617,96 @@ class InfoVAE(nn.Module):
         return self.decode(z), z
 
 
-def compute_kernel(x, y):
-    """Apply Gaussian kernel to the i-th vector of x and j-th vector of y.
+def compute_kernel(x, y, scales=(1.,)):
+    """Apply Gaussian kernel to the i-th vector of x and j-th vector of y,
+    exp(-|x_i - y_j|^2 / (scale * dim^2)) averaged over the scales. The
+    squared distances come from |x_i|^2 + |y_j|^2 - 2 x_i.y_j, one matrix
+    product, instead of tiling x and y into x_size x y_size x dim.
 
     :param x: torch.Tensor (x_size, dim)
     :param y: torch.Tensor (y_size, dim)
+    :param scales: multipliers of the default bandwidth dim^2 (default: (1,))
     """
-    x_size, y_size, dim = x.size(0), y.size(0), x.size(1)
-    tiled_x = x.unsqueeze(1).expand(x_size, y_size, dim)
-    tiled_y = y.unsqueeze(0).expand(x_size, y_size, dim)
-    return torch.exp(-torch.mean(torch.pow(tiled_x - tiled_y, 2), dim=2) / dim)
+    dim = x.size(1)
+    sq_dist = torch.sum(torch.pow(x, 2), 1).unsqueeze(1) + \
+        torch.sum(torch.pow(y, 2), 1).unsqueeze(0) - 2 * torch.mm(x, y.t())
+    kernel = 0
+    for scale in scales:
+        kernel = kernel + torch.exp(-sq_dist / float(scale * dim * dim))
+    return kernel / len(scales)
+
+
+def compute_kernel_mean(x, y, scales=(1.,), max_block=2**22):
+    """Mean of compute_kernel(x, y) over all pairs, computed over blocks
+    of rows of x so that no block has more than max_block entries."""
+    rows = max(1, max_block // y.size(0))
+    total = 0
+    for start in xrange(0, x.size(0), rows):
+        total = total + torch.sum(compute_kernel(x[start:start + rows], y, scales))
+    return total / float(x.size(0) * y.size(0))
 
 
-def compute_mmd(x, y):
-    """Compute maximum mean discrepancy."""
-    x_kernel = compute_kernel(x, x)
-    y_kernel = compute_kernel(y, y)
-    xy_kernel = compute_kernel(x, y)
-    return torch.mean(x_kernel) + torch.mean(y_kernel) - 2 * torch.mean(xy_kernel)
+def random_fourier_features(x, weights):
+    """Features whose dot products approximate the Gaussian kernel, for
+    frequencies drawn as in compute_mmd.
+
+    :param x: torch.Tensor (x_size, dim)
+    :param weights: torch.Tensor (dim, n_features) of random frequencies
+    :return: torch.Tensor (x_size, 2 * n_features)
+    """
+    projection = torch.mm(x, weights)
+    return torch.cat([torch.cos(projection), torch.sin(projection)], 1) / \
+        float(weights.size(1)) ** 0.5
+
+
+def compute_mmd(x, y, scales=(1.,), max_block=2**22, n_features=None):
+    """Compute maximum mean discrepancy.
+
+    :param x: torch.Tensor (x_size, dim)
+    :param y: torch.Tensor (y_size, dim)
+    :param scales: bandwidth multipliers of the kernel (see compute_kernel)
+    :param max_block: most kernel entries computed at once (default: 2**22)
+    :param n_features: if set, approximate the kernel with this many random
+                       Fourier features per scale: linear instead of
+                       quadratic in the batch size (default: None)
+    """
+    if n_features is None:
+        return compute_kernel_mean(x, x, scales, max_block) + \
+            compute_kernel_mean(y, y, scales, max_block) - \
+            2 * compute_kernel_mean(x, y, scales, max_block)
+
+    # frequencies of exp(-|d|^2 / (scale * dim^2)) are N(0, 2 / (scale * dim^2))
+    dim = x.size(1)
+    weights = []
+    for scale in scales:
+        std = (2. / (scale * dim * dim)) ** 0.5
+        weights.append(x.data.new(dim, n_features).normal_(0, std))
+    weights = Variable(torch.cat(weights, 1))
+    # the mean of the features of each side; scales share the normalization
+    # so that dot products average over them like compute_kernel
+    diff = torch.mean(random_fourier_features(x, weights), 0) - \
+        torch.mean(random_fourier_features(y, weights), 0)
+    return torch.sum(torch.pow(diff, 2))
 
 
 # ---- Start PixelCNN Section ----
 
 
 class PixelCNN(nn.Module):
-    """Vanilla PixelCNN from first Van de Oord paper."""
-    def __init__(self, n_blocks=15, data_channels=1, hid_dims=128, out_dims=256):
+    """Vanilla PixelCNN from first Van de Oord paper.
+
+    :param n_blocks: number of masked 3 x 3 convolutions
+    :param data_channels: number of image channels
+    :param hid_dims: number of hidden channels
+    :param out_dims: number of levels of a subpixel
+    :param n_logistics: if set, output the parameters of a mixture of
+                        n_logistics discretized logistics per subpixel
+                        instead of out_dims logits (default: None)
+    """
+    def __init__(self, n_blocks=15, data_channels=1, hid_dims=128, out_dims=256,
+                 n_logistics=None):
         super(PixelCNN, self).__init__()
+        self.n_params = 3 * n_logistics if n_logistics else out_dims
         self.conv1 = MaskedConv2d('A', data_channels, hid_dims, 7, 1, 3)
         blocks = []
         for _ in xrange(n_blocks):
@@ -417,10 +715,11 @@ class PixelCNN(nn.Module):
             blocks += [conv, relu]
         self.blocks = nn.Sequential(*blocks)
         self.conv2 = MaskedConv2d('B', hid_dims, hid_dims, 1)
-        self.conv4 = MaskedConv2d('B', hid_dims, out_dims * data_channels, 1)
+        self.conv4 = MaskedConv2d('B', hid_dims, self.n_params * data_channels, 1)
         self.data_channels = data_channels
         self.hid_dims = hid_dims
         self.out_dims = out_dims
+        self.n_logistics = n_logistics
         self.n_blocks = n_blocks
 
     def forward(self, x):
@@ -429,20 +728,24 @@ class PixelCNN(nn.Module):
         x = F.relu(self.conv2(x))
         x = self.conv4(x)
         batch_size, _, height, width = x.size()
-        x = x.view(batch_size, self.out_dims, self.data_channels, height, width)         
+        x = x.view(batch_size, self.n_params, self.data_channels, height, width)         
         return x
 
 
 class GatedPixelCNN(nn.Module):
-    """Improved PixelCNN with blind spot and gated blocks."""
-    def __init__(self, n_blocks=15, data_channels=1, hid_dims=128, out_dims=256):
+    """Improved PixelCNN with blind spot and gated blocks; parameters as
+    for PixelCNN."""
+    def __init__(self, n_blocks=15, data_channels=1, hid_dims=128, out_dims=256,
+                 n_logistics=None):
         super(GatedPixelCNN, self).__init__()
+        self.n_params = 3 * n_logistics if n_logistics else out_dims
         self.conv1 = GatedResidualBlock('A', data_channels, hid_dims, 7)
         self.blocks = GatedResidualBlockList(n_blocks, 'B', hid_dims, hid_dims, 3)
         self.conv2 = MaskedConv2d('B', hid_dims, hid_dims, 1)
-        self.conv4 = MaskedConv2d('B', hid_dims, out_dims * data_channels, 1)
+        self.conv4 = MaskedConv2d('B', hid_dims, self.n_params * data_channels, 1)
         self.data_channels = data_channels
         self.out_dims = out_dims
+        self.n_logistics = n_logistics
         self.n_blocks = n_blocks
 
     def forward(self, x):
@@ -452,7 +755,7 @@ class GatedPixelCNN(nn.Module):
         h = self.conv4(F.relu(h))
 
         batch_size, _, height, width = h.size()
-        h = h.view(batch_size, self.out_dims, self.data_channels, 
+        h = h.view(batch_size, self.n_params, self.data_channels, 
                    height, width)
         return h
 
@@ -563,6 +866,159 @@ class CroppedConv2d(nn.Conv2d):
         return x[:, :, :h_crop, :w_crop]
 
 
+class PixelCNNSampler(object):
+    """Draws images from a trained PixelCNN or GatedPixelCNN pixel by pixel,
+    with the same distribution as running the model over the whole image
+    once per pixel and channel, but at a fraction of the cost.
+
+    The output at a pixel only sees the pixels above it and to its left,
+    so while row i is sampled no activation above row i changes. The
+    inputs of every convolution taller than one row are cached as full
+    maps, and each step recomputes only row i of every layer, reading the
+    cached rows its kernel covers (see conv_row). No output sees its own
+    pixel, so all channels of a pixel are drawn from the same step.
+
+    :param model: PixelCNN or GatedPixelCNN
+    :param height: height of the images to sample
+    :param width: width of the images to sample
+    :param use_cuda: whether to use cuda tensors
+    """
+    def __init__(self, model, height, width, use_cuda=False):
+        if not isinstance(model, (PixelCNN, GatedPixelCNN)):
+            raise ValueError('cannot sample incrementally from %s' % type(model).__name__)
+        self.model = model
+        self.height = height
+        self.width = width
+        self.use_cuda = use_cuda
+
+    def sample(self, n_samples, batch_size=64, n_threads=None):
+        """
+        :param n_samples: number of images
+        :param batch_size: number of images sampled together (default: 64)
+        :param n_threads: number of CPU threads for torch while sampling
+                          (default: unchanged)
+        :return: n_samples x data_channels x height x width FloatTensor of
+                 levels scaled to [0, 1] (level / (out_dims - 1))
+        """
+        prev_threads = torch.get_num_threads()
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        try:
+            self.model.eval()
+            samples = []
+            for start in xrange(0, n_samples, batch_size):
+                samples.append(self.sample_batch(min(batch_size, n_samples - start)))
+        finally:
+            # the thread count is process wide; leave training as it was
+            torch.set_num_threads(prev_threads)
+        return torch.cat(samples, 0)
+
+    def sample_batch(self, batch_size):
+        model = self.model
+        n_channels, out_dims, n_params = model.data_channels, model.out_dims, model.n_params
+        x = torch.zeros(batch_size, n_channels, self.height, self.width)
+        if self.use_cuda:
+            x = x.cuda()
+        caches = self.caches(x)
+
+        for i in xrange(self.height):
+            for j in xrange(self.width):
+                params = self.forward_row(x, caches, i)
+                params = params.view(batch_size, n_params, n_channels, self.width)[:, :, :, j]
+                params = params.transpose(1, 2).contiguous().view(-1, n_params)
+                if model.n_logistics:
+                    levels = sample_logistic_mixture(params.data, out_dims)
+                else:
+                    levels = torch.multinomial(F.softmax(params).data, 1)
+                x[:, :, i, j] = levels.float().view(batch_size, n_channels) / (out_dims - 1)
+            # the last pixel of the row is not in the caches yet
+            self.forward_row(x, caches, i)
+        return x
+
+    def caches(self, x):
+        """Zero maps for the inputs of the convolutions that read other rows."""
+        maps = []
+        for n_channels in self.cached_channels():
+            maps.append(x.new(x.size(0), n_channels, x.size(2), x.size(3)).zero_())
+        return maps
+
+    def forward_row(self, x, caches, i):
+        """Row i of the output, batch_size x (n_params * data_channels) x 1
+        x width; writes row i of every cached map."""
+        model = self.model
+        if isinstance(model, PixelCNN):
+            return self.pixelcnn_row(x, caches, i)
+
+        # inputs (vertical, horizontal) of each gated block
+        blocks = [model.conv1] + list(model.blocks.blocks)
+        inputs = [(x, x)] + list(zip(caches[0::2], caches[1::2]))
+        h = None
+        for b, (block, (x_in, h_in)) in enumerate(zip(blocks, inputs)):
+            v = conv_row(block.vertical_conv, x_in, i)
+            to_vertical = block.x_to_h_conv(v)
+            v_t, v_s = torch.split(block.vertical_gate_conv(v), block.out_channels, dim=1)
+            v = F.tanh(v_t) * F.sigmoid(v_s)
+
+            h_ = conv_row(block.horizontal_conv, h_in, i)
+            h_t, h_s = torch.split(block.horizontal_gate_conv(h_ + to_vertical),
+                                   block.out_channels, dim=1)
+            h_ = block.horizontal_output(F.tanh(h_t) * F.sigmoid(h_s))
+            h = h_ if h is None else h + h_
+            if b + 1 < len(blocks):
+                caches[2 * b][:, :, i] = v.data[:, :, 0]
+                caches[2 * b + 1][:, :, i] = h.data[:, :, 0]
+
+        h = model.conv2(F.relu(h))
+        return model.conv4(F.relu(h))
+
+    def pixelcnn_row(self, x, caches, i):
+        model = self.model
+        h = conv_row(model.conv1, x, i)
+        convs = [m for m in model.blocks if isinstance(m, MaskedConv2d)]
+        for conv, cache in zip(convs, caches):
+            cache[:, :, i] = h.data[:, :, 0]
+            h = F.relu(conv_row(conv, cache, i))
+        h = F.relu(model.conv2(h))
+        return model.conv4(h)
+
+    def cached_channels(self):
+        model = self.model
+        if isinstance(model, PixelCNN):
+            # input of each 3 x 3 convolution
+            return [m.in_channels for m in model.blocks if isinstance(m, MaskedConv2d)]
+        channels = []
+        for block in model.blocks.blocks:
+            channels += [block.vertical_conv.in_channels, block.horizontal_conv.in_channels]
+        return channels
+
+
+def conv_row(conv, x, i):
+    """Row i of conv(x) (as cropped by CroppedConv2d), reading only the rows
+    of x the kernel covers, for a stride 1 convolution of a masked, cropped
+    or width preserving kind.
+
+    :param conv: MaskedConv2d, CroppedConv2d or nn.Conv2d
+    :param x: batch_size x in_channels x height x width tensor
+    :param i: row to compute
+    :return: batch_size x out_channels x 1 x width Variable
+    """
+    kh = conv.weight.size(2)
+    pad_h, pad_w = conv.padding
+    height, width = x.size(2), x.size(3)
+    # rows i - pad_h to i - pad_h + kh, zero outside of the image
+    top = i - pad_h
+    rows = x.new(x.size(0), x.size(1), kh, width).zero_()
+    lo, hi = max(top, 0), min(top + kh, height)
+    if hi > lo:
+        rows[:, :, lo - top:hi - top] = x[:, :, lo:hi]
+
+    weight = conv.weight
+    if isinstance(conv, MaskedConv2d):
+        weight = weight * Variable(conv.mask)
+    row = F.conv2d(Variable(rows, volatile=True), weight, conv.bias, padding=(0, pad_w))
+    return row[:, :, :, :width]
+
+
 def log_softmax_by_dim(input, dim=1):
     input_size = input.size()
     trans_input = input.transpose(dim, len(input_size) - 1)
@@ -574,12 +1030,87 @@ def log_softmax_by_dim(input, dim=1):
 
 
 def cross_entropy_by_dim(input, output, dim=1):
-    input_size = input.size()
-    output_size = output.size()
+    """Cross entropy of batch_size x out_dims x data_channels x height x
+    width logits against batch_size x data_channels x height x width
+    levels. Only views are taken to get to the 4-D layout F.cross_entropy
+    handles natively (classes along dim 1), so the logits are not
+    permuted and copied first.
+    """
+    batch_size, n_classes = input.size(0), input.size(1)
+    input_4d = input.view(batch_size, n_classes, input.size(2), -1)
+    output_3d = output.view(batch_size, output.size(1), -1)
+    return F.cross_entropy(input_4d, output_3d)
+
 
-    trans_input = input.permute(0, 2, 3, 4, 1)
-    trans_input_size = trans_input.size()
+def log_sum_exp(x, dim):
+    max_x = torch.max(x, dim, keepdim=True)[0]
+    return max_x.squeeze(dim) + torch.log(torch.sum(torch.exp(x - max_x), dim))
 
-    input_2d = trans_input.contiguous().view(-1, trans_input_size[-1])
-    output_2d = output.contiguous().view(-1)
-    return F.cross_entropy(input_2d, output_2d)
+
+def discretized_logistic_mixture_loss(input, output, levels):
+    """Negative log-likelihood, averaged over subpixels, of levels under a
+    mixture of logistics discretized to `levels` bins over [-1, 1]
+    (Salimans et al., PixelCNN++), one mixture per subpixel.
+
+    :param input: batch_size x (3 * n_logistics) x data_channels x height
+                  x width; mixture logits, means and log scales along dim 1
+    :param output: batch_size x data_channels x height x width levels
+    :param levels: number of levels
+    """
+    n_logistics = input.size(1) // 3
+    logits = input[:, :n_logistics]
+    means = input[:, n_logistics:2 * n_logistics]
+    log_scales = torch.clamp(input[:, 2 * n_logistics:], min=-7.)
+
+    # levels mapped to bin centers in [-1, 1]
+    x = output.unsqueeze(1).float() * (2. / (levels - 1)) - 1.
+    centered = x - means
+    inv_scales = torch.exp(-log_scales)
+    plus_in = inv_scales * (centered + 1. / (levels - 1))
+    min_in = inv_scales * (centered - 1. / (levels - 1))
+    # the first and last bins extend to -inf and +inf
+    log_cdf_plus = plus_in - F.softplus(plus_in)
+    log_one_minus_cdf_min = -F.softplus(min_in)
+    cdf_delta = F.sigmoid(plus_in) - F.sigmoid(min_in)
+    # density at the bin center times the bin width where the difference
+    # of the cdfs underflows
+    mid_in = inv_scales * centered
+    log_pdf_mid = mid_in - log_scales - 2. * F.softplus(mid_in) + np.log(2. / (levels - 1))
+    underflow = (cdf_delta < 1e-5).float()
+    log_delta = (1 - underflow) * torch.log(torch.clamp(cdf_delta, min=1e-12)) + \
+        underflow * log_pdf_mid
+
+    first = (output == 0).unsqueeze(1).float()
+    last = (output == levels - 1).unsqueeze(1).float()
+    log_probs = first * log_cdf_plus + last * log_one_minus_cdf_min + \
+        (1 - first - last) * log_delta
+    log_weights = logits - log_sum_exp(logits, 1).unsqueeze(1)
+    return -torch.mean(log_sum_exp(log_probs + log_weights, 1))
+
+
+def sample_logistic_mixture(input, levels):
+    """Draw levels from discretized logistic mixtures.
+
+    :param input: N x (3 * n_logistics) tensor; mixture logits, means and
+                  log scales of each subpixel
+    :param levels: number of levels
+    :return: N x 1 LongTensor
+    """
+    n_logistics = input.size(1) // 3
+    logits = input[:, :n_logistics]
+    weights = torch.exp(logits - torch.max(logits, 1, keepdim=True)[0])
+    component = torch.multinomial(weights, 1)
+    means = torch.gather(input[:, n_logistics:2 * n_logistics], 1, component)
+    log_scales = torch.clamp(torch.gather(input[:, 2 * n_logistics:], 1, component), min=-7.)
+    u = means.new(means.size()).uniform_(1e-5, 1. - 1e-5)
+    x = means + torch.exp(log_scales) * (torch.log(u) - torch.log(1. - u))
+    # nearest bin center, the end bins taking the tails
+    return torch.clamp(torch.round((x + 1.) * (levels - 1) / 2.), 0, levels - 1).long()
+
+
+def pixelcnn_loss(model, input, output):
+    """Loss of the output of a PixelCNN or GatedPixelCNN for target levels,
+    cross entropy or the logistic mixture NLL depending on its head."""
+    if model.n_logistics:
+        return discretized_logistic_mixture_loss(input, output, model.out_dims)
+    return cross_entropy_by_dim(input, output)
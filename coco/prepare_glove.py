@@ -0,0 +1,47 @@
+"""Extract the GloVe vectors of every word in the COCO captions (plus
+SOS and EOS) into a small store that utils.text_transformer and 
+model.TextDecoder memory-map instead of loading the full 840B table.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+
+from glove import build_store
+from utils import SOS, EOS, GLOVE_PATH, tokenize
+
+
+def caption_words(annotation_path):
+    """Return the set of tokens in a COCO captions annotation file,
+    tokenized the same way as in utils.text_transformer."""
+    with open(annotation_path) as fp:
+        annotations = json.load(fp)['annotations']
+    words = set()
+    for annotation in annotations:
+        words.update(tokenize(annotation['caption']))
+    return words
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annotations', type=str, nargs='+',
+                        default=['./data/coco/annotations/captions_train2014.json',
+                                 './data/coco/annotations/captions_val2014.json'],
+                        help='COCO caption annotation files to take words from')
+    parser.add_argument('--store_path', type=str, default=GLOVE_PATH,
+                        help='where to save the store (default: %s)' % GLOVE_PATH)
+    parser.add_argument('--float16', action='store_true', default=False,
+                        help='if True, store the vectors as float16')
+    args = parser.parse_args()
+
+    words = set()
+    for annotation_path in args.annotations:
+        words.update(caption_words(annotation_path))
+    print('Found %d distinct tokens in the captions.' % len(words))
+
+    n_words = build_store(args.store_path, words, required=[SOS, EOS], 
+                          dtype='float16' if args.float16 else 'float32')
+    print('Saved %d GloVe vectors to %s' % (n_words, args.store_path))
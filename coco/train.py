@@ -11,11 +11,10 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
 from torchvision.utils import save_image
 
 from model import MultimodalVAE
-from utils import text_transformer
+from datasets import CocoCaptionIds, CocoImageLoader
 
 DEFAULT_N_LATENTS = 100
 
@@ -99,33 +98,27 @@ if __name__ == "__main__":
                         help='how many batches to wait before logging training status (default: 10)')
     parser.add_argument('--anneal_kl', action='store_true', default=False, 
                         help='if True, use a fixed interval of doubling the KL term')
+    parser.add_argument('--teacher_forcing', action='store_true', default=False,
+                        help='if True, decode text from the ground truth during training')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
-    transform_train = transforms.Compose([transforms.Scale(32),
-                                          transforms.CenterCrop(32),
-                                          transforms.ToTensor()])
-    transform_test = transforms.Compose([transforms.Scale(32),
-                                         transforms.CenterCrop(32),
-                                         transforms.ToTensor()])
-    # transformer for text.
-    transform_text = text_transformer(deterministic=False)
-
-    # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.CocoCaptions('./data/coco/train2014', 
-                              './data/coco/annotations/captions_train2014.json',
-                              transform=transform_train,
-                              target_transform=transform_text),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.CocoCaptions('./data/coco/val2014', 
-                              './data/coco/annotations/captions_val2014.json',
-                              transform=transform_test,
-                              target_transform=transform_text),
-        batch_size=args.batch_size, shuffle=True)
+    # create loaders for COCO; 32px images are read from the image stores
+    # if datasets.py --images saved them, else decoded in a process pool
+    train_loader = CocoImageLoader(
+        CocoCaptionIds('./data/coco/train2014', 
+                       './data/coco/annotations/captions_train2014.json',
+                       './data/coco/captions_train2014'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_train2014')
+    test_loader = CocoImageLoader(
+        CocoCaptionIds('./data/coco/val2014', 
+                       './data/coco/annotations/captions_val2014.json',
+                       './data/coco/captions_val2014'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_val2014')
 
     # load multimodal VAE
     vae = MultimodalVAE(args.n_latents, use_cuda=args.cuda)
@@ -145,13 +138,15 @@ if __name__ == "__main__":
             if args.cuda:
                 image, text = image.cuda(), text.cuda()
             image, text = Variable(image), Variable(text)
+            text = vae.embed_text(text)
             optimizer.zero_grad()
             
             # for each batch, use 3 types of examples (joint, image-only, and text-only)
             # this way, we can hope to reconstruct both modalities from one
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text, teacher_forcing=args.teacher_forcing)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, kl_lambda=kl_lambda, 
@@ -190,10 +185,12 @@ if __name__ == "__main__":
             if args.cuda:
                 image, text = image.cuda(), text.cuda()
             image, text = Variable(image), Variable(text)
+            text = vae.embed_text(text)
                 
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, kl_lambda=kl_lambda, 
@@ -260,3 +257,7 @@ if __name__ == "__main__":
 
             sample_texts = vae.text_decoder.generate_vector(sample).data
             torch.save(sample_texts, './results/sample_text_vector.pt')
+
+    # stop the image decoding processes
+    train_loader.close()
+    test_loader.close()
@@ -12,10 +12,11 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
+from torchvision import datasets
 from torchvision.utils import save_image
 
 from model import ImageVAE
+from datasets import CocoImageLoader
 from train import loss_function, AverageMeter
 
 
@@ -72,23 +73,16 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/image_only'):
         os.makedirs('./results/image_only')
 
-    transform_train = transforms.Compose([transforms.Scale(32),
-                                          transforms.CenterCrop(32),
-                                          transforms.ToTensor()])
-    transform_test = transforms.Compose([transforms.Scale(32),
-                                         transforms.CenterCrop(32),
-                                         transforms.ToTensor()])
- 
-    train_loader = torch.utils.data.DataLoader(
+    train_loader = CocoImageLoader(
         datasets.CocoCaptions('./data/coco/train2014', 
-                              './data/coco/annotations/captions_train2014.json',
-                              transform=transform_train),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
+                              './data/coco/annotations/captions_train2014.json'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_train2014')
+    test_loader = CocoImageLoader(
         datasets.CocoCaptions('./data/coco/val2014', 
-                              './data/coco/annotations/captions_val2014.json',
-                              transform=transform_test),
-        batch_size=args.batch_size, shuffle=True)
+                              './data/coco/annotations/captions_val2014.json'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_val2014')
 
     vae = ImageVAE(n_latents=args.n_latents)
     if args.cuda:
@@ -168,3 +162,7 @@ if __name__ == "__main__":
         sample = vae.decode(sample).cpu()
         save_image(sample.data.view(64, 3, 32, 32),
                    './results/image_only/sample_image_epoch%d.png' % epoch)
+
+    # stop the image decoding processes
+    train_loader.close()
+    test_loader.close()
@@ -12,11 +12,12 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
+from torchvision import datasets
 from torchvision.utils import save_image
 
 from model import InfoVAE
 from model import compute_mmd
+from datasets import CocoImageLoader
 from train import AverageMeter
 
 
@@ -50,8 +51,9 @@ def loss_function(recon_x, x, z):
                                 torch.ones(batch_size, args.n_latents))
     if z.is_cuda:
         true_samples = true_samples.cuda()
-        true_samples = Variable(true_samples)
-    MMD = compute_mmd(true_samples, z)
+    true_samples = Variable(true_samples)
+    MMD = compute_mmd(true_samples, z, scales=args.kernel_scales,
+                      max_block=args.max_block, n_features=args.n_features)
     return BCE + MMD
 
 
@@ -68,6 +70,13 @@ if __name__ == "__main__":
                         help='learning rate (default: 1e-4)')
     parser.add_argument('--log_interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status (default: 10)')
+    parser.add_argument('--kernel_scales', type=float, nargs='+', default=[1.],
+                        help='bandwidths of the MMD kernel, as multiples of n_latents^2 (default: 1)')
+    parser.add_argument('--max_block', type=int, default=2**22, metavar='N',
+                        help='most MMD kernel entries computed at once (default: 2^22)')
+    parser.add_argument('--n_features', type=int, default=None, metavar='N',
+                        help='if set, approximate the MMD with N random Fourier features '
+                             'per bandwidth (default: exact)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
@@ -85,23 +94,16 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/infovae'):
         os.makedirs('./results/infovae')
 
-    transform_train = transforms.Compose([transforms.Scale(32),
-                                          transforms.CenterCrop(32),
-                                          transforms.ToTensor()])
-    transform_test = transforms.Compose([transforms.Scale(32),
-                                         transforms.CenterCrop(32),
-                                         transforms.ToTensor()])
- 
-    train_loader = torch.utils.data.DataLoader(
+    train_loader = CocoImageLoader(
         datasets.CocoCaptions('./data/coco/train2014', 
-                              './data/coco/annotations/captions_train2014.json',
-                              transform=transform_train),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
+                              './data/coco/annotations/captions_train2014.json'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_train2014')
+    test_loader = CocoImageLoader(
         datasets.CocoCaptions('./data/coco/val2014', 
-                              './data/coco/annotations/captions_val2014.json',
-                              transform=transform_test),
-        batch_size=args.batch_size, shuffle=True)
+                              './data/coco/annotations/captions_val2014.json'),
+        batch_size=args.batch_size, shuffle=True, 
+        store_dir='./data/coco/images32_val2014')
 
     vae = InfoVAE(n_latents=args.n_latents)
     if args.cuda:
@@ -169,3 +171,7 @@ if __name__ == "__main__":
         sample = vae.decode(sample).cpu().data
         save_image(sample.view(64, 3, 32, 32),
                    './results/infovae/sample_epoch%d.png' % epoch)
+
+    # stop the image decoding processes
+    train_loader.close()
+    test_loader.close()
@@ -5,7 +5,6 @@ from __future__ import absolute_import
 import os
 import sys
 import shutil
-import numpy as np
 from PIL import Image
 
 import torch
@@ -17,17 +16,21 @@ from torchvision import datasets, transforms
 from torchvision.utils import save_image
 
 from model import PixelCNN, GatedPixelCNN
-from model import cross_entropy_by_dim, log_softmax_by_dim
+from model import PixelCNNSampler
+from model import pixelcnn_loss
+from datasets import CocoImageLoader
 from train import AverageMeter
 
 
-def quantisize(images, levels):
-    """Convert images to N levels from 0 to N.
+def quantize(images, levels):
+    """Convert images in [0, 1] to levels from 0 to levels - 1, the same
+    bins as np.digitize(images, np.arange(levels) / levels) - 1, for a
+    whole batch at once.
 
-    :param images: numpy array
-    :return: numpy array
+    :param images: FloatTensor
+    :return: LongTensor
     """
-    return (np.digitize(images, np.arange(levels) / levels) - 1).astype('i')
+    return torch.clamp(torch.floor(images * levels), 0, levels - 1).long()
 
 
 def save_checkpoint(state, is_best, folder='./', filename='checkpoint.pth.tar'):
@@ -44,7 +47,8 @@ def load_checkpoint(file_path, use_cuda=False):
         checkpoint = torch.load(file_path,
                                 map_location=lambda storage, location: storage)
     model = GatedPixelCNN(n_groups=checkpoint['n_groups'], data_channels=3, 
-                          hid_dims=checkpoint['hid_dims'], out_dims=checkpoint['out_dims'])
+                          hid_dims=checkpoint['hid_dims'], out_dims=checkpoint['out_dims'],
+                          n_logistics=checkpoint.get('n_logistics'))
     model.load_state_dict(checkpoint['state_dict'])
     if use_cuda:
         model.cuda()
@@ -60,6 +64,9 @@ if __name__ == "__main__":
                         help='number of hidden RNN states (default: 128)')
     parser.add_argument('--out_dims', type=int, default=256, metavar='N',
                         help='2|4|8|16|...|256 (default: 256)')
+    parser.add_argument('--n_logistics', type=int, default=None, metavar='N',
+                        help='if set, model levels with a mixture of N discretized logistics '
+                             'instead of a softmax over out_dims (default: None)')
     parser.add_argument('--image_size', type=int, default=32, metavar='N',
                         help='size to reshape image to and generate (default: 32)')
     parser.add_argument('--batch_size', type=int, default=32, metavar='N',
@@ -72,6 +79,10 @@ if __name__ == "__main__":
                         help='how many batches to wait before logging training status (default: 10)')
     parser.add_argument('--cifar', action='store_true', default=False,
                         help='train on CIFAR if set (default: False)')
+    parser.add_argument('--sample_batch_size', type=int, default=64, metavar='N',
+                        help='images sampled together each epoch (default: 64)')
+    parser.add_argument('--n_threads', type=int, default=None, metavar='N',
+                        help='CPU threads used for sampling (default: torch default)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training (default: False)')
     args = parser.parse_args()
@@ -91,41 +102,42 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/%s' % args.folder_name):
         os.makedirs('./results/%s' % args.folder_name)
 
-    def preprocess(x):
-        transform = transforms.Compose([transforms.Scale(args.image_size),
-                                        transforms.CenterCrop(args.image_size),
-                                        transforms.ToTensor()])
-        x = transform(x)
-        if args.out_dims < 256:
-            x = quantisize(x.numpy(), args.out_dims).astype('f')
-            x = torch.from_numpy(x) / (args.out_dims - 1)
-        return x
+    def preprocess(images):
+        """Quantize a batch of images; returns the model input (levels
+        scaled back to [0, 1]) and the target levels."""
+        levels = quantize(images, args.out_dims)
+        return levels.float() / (args.out_dims - 1), levels
+
+    transform = transforms.Compose([transforms.Scale(args.image_size),
+                                    transforms.CenterCrop(args.image_size),
+                                    transforms.ToTensor()])
 
     if args.cifar:
         train_loader = torch.utils.data.DataLoader(
             datasets.CIFAR10(root='./data/cifar', train=True,
-                             download=True, transform=preprocess),
+                             download=True, transform=transform),
             batch_size=args.batch_size, shuffle=True)
         test_loader = torch.utils.data.DataLoader(
             datasets.CIFAR10(root='./data/cifar', train=False,
-                             download=True, transform=preprocess),
+                             download=True, transform=transform),
             batch_size=args.batch_size, shuffle=True)
     else:
         # create loaders for COCO
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = CocoImageLoader(
             datasets.CocoCaptions('./data/coco/train2014', 
-                                  './data/coco/annotations/captions_train2014.json',
-                                  transform=preprocess),
-            batch_size=args.batch_size, shuffle=True)
-        test_loader = torch.utils.data.DataLoader(
+                                  './data/coco/annotations/captions_train2014.json'),
+            batch_size=args.batch_size, shuffle=True, size=args.image_size,
+            store_dir='./data/coco/images%d_train2014' % args.image_size)
+        test_loader = CocoImageLoader(
             datasets.CocoCaptions('./data/coco/val2014', 
-                                  './data/coco/annotations/captions_val2014.json',
-                                  transform=preprocess),
-            batch_size=args.batch_size, shuffle=True)
+                                  './data/coco/annotations/captions_val2014.json'),
+            batch_size=args.batch_size, shuffle=True, size=args.image_size,
+            store_dir='./data/coco/images%d_val2014' % args.image_size)
 
     # load multimodal VAE
     model = GatedPixelCNN(n_blocks=args.n_blocks, data_channels=3, 
-                          hid_dims=args.hid_dims, out_dims=args.out_dims)
+                          hid_dims=args.hid_dims, out_dims=args.out_dims,
+                          n_logistics=args.n_logistics)
     if args.cuda:
         model.cuda()
 
@@ -137,8 +149,8 @@ if __name__ == "__main__":
         loss_meter = AverageMeter()
 
         for batch_idx, (data, _) in enumerate(train_loader):
-            data = Variable(data)
-            target = Variable((data.data * (args.out_dims - 1)).long())
+            data, target = preprocess(data)
+            data, target = Variable(data), Variable(target)
 
             if args.cuda:
                 data = data.cuda()
@@ -146,7 +158,7 @@ if __name__ == "__main__":
 
             optimizer.zero_grad()
             output = model(data)
-            loss = cross_entropy_by_dim(output, target)
+            loss = pixelcnn_loss(model, output, target)
             loss_meter.update(loss.data[0], len(data))
             
             loss.backward()
@@ -167,15 +179,15 @@ if __name__ == "__main__":
         loss_meter = AverageMeter()
 
         for batch_idx, (data, _) in enumerate(test_loader):
-            data = Variable(data)
-            target = Variable((data.data * (args.out_dims - 1)).long())
+            data, target = preprocess(data)
+            data, target = Variable(data), Variable(target)
             
             if args.cuda:
                 data = data.cuda()
                 target = target.cuda()
 
             output = model(data)
-            loss = cross_entropy_by_dim(output, target)
+            loss = pixelcnn_loss(model, output, target)
             loss_meter.update(loss.data[0], len(data))
         
         print('====> Test Epoch\tLoss: {:.4f}'.format(loss_meter.avg))
@@ -183,20 +195,10 @@ if __name__ == "__main__":
 
 
     def generate(epoch):
-        sample = torch.zeros(64, 3, args.image_size, args.image_size)
-        if args.cuda:
-            sample = sample.cuda()
-        model.eval() 
-
-        for i in xrange(args.image_size):
-            for j in xrange(args.image_size):
-                for k in xrange(3):
-                    output = model(Variable(sample, volatile=True))
-                    output = torch.exp(log_softmax_by_dim(output, dim=1))
-                    probs = output[:, :, k, i, j].data
-                    sample[:, k, i, j] = torch.multinomial(probs, 1).float() / (args.out_dims - 1)
-
-        save_image(sample, './results/{}/sample_{}.png'.format(args.folder_name, epoch)) 
+        sampler = PixelCNNSampler(model, args.image_size, args.image_size, use_cuda=args.cuda)
+        sample = sampler.sample(64, batch_size=args.sample_batch_size,
+                                n_threads=args.n_threads)
+        save_image(sample, './results/{}/sample_{}.png'.format(args.folder_name, epoch))
 
 
     best_loss = sys.maxint
@@ -213,8 +215,14 @@ if __name__ == "__main__":
             'optimizer' : optimizer.state_dict(),
             'hid_dims': args.hid_dims,
             'out_dims': args.out_dims,
+            'n_logistics': args.n_logistics,
             'n_blocks': args.n_blocks,
         }, is_best, folder='./trained_models/%s' % args.folder_name)     
 
         if is_best:
             generate(epoch)
+
+    if not args.cifar:
+        # stop the image decoding processes
+        train_loader.close()
+        test_loader.close()
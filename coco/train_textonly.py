@@ -12,11 +12,11 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms, datasets
+from torchvision import transforms
 
 from model import TextVAE
 from train import loss_function, AverageMeter
-from utils import text_transformer
+from datasets import CocoCaptionIds
 
 
 def save_checkpoint(state, is_best, folder='./', filename='checkpoint.pth.tar'):
@@ -55,6 +55,8 @@ if __name__ == "__main__":
                         help='how many batches to wait before logging training status (default: 10)')
     parser.add_argument('--anneal_kl', action='store_true', default=False, 
                         help='if True, use a fixed interval of doubling the KL term')
+    parser.add_argument('--teacher_forcing', action='store_true', default=False,
+                        help='if True, decode text from the ground truth during training')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
@@ -80,20 +82,18 @@ if __name__ == "__main__":
     transform_test = transforms.Compose([transforms.Scale(256),
                                          transforms.CenterCrop(224),
                                          transforms.ToTensor()])
-    # transformer for text.
-    transform_text = text_transformer(deterministic=False)
 
     train_loader = torch.utils.data.DataLoader(
-        datasets.CocoCaptions('./data/coco/train2014', 
-                              './data/coco/annotations/captions_train2014.json',
-                              transform=transform_train,
-                              target_transform=transform_text),
+        CocoCaptionIds('./data/coco/train2014', 
+                       './data/coco/annotations/captions_train2014.json',
+                       './data/coco/captions_train2014',
+                       transform=transform_train),
         batch_size=args.batch_size, shuffle=True)
     test_loader = torch.utils.data.DataLoader(
-        datasets.CocoCaptions('./data/coco/val2014', 
-                              './data/coco/annotations/captions_val2014.json',
-                              transform=transform_test,
-                              target_transform=transform_text),
+        CocoCaptionIds('./data/coco/val2014', 
+                       './data/coco/annotations/captions_val2014.json',
+                       './data/coco/captions_val2014',
+                       transform=transform_test),
         batch_size=args.batch_size, shuffle=True) 
 
     vae = TextVAE(args.n_latents, use_cuda=args.cuda)
@@ -111,8 +111,9 @@ if __name__ == "__main__":
             data = Variable(data)
             if args.cuda:
                 data = data.cuda()
+            data = vae.embed(data)
             optimizer.zero_grad()
-            recon_batch, mu, logvar = vae(data)
+            recon_batch, mu, logvar = vae(data, teacher_forcing=args.teacher_forcing)
             loss = loss_function(mu, logvar, recon_text=recon_batch, text=data, 
                                  kl_lambda=kl_lambda, lambda_yx=1.)
             loss.backward()
@@ -133,6 +134,7 @@ if __name__ == "__main__":
             if args.cuda:
                 data = data.cuda()
             data = Variable(data, volatile=True)
+            data = vae.embed(data)
             recon_batch, mu, logvar = vae(data)
             test_loss += loss_function(mu, logvar, recon_text=recon_batch, text=data, 
                                        kl_lambda=kl_lambda, lambda_yx=1.).data[0]
@@ -6,26 +6,30 @@ from __future__ import absolute_import
 
 import torch
 import random
-from glove import GloVe
+from glove import load_glove
 from nltk.tokenize import word_tokenize
 
 MAX_WORDS = 100  # max number of words in a sentence
 SOS = '<s>'
 EOS = '</s>'
 MAX_WORDS += 2
+# vocabulary-restricted GloVe store built by prepare_glove.py
+GLOVE_PATH = './data/coco/glove_coco.npy'
 
 
-def text_transformer(deterministic=False):
+def text_transformer(deterministic=False, glove_path=GLOVE_PATH):
     """Returns a function that should be used as a transformer
     in DataLoader for COCO captions.
 
     :param deterministic: COCO has 5 captions for each image.
                           if True, always take the 1st caption.
                           if False, randomly choose a caption.
+    :param glove_path: GloVe store to read embeddings from; falls back
+                       to the full table if missing (default: GLOVE_PATH)
     :return transform_text: function that takes a tuple of five 
                             strings as input
     """
-    glove = GloVe()
+    glove = load_glove(glove_path)
 
     def transform_text(five_sentences):
         if deterministic:
@@ -33,11 +37,7 @@ def text_transformer(deterministic=False):
         else:
             sentence = random.choice(five_sentences)
 
-        words = word_tokenize(sentence)
-        if len(words) > MAX_WORDS:
-            words = words[:MAX_WORDS]
-        words = [SOS] + words + [EOS]
-
+        words = tokenize(sentence)
         embeddings = torch.zeros((MAX_WORDS, 300))
         for i, word in enumerate(words):
             glove_vec = glove.get_word(word)
@@ -47,3 +47,11 @@ def text_transformer(deterministic=False):
         return embeddings
 
     return transform_text
+
+
+def tokenize(sentence):
+    """Split a caption into at most MAX_WORDS words, SOS and EOS included."""
+    words = word_tokenize(sentence)
+    if len(words) > MAX_WORDS - 2:
+        words = words[:MAX_WORDS - 2]
+    return [SOS] + words + [EOS]
@@ -3,6 +3,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import json
 import random
 import numpy as np
 from PIL import Image
@@ -12,6 +13,8 @@ from scipy.misc import imresize
 import torch
 import torchvision.datasets as dset
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
+from torch.utils.data.dataloader import default_collate
 
 VALID_PARTITIONS = {'train': 'im2latex_train.lst', 
                     'val': 'im2latex_validate.lst', 
@@ -26,21 +29,48 @@ CHAR_VOCAB = ['\t', '\n', '\r', ' ', '!', '"', '#', '$', '%', '&', "'", '(', ')'
               '|', '}', '~', '\x7f', '\x95', '\xa0', '\xa1', '\xa2', '\xa4', '\xa5', '\xa7', 
               '\xaa', '\xab', '\xca', '\xe7'] 
 N_CHAR_VOCAB = len(CHAR_VOCAB)
+CHAR_TO_IX = {char: ix for ix, char in enumerate(CHAR_VOCAB)}
 MAX_LENGTH = 1000  # 1000 characters is the most to generate
 SOS = N_CHAR_VOCAB
 FILL = N_CHAR_VOCAB + 1
+FORMULA_PATH = './data/im2latex_formulas.lst'
+# formulas encoded once as character ids, see build_formula_store
+FORMULA_STORE = './data/im2latex_formulas'
+RENDER_DIR = './data/formula_images_processed'
+# renders resized once and packed into one array, see prepare_renders.py
+RENDER_STORE = './data/formula_renders_%d'
+RENDER_SIZE = 64
 
 
 class Image2Latex(Dataset):
-    def __init__(self, partition='train', render_transform=None, formula_transform=None):
+    """Renders of formulas and the formulas as variable length LongTensors
+    of character ids, sliced out of the store built by build_formula_store.
+    Batch them with collate_formulas.
+
+    :param partition: train, val or test
+    :param render_transform: transform for the render
+    :param formula_transform: transform for the formula ids
+    :param store_dir: folder written by build_formula_store
+    :param render_store: packed renders written by prepare_renders.py
+                         --pack; if it exists, renders are read from it
+                         instead of RENDER_DIR
+    """
+    def __init__(self, partition='train', render_transform=None, formula_transform=None,
+                 store_dir=FORMULA_STORE, render_store=RENDER_STORE % RENDER_SIZE):
         self.partition = partition
         self.render_transform = render_transform
         self.formula_transform = formula_transform
 
         assert partition in VALID_PARTITIONS.keys()
         
-        with open('./data/im2latex_formulas.lst') as fp:
-            self.formulas = fp.readlines()
+        store = load_formula_store(store_dir)
+        self.tokens = store['tokens']
+        self.offsets = store['offsets']
+        self.renders = None
+        if render_store is not None and os.path.isfile(os.path.join(render_store, 'meta.json')):
+            store = load_render_store(render_store)
+            self.renders = store['renders']
+            self.render_row = {render_id: i for i, render_id in enumerate(store['render_ids'])}
 
         with open(os.path.join('./data', VALID_PARTITIONS[partition])) as fp:
             data = fp.readlines()
@@ -57,13 +87,18 @@ class Image2Latex(Dataset):
         self.size = len(self.ids)
 
     def __getitem__(self, index):
-        render_path = os.path.join('./data/formula_images_processed/%s.png' % self.render_ids[index])
-        render = Image.open(render_path).convert('L')
+        if self.renders is not None:
+            render = Image.fromarray(np.asarray(self.renders[self.render_row[self.render_ids[index]]]))
+        else:
+            render_path = os.path.join(RENDER_DIR, '%s.png' % self.render_ids[index])
+            render = Image.open(render_path).convert('L')
 
         if self.render_transform is not None:
             render = self.render_transform(render)
 
-        formula = self.formulas[index]
+        # ids are line numbers of the formula file
+        start, end = self.offsets[self.ids[index]], self.offsets[self.ids[index] + 1]
+        formula = torch.from_numpy(self.tokens[start:end].astype(np.int64))
 
         if self.formula_transform is not None:
             formula = self.formula_transform(formula)
@@ -72,6 +107,117 @@ class Image2Latex(Dataset):
     def __len__(self):
         return self.size
 
+    def formula_lengths(self):
+        """Number of characters of each formula, in dataset order."""
+        return np.diff(self.offsets)[self.ids]
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of indices of formulas with similar lengths, to pass as
+    DataLoader(dataset, batch_sampler=..., collate_fn=collate_formulas),
+    so that each batch is padded to little more than its formulas'
+    lengths. When shuffling, the indices are shuffled every epoch, cut
+    into pools of bucket_size batches and sorted by length within each
+    pool, and the resulting batches are shuffled.
+
+    :param lengths: length of each formula (see Image2Latex.formula_lengths)
+    :param batch_size: number of examples per batch
+    :param shuffle: if False, batch the formulas from shortest to longest
+    :param bucket_size: number of batches sorted together (default: 50)
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.bucket_size
+            pools = [order[start:start + pool_size]
+                     for start in xrange(0, len(order), pool_size)]
+            order = np.concatenate([pool[np.argsort(self.lengths[pool], kind='mergesort')]
+                                    for pool in pools])
+        else:
+            order = np.argsort(self.lengths, kind='mergesort')
+        batches = [order[start:start + self.batch_size].tolist()
+                   for start in xrange(0, len(order), self.batch_size)]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def build_formula_store(formula_path=FORMULA_PATH, store_dir=FORMULA_STORE):
+    """Encode every formula (one per line) as ids of CHAR_VOCAB and save
+    them in store_dir:
+
+        tokens.npy: uint8, the formulas one after another
+        offsets.npy: formula i is tokens[offsets[i]:offsets[i + 1]]
+        meta.json: size of the vocabulary used
+
+    :return: number of formulas
+    """
+    with open(formula_path) as fp:
+        formulas = fp.readlines()
+    tokens = np.array([CHAR_TO_IX[char] for formula in formulas for char in formula],
+                      dtype=np.uint8)
+    offsets = np.concatenate(([0], np.cumsum([len(formula) for formula in formulas])))
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, 'tokens.npy'), tokens)
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets.astype(np.int64))
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as fp:
+        json.dump({'vocab_size': N_CHAR_VOCAB}, fp)
+    return len(formulas)
+
+
+def load_formula_store(store_dir=FORMULA_STORE):
+    """Memory-map the arrays written by build_formula_store."""
+    if not os.path.isfile(os.path.join(store_dir, 'meta.json')):
+        raise IOError('Formula store %s not found. Run datasets.py to build it.' % store_dir)
+    with open(os.path.join(store_dir, 'meta.json')) as fp:
+        store = json.load(fp)
+    if store['vocab_size'] != N_CHAR_VOCAB:
+        raise ValueError('%s was built with another vocabulary; rebuild it '
+                         'with datasets.py' % store_dir)
+    for name in ['tokens', 'offsets']:
+        store[name] = np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r')
+    return store
+
+
+def load_render_store(store_dir):
+    """Memory-map the renders packed by prepare_renders.py: renders.npy is
+    N x size x size uint8 and render_ids.npy names the render of each row."""
+    with open(os.path.join(store_dir, 'meta.json')) as fp:
+        store = json.load(fp)
+    store['renders'] = np.load(os.path.join(store_dir, 'renders.npy'), mmap_mode='r')
+    store['render_ids'] = np.load(os.path.join(store_dir, 'render_ids.npy')).tolist()
+    return store
+
+
+def pad_formulas(formulas):
+    """Stack variable length formulas into a batch_size x max_length
+    LongTensor, filling the end of the shorter ones with FILL. max_length
+    is the longest formula of this batch, not MAX_LENGTH.
+    """
+    max_length = max(len(formula) for formula in formulas)
+    batch = torch.LongTensor(len(formulas), max_length).fill_(FILL)
+    for i, formula in enumerate(formulas):
+        if len(formula) > 0:
+            batch[i, :len(formula)] = formula
+    return batch
+
+
+def collate_formulas(batch):
+    """collate_fn of a DataLoader over Image2Latex."""
+    renders, formulas = zip(*batch)
+    return default_collate(renders), pad_formulas(formulas)
+
 
 def gen_vocab():
     with open('./data/im2latex_formulas.lst') as fp:
@@ -98,7 +244,7 @@ def string_to_tensor(string):
     """
     tensor = torch.ones(MAX_LENGTH).long() * FILL
     for ix in xrange(len(string)):
-        tensor[ix] = CHAR_VOCAB.index(string[ix])
+        tensor[ix] = CHAR_TO_IX[string[ix]]
     return tensor
 
 
@@ -123,6 +269,39 @@ def index_to_char(top_i):
         return CHAR_VOCAB[top_i]
 
 
+def composite_to_gray(render, color=255):
+    """Alpha composite an RGBA render over a single gray color and convert
+    it to grayscale, as a uint8 array. Gives the same pixels as
+    alpha_composite_with_color(render, (color,) * 3).convert('L') without
+    making the background image or the intermediate RGBA image.
+
+    :param render: PIL RGBA Image object
+    :param color: gray level of the background (default 255)
+    """
+    render = np.asarray(render)
+    alpha = render[:, :, 3:] / 255.0
+    rgb = (render[:, :, :3] * alpha + color * (1 - alpha)).astype(np.int32)
+    # ITU-R 601-2 luma with PIL's fixed point rounding
+    gray = (rgb[:, :, 0] * 19595 + rgb[:, :, 1] * 38470 + rgb[:, :, 2] * 7471 + 0x8000) >> 16
+    return gray.astype(np.uint8)
+
+
+def load_render(path, size=RENDER_SIZE):
+    """Open a processed render and apply transforms.Scale(size) followed
+    by transforms.CenterCrop(size), as a size x size uint8 array."""
+    render = Image.open(path).convert('L')
+    w, h = render.size
+    if w < h:
+        ow, oh = size, int(size * h / w)
+    else:
+        ow, oh = int(size * w / h), size
+    if (ow, oh) != (w, h):
+        render = render.resize((ow, oh), Image.BILINEAR)
+    x, y = int(round((ow - size) / 2.)), int(round((oh - size) / 2.))
+    render = render.crop((x, y, x + size, y + size))
+    return np.asarray(render, dtype=np.uint8)
+
+
 def alpha_composite(front, back):
     """Alpha composite two RGBA images.
     Source: http://stackoverflow.com/a/9166671/284318
@@ -158,3 +337,8 @@ def alpha_composite_with_color(image, color=(255, 255, 255)):
     """
     back = Image.new('RGBA', size=image.size, color=color + (255,))
     return alpha_composite(image, back)
+
+
+if __name__ == "__main__":
+    n_formulas = build_formula_store()
+    print('Encoded %d formulas into %s.' % (n_formulas, FORMULA_STORE))
@@ -19,7 +19,8 @@ class MultimodalVAE(nn.Module):
         self.render_decoder = RenderDecoder(n_latents)
         self.formula_encoder = FormulaEncoder(n_latents, N_CHAR_VOCAB, 
                                               n_hiddens=n_hiddens, bidirectional=True)
-        self.formula_decoder = FormulaDecoder(n_latents, N_CHAR_VOCAB, 
+        # the decoder also reads SOS and emits FILL to end a formula
+        self.formula_decoder = FormulaDecoder(n_latents, N_CHAR_VOCAB + 2, 
                                               n_hiddens=n_hiddens, use_cuda=use_cuda)
         self.experts = ProductOfExperts()
         self.n_latents = n_latents
@@ -38,7 +39,7 @@ class MultimodalVAE(nn.Module):
         else:  # return mean during inference
             return mu
 
-    def forward(self, render=None, formula=None):
+    def forward(self, render=None, formula=None, teacher_forcing=False):
         # can't just put nothing
         assert render is not None or formula is not None
         # map examples to distributional parameters
@@ -60,7 +61,7 @@ class MultimodalVAE(nn.Module):
         z = self.reparametrize(mu, logvar)
         # reconstruct inputs based on that gaussian
         render_recon = self.render_decoder(z)
-        formula_recon = self.formula_decoder(z)
+        formula_recon = self.formula_decoder(z, formula=formula if teacher_forcing else None)
         return render_recon, formula_recon, mu, logvar
 
 
@@ -93,7 +94,8 @@ class FormulaVAE(nn.Module):
     def __init__(self, n_latents=20, use_cuda=False):
         super(FormulaVAE, self).__init__()
         self.encoder = FormulaEncoder(n_latents, N_CHAR_VOCAB)
-        self.decoder = FormulaDecoder(n_latents, N_CHAR_VOCAB, use_cuda=use_cuda)
+        # the decoder also reads SOS and emits FILL to end a formula
+        self.decoder = FormulaDecoder(n_latents, N_CHAR_VOCAB + 2, use_cuda=use_cuda)
         self.n_latents = n_latents
         self.use_cuda = use_cuda
 
@@ -105,10 +107,10 @@ class FormulaVAE(nn.Module):
         else:  # return mean during inference
             return mu
 
-    def forward(self, x):
+    def forward(self, x, teacher_forcing=False):
         mu, logvar = self.encoder(x)
         z = self.reparametrize(mu, logvar)
-        return self.decoder(z), mu, logvar
+        return self.decoder(z, formula=x if teacher_forcing else None), mu, logvar
 
 
 class RenderEncoder(nn.Module):
@@ -197,15 +199,30 @@ class FormulaEncoder(nn.Module):
         self.n_hiddens = n_hiddens
         self.bidirectional = bidirectional
 
-    def forward(self, x):
-        n_hiddens = self.n_hiddens
+    def forward(self, x, lengths=None):
+        """Encode formulas as packed sequences, so the GRU stops at the end
+        of each formula instead of running over its FILL padding.
+
+        :param x: batch_size x seq_len LongTensor of character ids, padded
+                  at the end with FILL (see datasets.pad_formulas)
+        :param lengths: LongTensor of the number of characters of each
+                        formula (default: the positions before the FILLs)
+        """
         n_latents = self.n_latents
-        x = self.embed(x)
+        if lengths is None:
+            lengths = (x.data != FILL).long().sum(1)
+        # pack_padded_sequence takes the longest formula first
+        lengths, order = torch.sort(lengths.clamp(min=1), 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        x = x.index_select(0, Variable(order))
+        # padding is never read by the GRU; clamp keeps FILL a valid index
+        x = self.embed(x.clamp(max=self.embed.num_embeddings - 1))
         x = x.transpose(0, 1)  # GRU expects (seq_len, batch, ...)
-        x, h = self.gru(x, None)
-        x = x[-1]  # take only the last value
-        if self.bidirectional:
-            x = x[:, :n_hiddens] + x[:, n_hiddens:]  # sum bidirectional outputs
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths.tolist())
+        _, h = self.gru(x, None)
+        # states after the last real character (and, backwards, the first)
+        x = h[0] + h[1] if self.bidirectional else h[0]  # sum bidirectional outputs
+        x = x.index_select(0, Variable(unorder))
         x = self.h2p(x)
         return x[:, :n_latents], x[:, n_latents:]
 
@@ -214,7 +231,8 @@ class FormulaDecoder(nn.Module):
     """GRU for text decoding. 
 
     :param n_latents: size of latent vector
-    :param n_characters: size of characters (10 for MNIST)
+    :param n_characters: size of characters, including SOS and FILL
+                         (N_CHAR_VOCAB + 2)
     :param use_cuda: whether to use cuda tensors
     :param n_hiddens: number of hidden units in GRU
     """
@@ -228,7 +246,13 @@ class FormulaDecoder(nn.Module):
         self.n_latents = n_latents
         self.n_characters = n_characters
 
-    def forward(self, z):
+    def forward(self, z, formula=None):
+        """Free-running decoding where each step is fed the previous 
+        step's most likely character. If formula is given, decode with 
+        teacher forcing instead (see forward_teacher)."""
+        if formula is not None:
+            return self.forward_teacher(z, formula)
+
         n_latents = self.n_latents
         n_characters = self.n_characters
         batch_size = z.size(0)
@@ -250,6 +274,32 @@ class FormulaDecoder(nn.Module):
         # (batch_size, seq_len, ...)
         return words
 
+    def forward_teacher(self, z, formula):
+        """Teacher-forced decoding for training: the ground truth shifted
+        right by one (starting with SOS) is the input at every position,
+        so the whole sequence runs through the GRU in a single call
+        instead of MAX_LENGTH calls to step(). Matches step() applied 
+        position by position to the same inputs.
+
+        :param z: batch_size x n_latents
+        :param formula: batch_size x seq_len LongTensor of ground truth
+        """
+        batch_size, seq_len = formula.size(0), formula.size(1)
+        sos = Variable(formula.data.new(batch_size, 1).fill_(SOS))
+        c_in = torch.cat((sos, formula[:, :-1]), dim=1)
+        c_in = swish(self.embed(c_in))
+        z_seq = z.unsqueeze(1).expand(batch_size, seq_len, z.size(1))
+        c_in = torch.cat((c_in, z_seq), dim=2)
+        c_in = c_in.transpose(0, 1)  # GRU expects (seq_len, batch, ...)
+        # get hiddens from latents
+        h = self.z2h(z).unsqueeze(0).repeat(2, 1, 1)
+        c_out, _ = self.gru(c_in, h)
+        c_out = c_out.transpose(0, 1)
+        c_out = torch.cat((c_out, z_seq), dim=2).contiguous()
+        c_out = self.h2o(c_out.view(batch_size * seq_len, -1))
+        c_out = F.log_softmax(c_out)
+        return c_out.view(batch_size, seq_len, self.n_characters)
+
     def generate(self, z):
         """Like forward(.), but we are not given an input text"""
         words = self.forward(z)
@@ -258,6 +308,63 @@ class FormulaDecoder(nn.Module):
         sample = torch.multinomial(words.view(-1, char_size), 1)
         return sample.view(batch_size, MAX_LENGTH)
 
+    def generate_packed(self, z, max_length=MAX_LENGTH, sample=False):
+        """Generate formulas, ending each one as soon as it emits FILL.
+        Finished formulas are dropped from the active batch so later 
+        steps only run on the unfinished ones, and decoding stops once
+        every formula is done (rather than always running MAX_LENGTH
+        steps over a batch x MAX_LENGTH x n_characters output).
+
+        :param z: batch_size x n_latents
+        :param max_length: most characters to generate (default: MAX_LENGTH)
+        :param sample: if True, sample each character rather than taking 
+                       the most likely one (default: False)
+        :return chars: LongTensor of all generated characters, packed one 
+                       formula after another (the final FILL is dropped)
+        :return lengths: LongTensor of size batch_size with the length of 
+                         each formula in chars
+        """
+        batch_size = z.size(0)
+        # indices (into the batch) of the formulas still being generated
+        active = torch.arange(0, batch_size).long()
+        c_in = Variable(torch.LongTensor([SOS]).repeat(batch_size))
+        if self.use_cuda:
+            active = active.cuda()
+            c_in = c_in.cuda()
+        h = self.z2h(z).unsqueeze(0).repeat(2, 1, 1)
+        lengths = torch.zeros(batch_size).long()
+        steps = []
+
+        for i in xrange(max_length):
+            c_out, h = self.step(i, z, c_in, h)
+            if sample:
+                c_in = torch.multinomial(torch.exp(c_out), 1).view(-1)
+            else:
+                c_in = torch.max(c_out, dim=1)[1].view(-1)
+            chars = c_in.data
+            steps.append((active, chars))
+
+            running = chars.ne(FILL)
+            n_running = running.sum()
+            lengths.index_add_(0, active.cpu(), running.long().cpu())
+            if n_running == 0:
+                break
+            if n_running < active.size(0):
+                # shrink the active batch to the unfinished formulas
+                keep = running.nonzero().view(-1)
+                active = active[keep]
+                z = z.index_select(0, Variable(keep))
+                c_in = c_in.index_select(0, Variable(keep))
+                h = h.index_select(1, Variable(keep))
+
+        # scatter the steps back into one (batch_size, n_steps) buffer
+        buffer = steps[0][1].new(len(steps), batch_size).fill_(FILL)
+        for i, (index, chars) in enumerate(steps):
+            buffer[i].index_copy_(0, index, chars)
+        buffer = buffer.t().contiguous()
+        chars = buffer.masked_select(buffer.ne(FILL))
+        return chars, lengths
+
     def step(self, ix, z, c_in, h):
         c_in = swish(self.embed(c_in))
         c_in = torch.cat((c_in, z), dim=1)
@@ -274,14 +381,45 @@ class ProductOfExperts(nn.Module):
     """Return parameters for product of independent experts.
     See https://arxiv.org/pdf/1410.7827.pdf for equations.
 
-    :param mu: M x D for M experts
-    :param logvar: M x D for M experts
+    The product is precision-weighted and computed in log space, 
+    so a missing expert can be dropped per example via the mask.
+
+    :param mu: M x B x D for M experts
+    :param logvar: M x B x D for M experts
+    :param mask: M x B; 1 if the expert is observed for that example,
+                 0 if it should be left out of the product; an example 
+                 with no observed expert gets the prior p(z) = N(0, I)
+                 (default: None)
+    :param prior_expert: if True, add p(z) = N(0, I) as an extra expert;
+                         regularizes for missing modalities (default: False)
     """
-    def forward(self, mu, logvar, eps=1e-8):
-        var = torch.exp(logvar) + eps
-        pd_mu = torch.sum(mu * var, dim=0) / torch.sum(var, dim=0)
-        pd_var = 1 / torch.sum(1 / var, dim=0)
-        pd_logvar = torch.log(pd_var)
+    def forward(self, mu, logvar, mask=None, prior_expert=False):
+        if prior_expert or mask is not None:
+            prior_size = (1, mu.size(1), mu.size(2))
+            prior_mu = Variable(mu.data.new(*prior_size).zero_())
+            prior_logvar = Variable(logvar.data.new(*prior_size).zero_())
+            mu = torch.cat((mu, prior_mu), dim=0)
+            logvar = torch.cat((logvar, prior_logvar), dim=0)
+            if mask is not None:
+                if prior_expert:
+                    prior_mask = Variable(mask.data.new(1, mask.size(1)).fill_(1))
+                else:
+                    # only examples with no observed expert use the prior
+                    prior_mask = mask.sum(0, keepdim=True).eq(0).float()
+                mask = torch.cat((mask, prior_mask), dim=0)
+
+        # log precision is log(1 / var) = -logvar
+        log_precision = -logvar
+        if mask is not None:
+            mask = mask.unsqueeze(2).expand_as(logvar)
+            # missing experts get a vanishing precision
+            log_precision = log_precision * mask + (mask - 1) * 1e10
+        # logsumexp over experts: sum of precisions is the product precision
+        max_log_precision = torch.max(log_precision, dim=0, keepdim=True)[0]
+        weights = torch.exp(log_precision - max_log_precision)
+        sum_weights = torch.sum(weights, dim=0)
+        pd_mu = torch.sum(mu * weights, dim=0) / sum_weights
+        pd_logvar = -(max_log_precision.squeeze(0) + torch.log(sum_weights))
         return pd_mu, pd_logvar
 
 
@@ -1,28 +1,142 @@
-# loop through each render and convert by applying
-# alpha composite.
+# composite each render over white, convert it to grayscale and save it
+# to ./data/formula_images_processed, in parallel. Renders that are
+# already processed are skipped, so an interrupted run can be restarted.
+# With --pack, the processed renders are also resized and packed into one
+# array (see datasets.load_render_store).
 
 from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import json
 import numpy as np
 from PIL import Image
+from multiprocessing import Pool
 
-from datasets import alpha_composite_with_color
+from datasets import (composite_to_gray, load_render, RENDER_DIR, RENDER_STORE,
+                      RENDER_SIZE)
+
+RAW_RENDER_DIR = './data/formula_images'
+
+
+def process_render(render_file):
+    render_path = os.path.join(RAW_RENDER_DIR, render_file)
+    out_path = os.path.join(RENDER_DIR, render_file)
+    with Image.open(render_path) as render:
+        render = composite_to_gray(render.convert('RGBA'))
+    # written under another name first so a half written file is never
+    # taken for a processed one
+    tmp_path = out_path + '.tmp'
+    Image.fromarray(render, 'L').save(tmp_path, format='PNG')
+    os.rename(tmp_path, out_path)
+
+
+def process_renders(n_workers=None):
+    """Process every raw render that has no processed one yet.
+
+    :return: number of renders processed
+    """
+    if not os.path.isdir(RENDER_DIR):
+        os.makedirs(RENDER_DIR)
+    done = set(os.listdir(RENDER_DIR))
+    render_files = [render_file for render_file in sorted(os.listdir(RAW_RENDER_DIR))
+                    if render_file not in done]
+    pool = Pool(n_workers)
+    try:
+        for ix, _ in enumerate(pool.imap_unordered(process_render, render_files, chunksize=64)):
+            if (ix + 1) % 1000 == 0 or ix + 1 == len(render_files):
+                print('Processed latex renders [{}/{}]'.format(ix + 1, len(render_files)))
+    finally:
+        pool.terminate()
+    return len(render_files)
+
+
+def _load_renders(job):
+    render_files, size = job
+    return np.stack([load_render(os.path.join(RENDER_DIR, render_file), size)
+                     for render_file in render_files])
+
+
+def pack_renders(size=RENDER_SIZE, chunk_size=1000, n_workers=None):
+    """Resize every processed render as the training scripts do and write
+    them into RENDER_STORE % size:
+
+        renders.npy: N x size x size uint8
+        render_ids.npy: render id (file name without .png) of each row
+        meta.json: size of the renders, written once all rows are
+
+    Written chunks of rows are tracked in done.npy, so an interrupted
+    run only packs the missing ones.
+
+    :return: folder of the packed renders
+    """
+    store_dir = RENDER_STORE % size
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    render_files = sorted(render_file for render_file in os.listdir(RENDER_DIR)
+                          if render_file.endswith('.png'))
+    render_ids = np.array([os.path.splitext(render_file)[0] for render_file in render_files])
+    shape = (len(render_files), size, size)
+    n_chunks = (len(render_files) + chunk_size - 1) // chunk_size
+
+    renders_path = os.path.join(store_dir, 'renders.npy')
+    ids_path = os.path.join(store_dir, 'render_ids.npy')
+    done_path = os.path.join(store_dir, 'done.npy')
+    if (os.path.isfile(os.path.join(store_dir, 'meta.json')) and
+            np.array_equal(np.load(ids_path), render_ids)):
+        return store_dir  # already packed
+    resume = (os.path.isfile(done_path) and os.path.isfile(renders_path) and
+              np.array_equal(np.load(ids_path), render_ids))
+    if resume:
+        done = np.load(done_path)
+        renders = np.load(renders_path, mmap_mode='r+')
+        resume = len(done) == n_chunks and renders.shape == shape
+    if not resume:
+        if os.path.isfile(os.path.join(store_dir, 'meta.json')):
+            os.remove(os.path.join(store_dir, 'meta.json'))
+        done = np.zeros(n_chunks, dtype=bool)
+        np.save(done_path, done)
+        np.save(ids_path, render_ids)
+        renders = np.lib.format.open_memmap(renders_path, mode='w+', dtype=np.uint8,
+                                            shape=shape)
+
+    chunks = [chunk for chunk in xrange(n_chunks) if not done[chunk]]
+    jobs = [(render_files[chunk * chunk_size:(chunk + 1) * chunk_size], size)
+            for chunk in chunks]
+    pool = Pool(n_workers)
+    try:
+        for ix, chunk_renders in enumerate(pool.imap(_load_renders, jobs)):
+            start = chunks[ix] * chunk_size
+            renders[start:start + len(chunk_renders)] = chunk_renders
+            renders.flush()
+            done[chunks[ix]] = True
+            np.save(done_path, done)
+            print('Packed latex renders [{}/{}]'.format(
+                min(start + chunk_size, len(render_files)), len(render_files)))
+    finally:
+        pool.terminate()
+
+    del renders
+    with open(os.path.join(store_dir, 'meta.json'), 'w') as fp:
+        json.dump({'size': size}, fp)
+    os.remove(done_path)
+    return store_dir
 
 
 if __name__ == "__main__":
-    if not os.path.isdir('./data/formula_images_processed'):
-        os.mkdir('./data/formula_images_processed')
-
-    render_files = os.listdir('./data/formula_images/')
-    for ix, render_file in enumerate(render_files):
-        print('Saving latex example [{}/{}]'.format(ix + 1, len(render_files)))
-        render_path = os.path.join('./data/formula_images/', render_file)
-
-        with Image.open(render_path) as render:
-            render = render.convert('RGBA')
-            render = alpha_composite_with_color(render)
-            render = render.convert('L')
-            render.save(os.path.join('./data/formula_images_processed/', render_file))
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pack', action='store_true', default=False,
+                        help='also pack resized renders into one array')
+    parser.add_argument('--size', type=int, default=RENDER_SIZE,
+                        help='side of the packed renders (default: %d)' % RENDER_SIZE)
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    n_renders = process_renders(n_workers=args.n_workers)
+    print('Processed %d new renders into %s.' % (n_renders, RENDER_DIR))
+    if args.pack:
+        store_dir = pack_renders(size=args.size, n_workers=args.n_workers)
+        print('Packed renders into %s.' % store_dir)
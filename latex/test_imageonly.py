@@ -31,12 +31,10 @@ if __name__ == "__main__":
     preprocess_render = transforms.Compose([transforms.Scale(64),
                                             transforms.CenterCrop(64),
                                             transforms.ToTensor()])
-    preprocess_formula = datasets.string_to_tensor
     loader = torch.utils.data.DataLoader(
         datasets.Image2Latex(partition='test', 
-                             render_transform=preprocess_render,
-                             formula_transform=preprocess_formula),
-        batch_size=128, shuffle=True)
+                             render_transform=preprocess_render),
+        collate_fn=datasets.collate_formulas, batch_size=128, shuffle=True)
 
     vae = load_checkpoint(args.model_path, use_cuda=args.cuda)
     vae.eval()
@@ -103,17 +103,14 @@ if __name__ == "__main__":
     preprocess_render = transforms.Compose([transforms.Scale(64),
                                             transforms.CenterCrop(64),
                                             transforms.ToTensor()])
-    preprocess_formula = datasets.string_to_tensor
     train_loader = torch.utils.data.DataLoader(
         datasets.Image2Latex(partition='train', 
-                             render_transform=preprocess_render,
-                             formula_transform=preprocess_formula),
-        batch_size=args.batch_size, shuffle=True)
+                             render_transform=preprocess_render),
+        collate_fn=datasets.collate_formulas, batch_size=args.batch_size, shuffle=True)
     test_loader = torch.utils.data.DataLoader(
         datasets.Image2Latex(partition='val',
-                             render_transform=preprocess_render,
-                             formula_transform=preprocess_formula),
-        batch_size=args.batch_size, shuffle=True)
+                             render_transform=preprocess_render),
+        collate_fn=datasets.collate_formulas, batch_size=args.batch_size, shuffle=True)
 
     vae = RenderVAE(n_latents=args.n_latents)
     vae.weight_init(mean=0.0, std=0.02)
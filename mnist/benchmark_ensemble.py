@@ -0,0 +1,134 @@
+"""Time the training steps of a weak supervision sweep: one step of
+every MultimodalVAE in turn (as in train_pipeline) vs. one step of a
+MultimodalVAEEnsemble of all of them (as in train_ensemble_pipeline).
+Random tensors are used so no dataset needs to be on disk.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import numpy as np
+
+import torch
+import torch.optim as optim
+from torch.autograd import Variable
+
+from model import MultimodalVAE, MultimodalVAEEnsemble
+from train import loss_function, mixed_batch_masks
+from train import ensemble_loss_function, ensemble_batch_masks
+
+
+def sequential_step(vaes, optimizers, image, text, weak_percs, draws):
+    for vae, optimizer, weak_perc in zip(vaes, optimizers, weak_percs):
+        paired = draws < weak_perc
+        shown = np.ones(len(draws), dtype=bool)
+        index, expert_masks, target_masks = mixed_batch_masks(paired, shown, shown, paired)
+        if image.is_cuda:
+            index = index.cuda()
+            expert_masks = [mask.cuda() for mask in expert_masks]
+            target_masks = [mask.cuda() for mask in target_masks]
+        image_mask, text_mask = [Variable(mask) for mask in expert_masks]
+        image_target_mask, text_target_mask = [Variable(mask) for mask in target_masks]
+        index = Variable(index)
+        mixed_image, mixed_text = image.index_select(0, index), text.index_select(0, index)
+        optimizer.zero_grad()
+        recon_image, recon_text, mu, logvar = vae.forward_masked(
+            mixed_image, mixed_text, image_mask, text_mask)
+        loss = loss_function(mu, logvar, recon_image=recon_image, image=mixed_image,
+                             recon_text=recon_text, text=mixed_text,
+                             image_mask=image_target_mask, text_mask=text_target_mask,
+                             batch_size=len(draws))
+        loss.backward()
+        optimizer.step()
+
+
+def ensemble_step(ens, optimizer, image, text, weak_percs, draws):
+    paired = draws[np.newaxis] < weak_percs[:, np.newaxis]
+    shown = np.ones(paired.shape, dtype=bool)
+    index, expert_masks, row_weights, target_masks = \
+        ensemble_batch_masks(paired, shown, shown, paired)
+    if image.is_cuda:
+        index, row_weights = index.cuda(), row_weights.cuda()
+        expert_masks = [mask.cuda() for mask in expert_masks]
+        target_masks = [mask.cuda() for mask in target_masks]
+    image_mask, text_mask = [Variable(mask) for mask in expert_masks]
+    image_target_mask, text_target_mask = [Variable(mask) for mask in target_masks]
+    index, row_weights = Variable(index), Variable(row_weights)
+    mixed_image, mixed_text = image.index_select(0, index), text.index_select(0, index)
+    optimizer.zero_grad()
+    recon_image, recon_text, mu, logvar = ens.forward_masked(
+        mixed_image, mixed_text, image_mask, text_mask, row_weights)
+    losses = ensemble_loss_function(mu, logvar, recon_image, mixed_image, recon_text, mixed_text,
+                                    row_weights=row_weights, image_mask=image_target_mask,
+                                    text_mask=text_target_mask, batch_size=len(draws))
+    torch.sum(losses).backward()
+    optimizer.step()
+
+
+def time_steps(step_fn, image, text, n_steps=50, n_warmup=5):
+    """Return the average wall time (in seconds) of step_fn(image, text, draws)."""
+    rs = np.random.RandomState(42)
+    for i in xrange(n_warmup + n_steps):
+        if i == n_warmup:
+            if image.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+        step_fn(image, text, rs.random_sample(image.size(0)))
+    if image.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_steps
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weak_percs', type=float, nargs='+',
+                        default=[0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.],
+                        help='sweep points (default: those of paired_weak.py)')
+    parser.add_argument('--n_latents', type=int, default=20,
+                        help='size of the latent embedding (default: 20)')
+    parser.add_argument('--batch_size', type=int, default=128, metavar='N',
+                        help='input batch size for training (default: 128)')
+    parser.add_argument('--n_steps', type=int, default=50,
+                        help='number of timed training steps (default: 50)')
+    parser.add_argument('--n_threads', type=int, default=None,
+                        help='intra-op threads (default: torch default)')
+    parser.add_argument('--cuda', action='store_true', default=False,
+                        help='enables CUDA training')
+    args = parser.parse_args()
+    args.cuda = args.cuda and torch.cuda.is_available()
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    weak_percs = np.array(args.weak_percs)
+    image = torch.rand(args.batch_size, 784)
+    text = torch.LongTensor(args.batch_size).random_(0, 10)
+    if args.cuda:
+        image, text = image.cuda(), text.cuda()
+    image, text = Variable(image), Variable(text)
+
+    torch.manual_seed(1)
+    vaes = [MultimodalVAE(n_latents=args.n_latents) for _ in weak_percs]
+    ens = MultimodalVAEEnsemble(vaes)
+    if args.cuda:
+        ens.cuda()
+        for vae in vaes:
+            vae.cuda()
+    for vae in vaes:
+        vae.train()
+    ens.train()
+    optimizers = [optim.Adam(vae.parameters(), lr=1e-3) for vae in vaes]
+    ens_optimizer = optim.Adam(ens.parameters(), lr=1e-3)
+
+    sequential_time = time_steps(
+        lambda image, text, draws: sequential_step(vaes, optimizers, image, text, weak_percs, draws),
+        image, text, n_steps=args.n_steps)
+    ensemble_time = time_steps(
+        lambda image, text, draws: ensemble_step(ens, ens_optimizer, image, text, weak_percs, draws),
+        image, text, n_steps=args.n_steps)
+    run_time = sequential_time / len(weak_percs)
+    print('{} sequential runs:\t{:.3f} ms / step'.format(len(weak_percs), sequential_time * 1000.))
+    print('ensemble:\t{:.3f} ms / step ({:.1f} sequential runs)'.format(
+        ensemble_time * 1000., ensemble_time / run_time))
@@ -0,0 +1,91 @@
+"""Time a full training step (forward, backward, optimizer) of the
+MultimodalVAE using the old three-call loop vs. forward_subsets.
+Random tensors are used so no dataset needs to be on disk.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+
+import torch
+import torch.optim as optim
+from torch.autograd import Variable
+
+from model import MultimodalVAE
+from train import loss_function
+
+
+def three_call_step(vae, image, text):
+    recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
+    recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
+    recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+    return [(recon_image_1, recon_text_1, mu_1, logvar_1),
+            (recon_image_2, recon_text_2, mu_2, logvar_2),
+            (recon_image_3, recon_text_3, mu_3, logvar_3)]
+
+
+def subsets_step(vae, image, text):
+    return vae.forward_subsets(image, text)
+
+
+def time_steps(step_fn, vae, optimizer, image, text, n_steps=100, n_warmup=10):
+    """Return the average wall time (in seconds) of a single training step.
+
+    :param step_fn: function returning 3 (recon_image, recon_text, mu, logvar) tuples
+    :param n_steps: number of timed steps
+    :param n_warmup: number of untimed steps run first
+    """
+    vae.train()
+    for i in xrange(n_warmup + n_steps):
+        if i == n_warmup:
+            if image.is_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+        optimizer.zero_grad()
+        loss = 0
+        for recon_image, recon_text, mu, logvar in step_fn(vae, image, text):
+            loss += loss_function(mu, logvar, recon_image=recon_image, image=image,
+                                  recon_text=recon_text, text=text)
+        loss.backward()
+        optimizer.step()
+    if image.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / n_steps
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_latents', type=int, default=20,
+                        help='size of the latent embedding (default: 20)')
+    parser.add_argument('--batch_size', type=int, default=128, metavar='N',
+                        help='input batch size for training (default: 128)')
+    parser.add_argument('--n_steps', type=int, default=100,
+                        help='number of timed training steps (default: 100)')
+    parser.add_argument('--cuda', action='store_true', default=False,
+                        help='enables CUDA training')
+    args = parser.parse_args()
+    args.cuda = args.cuda and torch.cuda.is_available()
+
+    image = torch.rand(args.batch_size, 784)
+    text = torch.LongTensor(args.batch_size).random_(0, 10)
+    if args.cuda:
+        image, text = image.cuda(), text.cuda()
+    image, text = Variable(image), Variable(text)
+
+    timings = []
+    for name, step_fn in [('three calls', three_call_step),
+                          ('forward_subsets', subsets_step)]:
+        torch.manual_seed(1)
+        vae = MultimodalVAE(n_latents=args.n_latents)
+        if args.cuda:
+            vae.cuda()
+        optimizer = optim.Adam(vae.parameters(), lr=1e-3)
+        step_time = time_steps(step_fn, vae, optimizer, image, text,
+                               n_steps=args.n_steps)
+        timings.append(step_time)
+        print('{}:\t{:.3f} ms / step'.format(name, step_time * 1000.))
+
+    print('speedup: {:.2f}x'.format(timings[0] / timings[1]))
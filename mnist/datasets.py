@@ -0,0 +1,56 @@
+"""Batch-level loading of MNIST straight from the stored uint8 tensors,
+without a PIL image and ToTensor() per example."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import torch
+import torchvision.datasets as dset
+
+
+class BatchLoader(object):
+    """Iterates over (image, label) batches like DataLoader(dataset,
+    batch_size, shuffle) with transforms.ToTensor(), but every batch is a
+    single index_select into the whole uint8 image tensor, scaled to
+    [0, 1] in one op, and the same rows of a precomputed label tensor.
+
+    :param images: N x H x W uint8 tensor
+    :param labels: N (x ...) LongTensor
+    :param batch_size: number of examples per batch (default: 1)
+    :param shuffle: if True, reshuffle the examples every epoch
+    :param dataset: object reported as loader.dataset (for len())
+    """
+    def __init__(self, images, labels, batch_size=1, shuffle=False, dataset=None):
+        # shared memory so forked processes can read the same tensors
+        self.images = images.share_memory_()
+        self.labels = labels.share_memory_()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = dataset if dataset is not None else images
+
+    def __iter__(self):
+        n = self.images.size(0)
+        if self.shuffle:
+            order = torch.randperm(n)
+        else:
+            order = torch.arange(0, n).long()
+        for start in xrange(0, n, self.batch_size):
+            index = order[start:start + self.batch_size]
+            image = self.images.index_select(0, index).float().div_(255).unsqueeze(1)
+            yield image, self.labels.index_select(0, index)
+
+    def __len__(self):
+        return (self.images.size(0) + self.batch_size - 1) // self.batch_size
+
+
+def mnist_loader(root, train=True, batch_size=1, shuffle=False):
+    """BatchLoader over torchvision's MNIST; batches are the same as
+    DataLoader(datasets.MNIST(..., transform=transforms.ToTensor()))."""
+    dataset = dset.MNIST(root, train=train, download=True)
+    if train:
+        images, labels = dataset.train_data, dataset.train_labels
+    else:
+        images, labels = dataset.test_data, dataset.test_labels
+    return BatchLoader(images, labels, batch_size=batch_size,
+                       shuffle=shuffle, dataset=dataset)
@@ -5,7 +5,6 @@ from __future__ import absolute_import
 
 import os
 import sys
-import shutil
 import random
 import numpy as np
 
@@ -14,16 +13,18 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
 
 from model import MultimodalVAE
+from datasets import mnist_loader
 from train import AverageMeter
 from train import save_checkpoint, load_checkpoint
-from train import loss_function
+from train import loss_function, mixed_batch_masks
+from sweep import run_sweep, write_summary
 
 
 def train_pipeline(out_dir, weak_perc_m1, weak_perc_m2, n_latents=20, batch_size=128, 
-                   epochs=20, lr=1e-3, log_interval=10, cuda=False):
+                   epochs=20, lr=1e-3, log_interval=10, cuda=False,
+                   train_loader=None, test_loader=None):
     """Pipeline to train and test MultimodalVAE on MNIST dataset. This is 
     identical to the code in train.py.
 
@@ -36,16 +37,16 @@ def train_pipeline(out_dir, weak_perc_m1, weak_perc_m2, n_latents=20, batch_size
     :param lr: learning rate (default: 1e-3)
     :param log_interval: interval of printing (default: 10)
     :param cuda: whether to use cuda or not (default: False)
+    :param train_loader: loader of the training set (default: built here)
+    :param test_loader: loader of the test set (default: built here)
     """
     # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=True, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=False, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=batch_size, shuffle=True)
+    if train_loader is None:
+        train_loader = mnist_loader('./data', train=True, 
+                                    batch_size=batch_size, shuffle=True)
+    if test_loader is None:
+        test_loader = mnist_loader('./data', train=False, 
+                                   batch_size=batch_size, shuffle=True)
 
     # load multimodal VAE
     vae = MultimodalVAE(n_latents=n_latents)
@@ -62,52 +63,50 @@ def train_pipeline(out_dir, weak_perc_m1, weak_perc_m2, n_latents=20, batch_size
                             # otherwise, we end up showing different examples over epochs
         vae.train()
 
-        joint_loss_meter = AverageMeter()
-        image_loss_meter = AverageMeter()
-        text_loss_meter = AverageMeter()
+        loss_meter = AverageMeter()
 
         for batch_idx, (image, text) in enumerate(train_loader):
+            n_examples = len(image)
+            # every example is shown as a joint view; each one is additionally
+            # shown as an image-only / text-only view with prob. weak_perc_m1 / m2
+            shown = np.ones(n_examples, dtype=bool)
+            show_image = np.random.random(n_examples) < weak_perc_m1
+            show_text = np.random.random(n_examples) < weak_perc_m2
+            index, expert_masks, target_masks = mixed_batch_masks(shown, show_image, show_text, shown)
+            image_mask, text_mask = expert_masks
+            image_target_mask, text_target_mask = target_masks
             if cuda:
-                image, text = image.cuda(), text.cuda()
+                image, text, index = image.cuda(), text.cuda(), index.cuda()
+                image_mask, text_mask = image_mask.cuda(), text_mask.cuda()
+                image_target_mask, text_target_mask = image_target_mask.cuda(), text_target_mask.cuda()
+            # lay out all the views as rows of a single batch
+            image, text = image.index_select(0, index), text.index_select(0, index)
             image, text = Variable(image), Variable(text)
+            image_mask, text_mask = Variable(image_mask), Variable(text_mask)
+            image_target_mask = Variable(image_target_mask)
+            text_target_mask = Variable(text_target_mask)
             image = image.view(-1, 784)  # flatten image
             optimizer.zero_grad()
-            
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            loss = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
-                                 recon_text=recon_text_1, text=text, lambda_xy=1., lambda_yx=1.)
-            joint_loss_meter.update(loss.data[0], len(image))
-
-            # depending on this flip, we decide whether or not to show a modality 
-            # versus another one.
-            flip = np.random.random()
-            if flip < weak_perc_m1:
-                recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-                loss_2 = loss_function(mu_2, logvar_2, recon_image=recon_image_2, image=image, 
-                                       recon_text=recon_text_2, text=text, lambda_xy=1., lambda_yx=1.)
-                image_loss_meter.update(loss_2.data[0], len(image))
-                loss += loss_2
-
-            flip = np.random.random()
-            if flip < weak_perc_m2:
-                recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
-                loss_3 = loss_function(mu_3, logvar_3, recon_image=recon_image_3, image=image, 
-                                       recon_text=recon_text_3, text=text, lambda_xy=0., lambda_yx=1.)
-                text_loss_meter.update(loss_3.data[0], len(text))
-                loss += loss_3 
+
+            # one forward pass over the mixed batch; the masked product of 
+            # experts only uses the modalities each row is allowed to see
+            recon_image, recon_text, mu, logvar = vae.forward_masked(image, text, image_mask, text_mask)
+            loss = loss_function(mu, logvar, recon_image=recon_image, image=image, 
+                                 recon_text=recon_text, text=text,
+                                 image_mask=image_target_mask, text_mask=text_target_mask,
+                                 batch_size=n_examples)
+            loss_meter.update(loss.data[0], n_examples)
 
             loss.backward()
             optimizer.step()
 
             if batch_idx % log_interval == 0:
-                print('[Weak (Image) {:.0f}% | Weak (Text) {:.0f}%] Train Epoch: {} [{}/{} ({:.0f}%)]\tJoint Loss: {:.6f}\tImage Loss: {:.6f}\tText Loss: {:.6f}'.format(
-                    100. * weak_perc_m1, 100. * weak_perc_m2, epoch, batch_idx * len(image), 
-                    len(train_loader.dataset), 100. * batch_idx / len(train_loader), 
-                    joint_loss_meter.avg, image_loss_meter.avg, text_loss_meter.avg))
+                print('[Weak (Image) {:.0f}% | Weak (Text) {:.0f}%] Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                    100. * weak_perc_m1, 100. * weak_perc_m2, epoch, batch_idx * n_examples, len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader), loss_meter.avg))
 
-        print('====> [Weak (Image) {:.0f}% | Weak (Text) {:.0f}%] Epoch: {} Joint loss: {:.4f}\tImage loss: {:.4f}\tText loss: {:.4f}'.format(
-            100. * weak_perc_m1, 100. * weak_perc_m2, epoch, joint_loss_meter.avg, 
-            image_loss_meter.avg, text_loss_meter.avg))
+        print('====> [Weak (Image) {:.0f}% | Weak (Text) {:.0f}%] Epoch: {} Loss: {:.4f}'.format(
+            100. * weak_perc_m1, 100. * weak_perc_m2, epoch, loss_meter.avg))
 
 
     def test():
@@ -182,29 +181,31 @@ if __name__ == "__main__":
                         help='learning rate (default: 1e-3)')
     parser.add_argument('--log_interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of configurations trained at once (default: one per cpu)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
     supervision_dir = './trained_models/weak_modal_supervision'
-    if os.path.isdir(supervision_dir):
-        shutil.rmtree(supervision_dir)
-    os.makedirs(supervision_dir)
-    print('Created directory: %s' % supervision_dir)
-
-    for weak_perc_1 in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]:
-        for weak_perc_2 in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]:
-            perc_dir = os.path.join(supervision_dir, 'weak_perc_m1_{}_m2_{}'.format(
-                weak_perc_1, weak_perc_2))
-            
-            if os.path.isdir(perc_dir):
-                shutil.rmtree(perc_dir)
-            os.makedirs(perc_dir)
-            print('Created directory: %s' % perc_dir)
-
-            # train a modal that shows all paired data but a subset of the data for each 
-            # modality. We can then make a heatmap and do analysis.
-            train_pipeline(perc_dir, weak_perc_1, weak_perc_2, n_latents=args.n_latents, 
-                           batch_size=args.batch_size, epochs=args.epochs, lr=args.lr, 
-                           log_interval=args.log_interval, cuda=args.cuda)
+    if not os.path.isdir(supervision_dir):
+        os.makedirs(supervision_dir)
+        print('Created directory: %s' % supervision_dir)
+
+    # the data is loaded once, into shared memory, for every configuration
+    loaders = (mnist_loader('./data', train=True, batch_size=args.batch_size, shuffle=True),
+               mnist_loader('./data', train=False, batch_size=args.batch_size, shuffle=True))
+    # train a modal that shows all paired data but a subset of the data for each 
+    # modality. We can then make a heatmap and do analysis.
+    configs = [('weak_perc_m1_{}_m2_{}'.format(weak_perc_1, weak_perc_2),
+                dict(weak_perc_m1=weak_perc_1, weak_perc_m2=weak_perc_2,
+                     n_latents=args.n_latents, batch_size=args.batch_size,
+                     epochs=args.epochs, lr=args.lr,
+                     log_interval=args.log_interval, cuda=args.cuda))
+               for weak_perc_1 in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]
+               for weak_perc_2 in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]]
+    # cuda runs stay in this process
+    run_sweep(train_pipeline, configs, supervision_dir, loaders,
+              n_workers=1 if args.cuda else args.n_workers)
+    print('Wrote %s.' % write_summary(configs, supervision_dir))
@@ -83,6 +83,64 @@ class MultimodalVAE(nn.Module):
 
         return image_recon, text_recon, mu, logvar
 
+    def forward_subsets(self, image, text):
+        """Equivalent to calling forward with (image, text), (image) and
+        (text) but each encoder runs only once and the latents of all
+        three subsets are decoded together as one concatenated batch.
+
+        :param image: batch of images
+        :param text: batch of texts
+        :return: list of (image_recon, text_recon, mu, logvar) tuples for
+                 the joint, image-only and text-only subsets (in that order)
+        """
+        batch_size = image.size(0)
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        # product of experts for every subset of modalities; shares the
+        # encoder outputs rather than recomputing them per subset
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        joint_mu, joint_logvar = self.experts(mu, logvar)
+        image_mu, image_logvar = self.experts(image_mu.unsqueeze(0),
+                                              image_logvar.unsqueeze(0))
+        text_mu, text_logvar = self.experts(text_mu.unsqueeze(0),
+                                            text_logvar.unsqueeze(0))
+        mu = torch.cat((joint_mu, image_mu, text_mu), dim=0)
+        logvar = torch.cat((joint_logvar, image_logvar, text_logvar), dim=0)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # one decoder call per modality over all subsets at once
+        image_recon = torch.split(self.decode_image(z), batch_size, dim=0)
+        text_recon = torch.split(self.decode_text(z), batch_size, dim=0)
+        mu = torch.split(mu, batch_size, dim=0)
+        logvar = torch.split(logvar, batch_size, dim=0)
+        return list(zip(image_recon, text_recon, mu, logvar))
+
+    def forward_masked(self, image, text, image_mask, text_mask, prior_expert=False):
+        """Like forward but each example chooses which modalities enter the
+        product of experts, so a single batch can mix paired, image-only 
+        and text-only examples in one pass.
+
+        :param image: batch of images; ignored where image_mask is 0
+        :param text: batch of texts; ignored where text_mask is 0
+        :param image_mask: B float tensor; 1 if the image is observed
+        :param text_mask: B float tensor; 1 if the text is observed
+        :param prior_expert: if True, add p(z) as an expert (default: False)
+        """
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        mask = torch.stack((image_mask, text_mask), dim=0)
+        # product of the observed experts only
+        mu, logvar = self.experts(mu, logvar, mask=mask, prior_expert=prior_expert)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # reconstruct inputs based on that gaussian
+        image_recon = self.decode_image(z)
+        text_recon = self.decode_text(z)
+        return image_recon, text_recon, mu, logvar
+
     def gen_latents(self, image, text):
         # compute separate gaussians per modality
         image_mu, image_logvar = self.encode_image(image)
@@ -174,17 +232,311 @@ class ProductOfExperts(nn.Module):
     """Return parameters for product of independent experts.
     See https://arxiv.org/pdf/1410.7827.pdf for equations.
 
-    :param mu: M x D for M experts
-    :param logvar: M x D for M experts
+    The product is precision-weighted and computed in log space, 
+    so a missing expert can be dropped per example via the mask.
+
+    :param mu: M x B x D for M experts
+    :param logvar: M x B x D for M experts
+    :param mask: M x B; 1 if the expert is observed for that example,
+                 0 if it should be left out of the product; an example 
+                 with no observed expert gets the prior p(z) = N(0, I)
+                 (default: None)
+    :param prior_expert: if True, add p(z) = N(0, I) as an extra expert;
+                         regularizes for missing modalities (default: False)
     """
-    def forward(self, mu, logvar, eps=1e-8):
-        var = torch.exp(logvar) + eps
-        pd_mu = torch.sum(mu * var, dim=0) / torch.sum(var, dim=0)
-        pd_var = 1 / torch.sum(1 / var, dim=0)
-        pd_logvar = torch.log(pd_var)
+    def forward(self, mu, logvar, mask=None, prior_expert=False):
+        if prior_expert or mask is not None:
+            prior_size = (1, mu.size(1), mu.size(2))
+            prior_mu = Variable(mu.data.new(*prior_size).zero_())
+            prior_logvar = Variable(logvar.data.new(*prior_size).zero_())
+            mu = torch.cat((mu, prior_mu), dim=0)
+            logvar = torch.cat((logvar, prior_logvar), dim=0)
+            if mask is not None:
+                if prior_expert:
+                    prior_mask = Variable(mask.data.new(1, mask.size(1)).fill_(1))
+                else:
+                    # only examples with no observed expert use the prior
+                    prior_mask = mask.sum(0, keepdim=True).eq(0).float()
+                mask = torch.cat((mask, prior_mask), dim=0)
+
+        # log precision is log(1 / var) = -logvar
+        log_precision = -logvar
+        if mask is not None:
+            mask = mask.unsqueeze(2).expand_as(logvar)
+            # missing experts get a vanishing precision
+            log_precision = log_precision * mask + (mask - 1) * 1e10
+        # logsumexp over experts: sum of precisions is the product precision
+        max_log_precision = torch.max(log_precision, dim=0, keepdim=True)[0]
+        weights = torch.exp(log_precision - max_log_precision)
+        sum_weights = torch.sum(weights, dim=0)
+        pd_mu = torch.sum(mu * weights, dim=0) / sum_weights
+        pd_logvar = -(max_log_precision.squeeze(0) + torch.log(sum_weights))
         return pd_mu, pd_logvar
 
 
+class MultimodalVAEEnsemble(nn.Module):
+    """K independent MultimodalVAEs trained side by side. The parameters
+    of every layer are stacked along a first dimension of size K, so each
+    layer runs all replicas with one batched matrix product instead of K
+    small ones. Every replica sees the same rows of data; row_weights pick
+    which rows make up the batch of each replica (see forward_masked).
+
+    The replicas share no parameters, so gradients of the summed losses
+    are the gradients of each replica alone, and an optimizer with
+    elementwise state (SGD, Adam) over the ensemble keeps separate state
+    per replica.
+
+    :param vaes: K MultimodalVAEs with the same n_latents; the ensemble
+                 starts from copies of their parameters
+    """
+    def __init__(self, vaes):
+        super(MultimodalVAEEnsemble, self).__init__()
+        self.image_encoder = EnsembleSequential([vae.image_encoder.net for vae in vaes])
+        self.image_decoder = EnsembleSequential([vae.image_decoder.net for vae in vaes])
+        self.text_encoder = EnsembleSequential([vae.text_encoder.net for vae in vaes])
+        self.text_decoder = EnsembleSequential([vae.text_decoder.net for vae in vaes])
+        self.experts = ProductOfExperts()
+        self.n_latents = vaes[0].n_latents
+        self.n_models = len(vaes)
+
+    def reparametrize(self, mu, logvar):
+        if self.training:
+            std = logvar.mul(0.5).exp_()
+            eps = Variable(std.data.new(std.size()).normal_())
+            return eps.mul(std).add_(mu)
+        else:  # return mean during inference
+            return mu
+
+    def forward(self, image=None, text=None):
+        """MultimodalVAE.forward for every replica; shapes as in
+        forward_masked."""
+        # can't just put nothing
+        assert image is not None or text is not None
+        experts = []
+        if image is not None:
+            experts.append(self.encode(self.image_encoder(image)))
+        if text is not None:
+            experts.append(self.encode(self.text_encoder(text)))
+        n_models, n_rows, n_latents = experts[0][0].size()
+        mu = torch.stack([mu for mu, _ in experts], dim=0).view(len(experts), -1, n_latents)
+        logvar = torch.stack([logvar for _, logvar in experts], dim=0).view(len(experts), -1, n_latents)
+        # product of experts to combine gaussians
+        mu, logvar = self.experts(mu, logvar)
+        return self.decode(mu.view(n_models, n_rows, n_latents),
+                           logvar.view(n_models, n_rows, n_latents))
+
+    def forward_masked(self, image, text, image_mask, text_mask, row_weights=None):
+        """MultimodalVAE.forward_masked for every replica at once.
+
+        :param image: N x 784 images, shared by all replicas
+        :param text: N labels, shared by all replicas
+        :param image_mask: N float tensor; 1 if the image is an expert
+        :param text_mask: N float tensor; 1 if the text is an expert
+        :param row_weights: K x N float tensor; 1 if the row belongs to the
+                            batch of that replica, 0 if it is only padding
+                            (left out of the batch norm statistics);
+                            default: every row for every replica
+        :return: K x N x 784 image and K x N x 10 text reconstructions,
+                 K x N x n_latents mu and logvar
+        """
+        image_mu, image_logvar = self.encode(self.image_encoder(image, row_weights))
+        text_mu, text_logvar = self.encode(self.text_encoder(text, row_weights))
+        n_models, n_rows, n_latents = image_mu.size()
+        mu = torch.stack((image_mu, text_mu), dim=0).view(2, -1, n_latents)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0).view(2, -1, n_latents)
+        mask = torch.stack((image_mask, text_mask), dim=0).unsqueeze(1)
+        mask = mask.expand(2, n_models, n_rows).contiguous().view(2, -1)
+        # product of the observed experts only
+        mu, logvar = self.experts(mu, logvar, mask=mask)
+        return self.decode(mu.view(n_models, n_rows, n_latents),
+                           logvar.view(n_models, n_rows, n_latents), row_weights)
+
+    def encode(self, x):
+        n_latents = self.n_latents
+        return x[:, :, :n_latents], x[:, :, n_latents:]
+
+    def decode(self, mu, logvar, row_weights=None):
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # reconstruct inputs based on that gaussian
+        image_recon = F.sigmoid(self.image_decoder(z, row_weights))
+        text_recon = self.text_decoder(z, row_weights)
+        text_recon = F.log_softmax(text_recon.view(-1, text_recon.size(2))).view_as(text_recon)
+        return image_recon, text_recon, mu, logvar
+
+    def replica_state_dict(self, k):
+        """state_dict of replica k as a MultimodalVAE."""
+        state = MultimodalVAE(n_latents=self.n_latents).state_dict()
+        for name, net in self.named_children():
+            if isinstance(net, EnsembleSequential):
+                for key, value in net.replica_tensors(k).items():
+                    state['%s.net.%s' % (name, key)] = value.cpu().clone()
+        return state
+
+    def replica(self, k):
+        """Replica k as a MultimodalVAE."""
+        vae = MultimodalVAE(n_latents=self.n_latents)
+        vae.load_state_dict(self.replica_state_dict(k))
+        return vae
+
+    def replica_optimizer_state_dict(self, optimizer, k):
+        """state_dict of an optimizer with elementwise state over this
+        ensemble, restricted to replica k: it loads into the same optimizer
+        over replica(k).parameters()."""
+        # replica parameter name -> per replica view of the optimizer state
+        param_states = {}
+        for name, net in self.named_children():
+            if isinstance(net, EnsembleSequential):
+                for key, state in net.replica_optimizer_states(optimizer, k).items():
+                    param_states['%s.net.%s' % (name, key)] = state
+        names = [name for name, _ in MultimodalVAE(n_latents=self.n_latents).named_parameters()]
+        state = optimizer.state_dict()
+        param_groups = []
+        for group in state['param_groups']:
+            group = dict(group)
+            group['params'] = list(range(len(names)))
+            param_groups.append(group)
+        assert len(param_groups) == 1, 'one param group over the whole ensemble'
+        return {'state': dict((i, param_states[name]) for i, name in enumerate(names)
+                              if name in param_states),
+                'param_groups': param_groups}
+
+
+class EnsembleSequential(nn.Module):
+    """The same nn.Sequential of Linear, BatchNorm1d, Embedding and ReLU
+    layers from K replicas, run for all of them at once.
+
+    :param nets: K nn.Sequential with the same layers
+    """
+    def __init__(self, nets):
+        super(EnsembleSequential, self).__init__()
+        layers = []
+        for modules in zip(*[list(net.children()) for net in nets]):
+            if isinstance(modules[0], nn.Linear):
+                layers.append(EnsembleLinear(modules))
+            elif isinstance(modules[0], nn.BatchNorm1d):
+                layers.append(EnsembleBatchNorm1d(modules))
+            elif isinstance(modules[0], nn.Embedding):
+                layers.append(EnsembleEmbedding(modules))
+            elif isinstance(modules[0], nn.ReLU):
+                layers.append(nn.ReLU())
+            else:
+                raise ValueError('cannot stack %s' % type(modules[0]).__name__)
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, x, row_weights=None):
+        """
+        :param x: K x N x D input, or N x D (N for an embedding) shared by
+                  all replicas
+        :param row_weights: K x N rows of each replica (see
+                            MultimodalVAEEnsemble.forward_masked)
+        :return: K x N x D_out
+        """
+        for layer in self.layers:
+            if isinstance(layer, EnsembleBatchNorm1d):
+                x = layer(x, row_weights)
+            else:
+                x = layer(x)
+        return x
+
+    def replica_tensors(self, k):
+        """Parameters and buffers of replica k, named as in nn.Sequential."""
+        tensors = {}
+        for i, layer in enumerate(self.layers):
+            if hasattr(layer, 'replica_tensors'):
+                for key, value in layer.replica_tensors(k).items():
+                    tensors['%d.%s' % (i, key)] = value
+        return tensors
+
+    def replica_optimizer_states(self, optimizer, k):
+        states = {}
+        for i, layer in enumerate(self.layers):
+            for key, param in layer.named_parameters():
+                if param not in optimizer.state:
+                    continue
+                state = {}
+                for name, value in optimizer.state[param].items():
+                    if torch.is_tensor(value) and value.dim() > 0:
+                        value = layer.replica_tensors(k, {key: value})[key].cpu().clone()
+                    state[name] = value
+                states['%d.%s' % (i, key)] = state
+        return states
+
+
+class EnsembleLinear(nn.Module):
+    """K nn.Linear layers; weight is K x in_features x out_features."""
+    def __init__(self, linears):
+        super(EnsembleLinear, self).__init__()
+        self.weight = Parameter(torch.stack([linear.weight.data.t() for linear in linears]))
+        self.bias = Parameter(torch.stack([linear.bias.data for linear in linears]))
+
+    def forward(self, x):
+        n_models, _, out_features = self.weight.size()
+        if x.dim() == 2:
+            x = x.unsqueeze(0).expand(n_models, x.size(0), x.size(1))
+        bias = self.bias.unsqueeze(1).expand(n_models, x.size(1), out_features)
+        return torch.baddbmm(bias, x, self.weight)
+
+    def replica_tensors(self, k, tensors=None):
+        tensors = tensors or {'weight': self.weight.data, 'bias': self.bias.data}
+        return dict((key, value[k].t() if key == 'weight' else value[k])
+                    for key, value in tensors.items())
+
+
+class EnsembleBatchNorm1d(nn.Module):
+    """K nn.BatchNorm1d layers over K x N x F inputs. In training, the
+    statistics of replica k only cover the rows with row_weights[k] = 1."""
+    def __init__(self, norms):
+        super(EnsembleBatchNorm1d, self).__init__()
+        self.weight = Parameter(torch.stack([norm.weight.data for norm in norms]))
+        self.bias = Parameter(torch.stack([norm.bias.data for norm in norms]))
+        self.register_buffer('running_mean', torch.stack([norm.running_mean for norm in norms]))
+        self.register_buffer('running_var', torch.stack([norm.running_var for norm in norms]))
+        self.momentum = norms[0].momentum
+        self.eps = norms[0].eps
+
+    def forward(self, x, row_weights=None):
+        if self.training:
+            if row_weights is None:
+                row_weights = Variable(x.data.new(x.size(0), x.size(1)).fill_(1))
+            # weighted sums over the rows as K x 1 x N by K x N x F products
+            weights = row_weights.unsqueeze(1)
+            n_rows = torch.sum(weights, 2, keepdim=True)
+            mean = torch.bmm(weights, x) / n_rows
+            x = x - mean
+            var = torch.bmm(weights, x * x) / n_rows
+            # running variance is unbiased, as in nn.BatchNorm1d
+            n_rows = n_rows.data.squeeze(1)
+            self.running_mean.mul_(1 - self.momentum).add_(self.momentum * mean.data.squeeze(1))
+            self.running_var.mul_(1 - self.momentum).add_(
+                self.momentum * var.data.squeeze(1) * n_rows / (n_rows - 1))
+        else:
+            x = x - Variable(self.running_mean.unsqueeze(1))
+            var = Variable(self.running_var.unsqueeze(1))
+        scale = self.weight.unsqueeze(1) / torch.sqrt(var + self.eps)
+        return x * scale + self.bias.unsqueeze(1)
+
+    def replica_tensors(self, k, tensors=None):
+        tensors = tensors or {'weight': self.weight.data, 'bias': self.bias.data,
+                              'running_mean': self.running_mean,
+                              'running_var': self.running_var}
+        return dict((key, value[k]) for key, value in tensors.items())
+
+
+class EnsembleEmbedding(nn.Module):
+    """K nn.Embedding layers; weight is K x num_embeddings x embedding_dim."""
+    def __init__(self, embeddings):
+        super(EnsembleEmbedding, self).__init__()
+        self.weight = Parameter(torch.stack([embedding.weight.data for embedding in embeddings]))
+
+    def forward(self, x):
+        return torch.index_select(self.weight, 1, x)
+
+    def replica_tensors(self, k, tensors=None):
+        tensors = tensors or {'weight': self.weight.data}
+        return dict((key, value[k]) for key, value in tensors.items())
+
+
 class VAE(nn.Module):
     def __init__(self, n_latents=20):
         super(VAE, self).__init__()
@@ -283,15 +635,24 @@ class InfoVAE(nn.Module):
 
 
 class GatedPixelCNN(nn.Module):
-    """Improved PixelCNN with blind spot and gated blocks."""
-    def __init__(self, data_channels=1, out_dims=256):
+    """Improved PixelCNN with blind spot and gated blocks.
+
+    :param data_channels: number of image channels
+    :param out_dims: number of levels of a subpixel
+    :param n_logistics: if set, output the parameters of a mixture of
+                        n_logistics discretized logistics per subpixel
+                        instead of out_dims logits (default: None)
+    """
+    def __init__(self, data_channels=1, out_dims=256, n_logistics=None):
         super(GatedPixelCNN, self).__init__()
+        self.n_params = 3 * n_logistics if n_logistics else out_dims
         self.conv1 = GatedResidualBlock(data_channels, 128, 7, 'A')
         self.blocks = GatedResidualBlockList(5, 128, 128, 3, 'B')
         self.conv2 = MaskedConv2d('B', data_channels, 128, 16, 1)
-        self.conv4 = MaskedConv2d('B', data_channels, 16, out_dims * data_channels, 1)
+        self.conv4 = MaskedConv2d('B', data_channels, 16, self.n_params * data_channels, 1)
         self.data_channels = data_channels
         self.out_dims = out_dims
+        self.n_logistics = n_logistics
 
     def forward(self, x):
         x, h = self.conv1(x, x)
@@ -300,7 +661,7 @@ class GatedPixelCNN(nn.Module):
         h = self.conv4(F.relu(h))
 
         batch_size, _, height, width = h.size()
-        h = h.view(batch_size, self.out_dims, self.data_channels, 
+        h = h.view(batch_size, self.n_params, self.data_channels, 
                    height, width)
         return h
 
@@ -354,14 +715,17 @@ class GatedResidualBlock(nn.Module):
 
 
 class PixelCNN(nn.Module):
-    def __init__(self, data_channels=1, out_dims=256):
+    """PixelCNN with residual blocks; parameters as for GatedPixelCNN."""
+    def __init__(self, data_channels=1, out_dims=256, n_logistics=None):
         super(PixelCNN, self).__init__()
+        self.n_params = 3 * n_logistics if n_logistics else out_dims
         self.conv1 = MaskedConv2d('A', data_channels, data_channels, 128, 7, padding=3)
         self.blocks = ResidualBlockList(15, 128, 128, 3, 'B')
         self.conv2 = MaskedConv2d('B', data_channels, 128, 16, 1)
-        self.conv4 = MaskedConv2d('B', data_channels, 16, out_dims * data_channels, 1)
+        self.conv4 = MaskedConv2d('B', data_channels, 16, self.n_params * data_channels, 1)
         self.data_channels = data_channels
         self.out_dims = out_dims
+        self.n_logistics = n_logistics
 
     def forward(self, x):
         h = self.conv1(x)
@@ -370,7 +734,7 @@ class PixelCNN(nn.Module):
         h = self.conv4(F.relu(h))
 
         batch_size, _, height, width = h.size()
-        h = h.view(batch_size, self.out_dims, self.data_channels, height, width)
+        h = h.view(batch_size, self.n_params, self.data_channels, height, width)
         return h 
 
 
@@ -439,6 +803,160 @@ class CroppedConv2d(nn.Conv2d):
         return x[:, :, :h_crop, :w_crop]
 
 
+class PixelCNNSampler(object):
+    """Draws images from a trained PixelCNN or GatedPixelCNN pixel by pixel,
+    with the same distribution as running the model over the whole image
+    once per pixel and channel, but at a fraction of the cost.
+
+    The output at a pixel only sees the pixels above it and to its left,
+    so while row i is sampled no activation above row i changes. The
+    inputs of every convolution taller than one row are cached as full
+    maps, and each step recomputes only row i of every layer, reading the
+    cached rows its kernel covers (see conv_row). No output sees its own
+    pixel, so all channels of a pixel are drawn from the same step.
+
+    :param model: PixelCNN or GatedPixelCNN
+    :param height: height of the images to sample
+    :param width: width of the images to sample
+    :param use_cuda: whether to use cuda tensors
+    """
+    def __init__(self, model, height, width, use_cuda=False):
+        if not isinstance(model, (PixelCNN, GatedPixelCNN)):
+            raise ValueError('cannot sample incrementally from %s' % type(model).__name__)
+        self.model = model
+        self.height = height
+        self.width = width
+        self.use_cuda = use_cuda
+
+    def sample(self, n_samples, batch_size=64, n_threads=None):
+        """
+        :param n_samples: number of images
+        :param batch_size: number of images sampled together (default: 64)
+        :param n_threads: number of CPU threads for torch while sampling
+                          (default: unchanged)
+        :return: n_samples x data_channels x height x width FloatTensor of
+                 levels scaled to [0, 1] (level / (out_dims - 1))
+        """
+        prev_threads = torch.get_num_threads()
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        try:
+            self.model.eval()
+            samples = []
+            for start in xrange(0, n_samples, batch_size):
+                samples.append(self.sample_batch(min(batch_size, n_samples - start)))
+        finally:
+            # the thread count is process wide; leave training as it was
+            torch.set_num_threads(prev_threads)
+        return torch.cat(samples, 0)
+
+    def sample_batch(self, batch_size):
+        model = self.model
+        n_channels, out_dims, n_params = model.data_channels, model.out_dims, model.n_params
+        x = torch.zeros(batch_size, n_channels, self.height, self.width)
+        if self.use_cuda:
+            x = x.cuda()
+        caches = self.caches(x)
+
+        for i in xrange(self.height):
+            for j in xrange(self.width):
+                params = self.forward_row(x, caches, i)
+                params = params.view(batch_size, n_params, n_channels, self.width)[:, :, :, j]
+                params = params.transpose(1, 2).contiguous().view(-1, n_params)
+                if model.n_logistics:
+                    levels = sample_logistic_mixture(params.data, out_dims)
+                else:
+                    levels = torch.multinomial(F.softmax(params).data, 1)
+                x[:, :, i, j] = levels.float().view(batch_size, n_channels) / (out_dims - 1)
+            # the last pixel of the row is not in the caches yet
+            self.forward_row(x, caches, i)
+        return x
+
+    def caches(self, x):
+        """Zero maps for the inputs of the convolutions that read other rows."""
+        maps = []
+        for n_channels in self.cached_channels():
+            maps.append(x.new(x.size(0), n_channels, x.size(2), x.size(3)).zero_())
+        return maps
+
+    def forward_row(self, x, caches, i):
+        """Row i of the output, batch_size x (n_params * data_channels) x 1
+        x width; writes row i of every cached map."""
+        model = self.model
+        if isinstance(model, PixelCNN):
+            return self.pixelcnn_row(x, caches, i)
+
+        # inputs (vertical, horizontal) of each gated block
+        blocks = [model.conv1] + list(model.blocks.blocks)
+        inputs = [(x, x)] + list(zip(caches[0::2], caches[1::2]))
+        h = None
+        for b, (block, (x_in, h_in)) in enumerate(zip(blocks, inputs)):
+            v = conv_row(block.vertical_conv, x_in, i)
+            to_vertical = block.x_to_h_conv(v)
+            v_t, v_s = torch.split(block.vertical_gate_conv(v), block.out_channels, dim=1)
+            v = F.tanh(v_t) * F.sigmoid(v_s)
+
+            h_ = conv_row(block.horizontal_conv, h_in, i)
+            h_t, h_s = torch.split(block.horizontal_gate_conv(h_ + to_vertical),
+                                   block.out_channels, dim=1)
+            h_ = block.horizontal_output(F.tanh(h_t) * F.sigmoid(h_s))
+            h = h_ if h is None else h + h_
+            if b + 1 < len(blocks):
+                caches[2 * b][:, :, i] = v.data[:, :, 0]
+                caches[2 * b + 1][:, :, i] = h.data[:, :, 0]
+
+        h = model.conv2(F.relu(h))
+        return model.conv4(F.relu(h))
+
+    def pixelcnn_row(self, x, caches, i):
+        model = self.model
+        h = conv_row(model.conv1, x, i)
+        for block, cache in zip(model.blocks.blocks, caches):
+            t = F.relu(block.conv1(F.relu(h)))
+            cache[:, :, i] = t.data[:, :, 0]
+            t = conv_row(block.conv2, cache, i)
+            h = h + block.conv3(F.relu(t))
+        h = model.conv2(F.relu(h))
+        return model.conv4(F.relu(h))
+
+    def cached_channels(self):
+        model = self.model
+        if isinstance(model, PixelCNN):
+            # input of the 3 x 3 convolution of each residual block
+            return [block.conv2.in_channels for block in model.blocks.blocks]
+        channels = []
+        for block in model.blocks.blocks:
+            channels += [block.vertical_conv.in_channels, block.horizontal_conv.in_channels]
+        return channels
+
+
+def conv_row(conv, x, i):
+    """Row i of conv(x) (as cropped by CroppedConv2d), reading only the rows
+    of x the kernel covers, for a stride 1 convolution of a masked, cropped
+    or width preserving kind.
+
+    :param conv: MaskedConv2d, CroppedConv2d or nn.Conv2d
+    :param x: batch_size x in_channels x height x width tensor
+    :param i: row to compute
+    :return: batch_size x out_channels x 1 x width Variable
+    """
+    kh = conv.weight.size(2)
+    pad_h, pad_w = conv.padding
+    height, width = x.size(2), x.size(3)
+    # rows i - pad_h to i - pad_h + kh, zero outside of the image
+    top = i - pad_h
+    rows = x.new(x.size(0), x.size(1), kh, width).zero_()
+    lo, hi = max(top, 0), min(top + kh, height)
+    if hi > lo:
+        rows[:, :, lo - top:hi - top] = x[:, :, lo:hi]
+
+    weight = conv.weight
+    if isinstance(conv, MaskedConv2d):
+        weight = weight * Variable(conv.mask)
+    row = F.conv2d(Variable(rows, volatile=True), weight, conv.bias, padding=(0, pad_w))
+    return row[:, :, :, :width]
+
+
 def log_softmax_by_dim(input, dim=1):
     input_size = input.size()
     trans_input = input.transpose(dim, len(input_size) - 1)
@@ -450,15 +968,90 @@ def log_softmax_by_dim(input, dim=1):
 
 
 def cross_entropy_by_dim(input, output, dim=1):
-    input_size = input.size()
-    output_size = output.size()
+    """Cross entropy of batch_size x out_dims x data_channels x height x
+    width logits against batch_size x data_channels x height x width
+    levels. Only views are taken to get to the 4-D layout F.cross_entropy
+    handles natively (classes along dim 1), so the logits are not
+    permuted and copied first.
+    """
+    batch_size, n_classes = input.size(0), input.size(1)
+    input_4d = input.view(batch_size, n_classes, input.size(2), -1)
+    output_3d = output.view(batch_size, output.size(1), -1)
+    return F.cross_entropy(input_4d, output_3d)
+
 
-    trans_input = input.permute(0, 2, 3, 4, 1)
-    trans_input_size = trans_input.size()
+def log_sum_exp(x, dim):
+    max_x = torch.max(x, dim, keepdim=True)[0]
+    return max_x.squeeze(dim) + torch.log(torch.sum(torch.exp(x - max_x), dim))
 
-    input_2d = trans_input.contiguous().view(-1, trans_input_size[-1])
-    output_2d = output.contiguous().view(-1)
-    return F.cross_entropy(input_2d, output_2d)
+
+def discretized_logistic_mixture_loss(input, output, levels):
+    """Negative log-likelihood, averaged over subpixels, of levels under a
+    mixture of logistics discretized to `levels` bins over [-1, 1]
+    (Salimans et al., PixelCNN++), one mixture per subpixel.
+
+    :param input: batch_size x (3 * n_logistics) x data_channels x height
+                  x width; mixture logits, means and log scales along dim 1
+    :param output: batch_size x data_channels x height x width levels
+    :param levels: number of levels
+    """
+    n_logistics = input.size(1) // 3
+    logits = input[:, :n_logistics]
+    means = input[:, n_logistics:2 * n_logistics]
+    log_scales = torch.clamp(input[:, 2 * n_logistics:], min=-7.)
+
+    # levels mapped to bin centers in [-1, 1]
+    x = output.unsqueeze(1).float() * (2. / (levels - 1)) - 1.
+    centered = x - means
+    inv_scales = torch.exp(-log_scales)
+    plus_in = inv_scales * (centered + 1. / (levels - 1))
+    min_in = inv_scales * (centered - 1. / (levels - 1))
+    # the first and last bins extend to -inf and +inf
+    log_cdf_plus = plus_in - F.softplus(plus_in)
+    log_one_minus_cdf_min = -F.softplus(min_in)
+    cdf_delta = F.sigmoid(plus_in) - F.sigmoid(min_in)
+    # density at the bin center times the bin width where the difference
+    # of the cdfs underflows
+    mid_in = inv_scales * centered
+    log_pdf_mid = mid_in - log_scales - 2. * F.softplus(mid_in) + np.log(2. / (levels - 1))
+    underflow = (cdf_delta < 1e-5).float()
+    log_delta = (1 - underflow) * torch.log(torch.clamp(cdf_delta, min=1e-12)) + \
+        underflow * log_pdf_mid
+
+    first = (output == 0).unsqueeze(1).float()
+    last = (output == levels - 1).unsqueeze(1).float()
+    log_probs = first * log_cdf_plus + last * log_one_minus_cdf_min + \
+        (1 - first - last) * log_delta
+    log_weights = logits - log_sum_exp(logits, 1).unsqueeze(1)
+    return -torch.mean(log_sum_exp(log_probs + log_weights, 1))
+
+
+def sample_logistic_mixture(input, levels):
+    """Draw levels from discretized logistic mixtures.
+
+    :param input: N x (3 * n_logistics) tensor; mixture logits, means and
+                  log scales of each subpixel
+    :param levels: number of levels
+    :return: N x 1 LongTensor
+    """
+    n_logistics = input.size(1) // 3
+    logits = input[:, :n_logistics]
+    weights = torch.exp(logits - torch.max(logits, 1, keepdim=True)[0])
+    component = torch.multinomial(weights, 1)
+    means = torch.gather(input[:, n_logistics:2 * n_logistics], 1, component)
+    log_scales = torch.clamp(torch.gather(input[:, 2 * n_logistics:], 1, component), min=-7.)
+    u = means.new(means.size()).uniform_(1e-5, 1. - 1e-5)
+    x = means + torch.exp(log_scales) * (torch.log(u) - torch.log(1. - u))
+    # nearest bin center, the end bins taking the tails
+    return torch.clamp(torch.round((x + 1.) * (levels - 1) / 2.), 0, levels - 1).long()
+
+
+def pixelcnn_loss(model, input, output):
+    """Loss of the output of a PixelCNN or GatedPixelCNN for target levels,
+    cross entropy or the logistic mixture NLL depending on its head."""
+    if model.n_logistics:
+        return discretized_logistic_mixture_loss(input, output, model.out_dims)
+    return cross_entropy_by_dim(input, output)
 
 
 class PixelCNNv2(nn.Module):
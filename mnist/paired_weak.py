@@ -10,7 +10,6 @@ from __future__ import absolute_import
 
 import os
 import sys
-import shutil
 import random
 import numpy as np
 
@@ -19,16 +18,19 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms, datasets
 
-from model import MultimodalVAE
+from model import MultimodalVAE, MultimodalVAEEnsemble
+from datasets import mnist_loader
 from train import AverageMeter
 from train import save_checkpoint, load_checkpoint
-from train import loss_function
+from train import loss_function, mixed_batch_masks
+from train import ensemble_loss_function, ensemble_batch_masks
+from sweep import run_sweep, write_summary, BEST_CHECKPOINT
 
 
 def train_pipeline(out_dir, weak_perc, n_latents=20, batch_size=128, epochs=20, lr=1e-3, 
-                   log_interval=10, cuda=False):
+                   log_interval=10, cuda=False,
+                   train_loader=None, test_loader=None):
     """Pipeline to train and test MultimodalVAE on MNIST dataset. This is 
     identical to the code in train.py.
 
@@ -40,16 +42,16 @@ def train_pipeline(out_dir, weak_perc, n_latents=20, batch_size=128, epochs=20,
     :param lr: learning rate (default: 1e-3)
     :param log_interval: interval of printing (default: 10)
     :param cuda: whether to use cuda or not (default: False)
+    :param train_loader: loader of the training set (default: built here)
+    :param test_loader: loader of the test set (default: built here)
     """
     # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=True, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=False, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=batch_size, shuffle=True)
+    if train_loader is None:
+        train_loader = mnist_loader('./data', train=True, 
+                                    batch_size=batch_size, shuffle=True)
+    if test_loader is None:
+        test_loader = mnist_loader('./data', train=False, 
+                                   batch_size=batch_size, shuffle=True)
 
     # load multimodal VAE
     vae = MultimodalVAE(n_latents=n_latents)
@@ -66,57 +68,50 @@ def train_pipeline(out_dir, weak_perc, n_latents=20, batch_size=128, epochs=20,
                             # otherwise, we end up showing different examples over epochs
         vae.train()
 
-        joint_loss_meter = AverageMeter()
-        image_loss_meter = AverageMeter()
-        text_loss_meter = AverageMeter()
+        loss_meter = AverageMeter()
 
         for batch_idx, (image, text) in enumerate(train_loader):
+            n_examples = len(image)
+            # every example is shown as an image-only and a text-only view; only
+            # examples whose pairing is shown also get a joint view (and may use
+            # the pairing to reconstruct text from the image-only view)
+            paired = np.random.random(n_examples) < weak_perc
+            shown = np.ones(n_examples, dtype=bool)
+            index, expert_masks, target_masks = mixed_batch_masks(paired, shown, shown, paired)
+            image_mask, text_mask = expert_masks
+            image_target_mask, text_target_mask = target_masks
             if cuda:
-                image, text = image.cuda(), text.cuda()
+                image, text, index = image.cuda(), text.cuda(), index.cuda()
+                image_mask, text_mask = image_mask.cuda(), text_mask.cuda()
+                image_target_mask, text_target_mask = image_target_mask.cuda(), text_target_mask.cuda()
+            # lay out all the views as rows of a single batch
+            image, text = image.index_select(0, index), text.index_select(0, index)
             image, text = Variable(image), Variable(text)
+            image_mask, text_mask = Variable(image_mask), Variable(text_mask)
+            image_target_mask = Variable(image_target_mask)
+            text_target_mask = Variable(text_target_mask)
             image = image.view(-1, 784)  # flatten image
             optimizer.zero_grad()
-            
-            # depending on this flip, we either show it a full paired example or 
-            # we show it single modalities (in which we cannot compute the full loss)
-            flip = np.random.random()
-            if flip < weak_perc:  # here we show a paired example
-                recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-                loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
-                                       recon_text=recon_text_1, text=text, lambda_xy=1., lambda_yx=1.)
-                recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-                loss_2 = loss_function(mu_2, logvar_2, recon_image=recon_image_2, image=image, 
-                                       recon_text=recon_text_2, text=text, lambda_xy=1., lambda_yx=1.)
-                recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
-                loss_3 = loss_function(mu_3, logvar_3, recon_image=recon_image_3, image=image, 
-                                       recon_text=recon_text_3, text=text, lambda_xy=0., lambda_yx=1.)
-
-                loss = loss_1 + loss_2 + loss_3
-                joint_loss_meter.update(loss_1.data[0], len(image))
-            
-            else:  # here we show individual modalities
-                recon_image_2, _, mu_2, logvar_2 = vae(image=image)
-                loss_2 = loss_function(mu_2, logvar_2, recon_image=recon_image_2, image=image, 
-                                       lambda_xy=1., lambda_yx=0.)
-                _, recon_text_3, mu_3, logvar_3 = vae(text=text)
-                loss_3 = loss_function(mu_3, logvar_3, recon_text=recon_text_3, text=text, 
-                                       lambda_yx=1., lambda_yx=0.)
-                loss = loss_2 + loss_3
-
-            image_loss_meter.update(loss_2.data[0], len(image))
-            text_loss_meter.update(loss_3.data[0], len(text))
+
+            # one forward pass over the mixed batch; the masked product of 
+            # experts only uses the modalities each row is allowed to see
+            recon_image, recon_text, mu, logvar = vae.forward_masked(image, text, image_mask, text_mask)
+            loss = loss_function(mu, logvar, recon_image=recon_image, image=image, 
+                                 recon_text=recon_text, text=text,
+                                 image_mask=image_target_mask, text_mask=text_target_mask,
+                                 batch_size=n_examples)
+            loss_meter.update(loss.data[0], n_examples)
 
             loss.backward()
             optimizer.step()
 
             if batch_idx % log_interval == 0:
-                print('[Weak {:.0f}%] Train Epoch: {} [{}/{} ({:.0f}%)]\tJoint Loss: {:.6f}\tImage Loss: {:.6f}\tText Loss: {:.6f}'.format(
-                    100. * weak_perc, epoch, batch_idx * len(image), len(train_loader.dataset),
-                    100. * batch_idx / len(train_loader), joint_loss_meter.avg,
-                    image_loss_meter.avg, text_loss_meter.avg))
+                print('[Weak {:.0f}%] Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
+                    100. * weak_perc, epoch, batch_idx * n_examples, len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader), loss_meter.avg))
 
-        print('====> [Weak {:.0f}%] Epoch: {} Joint loss: {:.4f}\tImage loss: {:.4f}\tText loss: {:.4f}'.format(
-            100. * weak_perc, epoch, joint_loss_meter.avg, image_loss_meter.avg, text_loss_meter.avg))
+        print('====> [Weak {:.0f}%] Epoch: {} Loss: {:.4f}'.format(
+            100. * weak_perc, epoch, loss_meter.avg))
 
 
     def test():
@@ -178,6 +173,150 @@ def train_pipeline(out_dir, weak_perc, n_latents=20, batch_size=128, epochs=20,
         }, is_best, folder=out_dir)     
 
 
+def train_ensemble_pipeline(out_dirs, weak_percs, n_latents=20, batch_size=128, epochs=20, 
+                            lr=1e-3, log_interval=10, cuda=False,
+                            train_loader=None, test_loader=None):
+    """train_pipeline for several values of weak_perc at once: the K models
+    are trained as one MultimodalVAEEnsemble, over the same batches, and
+    each is checkpointed into its own folder as a plain MultimodalVAE.
+
+    Every batch holds the image-only and text-only views of all its 
+    examples, and the joint views of those that some model is shown the
+    pairing of; a model leaves the joint rows it is not shown out of its
+    loss and batch norm statistics, so each one makes the same choices 
+    and takes the same steps as it would in train_pipeline.
+
+    :param out_dirs: K directories to store trained models
+    :param weak_percs: K percents of time to show a relation pair
+    (other parameters as in train_pipeline)
+    """
+    if train_loader is None:
+        train_loader = mnist_loader('./data', train=True, 
+                                    batch_size=batch_size, shuffle=True)
+    if test_loader is None:
+        test_loader = mnist_loader('./data', train=False, 
+                                   batch_size=batch_size, shuffle=True)
+
+    weak_percs = np.asarray(weak_percs)
+    n_models = len(weak_percs)
+    ens = MultimodalVAEEnsemble([MultimodalVAE(n_latents=n_latents) for _ in xrange(n_models)])
+    if cuda:
+        ens.cuda()
+
+    # Adam keeps elementwise state, so every model has its own
+    optimizer = optim.Adam(ens.parameters(), lr=lr)
+    names = ', '.join('{:.0f}%'.format(100. * weak_perc) for weak_perc in weak_percs)
+
+
+    def train(epoch):
+        random.seed(42)
+        np.random.seed(42)  # same choices as train_pipeline
+        ens.train()
+
+        loss_meter = AverageMeter()
+
+        for batch_idx, (image, text) in enumerate(train_loader):
+            n_examples = len(image)
+            # one draw per example for all models, as in train_pipeline
+            paired = np.random.random(n_examples)[np.newaxis] < weak_percs[:, np.newaxis]
+            shown = np.ones((n_models, n_examples), dtype=bool)
+            index, expert_masks, row_weights, target_masks = \
+                ensemble_batch_masks(paired, shown, shown, paired)
+            image_mask, text_mask = expert_masks
+            image_target_mask, text_target_mask = target_masks
+            if cuda:
+                image, text, index = image.cuda(), text.cuda(), index.cuda()
+                image_mask, text_mask, row_weights = image_mask.cuda(), text_mask.cuda(), row_weights.cuda()
+                image_target_mask, text_target_mask = image_target_mask.cuda(), text_target_mask.cuda()
+            image, text = image.index_select(0, index), text.index_select(0, index)
+            image, text = Variable(image), Variable(text)
+            image_mask, text_mask = Variable(image_mask), Variable(text_mask)
+            row_weights = Variable(row_weights)
+            image_target_mask = Variable(image_target_mask)
+            text_target_mask = Variable(text_target_mask)
+            image = image.view(-1, 784)  # flatten image
+            optimizer.zero_grad()
+
+            recon_image, recon_text, mu, logvar = ens.forward_masked(
+                image, text, image_mask, text_mask, row_weights)
+            losses = ensemble_loss_function(mu, logvar, recon_image, image, recon_text, text,
+                                            row_weights=row_weights, image_mask=image_target_mask,
+                                            text_mask=text_target_mask, batch_size=n_examples)
+            loss_meter.update(losses.data.cpu().numpy(), n_examples)
+
+            # the models share nothing, so the sum gives each its own gradients
+            torch.sum(losses).backward()
+            optimizer.step()
+
+            if batch_idx % log_interval == 0:
+                print('[Weak {}] Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {}'.format(
+                    names, epoch, batch_idx * n_examples, len(train_loader.dataset),
+                    100. * batch_idx / len(train_loader),
+                    ' '.join('{:.6f}'.format(loss) for loss in loss_meter.avg)))
+
+        print('====> [Weak {}] Epoch: {} Loss: {}'.format(
+            names, epoch, ' '.join('{:.4f}'.format(loss) for loss in loss_meter.avg)))
+
+
+    def test():
+        ens.eval()
+        test_joint_loss = 0
+        test_image_loss = 0
+        test_text_loss = 0
+
+        for batch_idx, (image, text) in enumerate(test_loader):
+            if cuda:
+                image, text = image.cuda(), text.cuda()
+            image, text = Variable(image, volatile=True), Variable(text, volatile=True)
+            image = image.view(-1, 784)  # flatten image
+
+            recon_image_1, recon_text_1, mu_1, logvar_1 = ens(image, text)
+            recon_image_2, recon_text_2, mu_2, logvar_2 = ens(image=image)
+            recon_image_3, recon_text_3, mu_3, logvar_3 = ens(text=text)
+
+            loss_1 = ensemble_loss_function(mu_1, logvar_1, recon_image_1, image, 
+                                            recon_text_1, text, lambda_xy=1., lambda_yx=1.)
+            loss_2 = ensemble_loss_function(mu_2, logvar_2, recon_image_2, image, 
+                                            recon_text_2, text, lambda_xy=1., lambda_yx=1.)
+            loss_3 = ensemble_loss_function(mu_3, logvar_3, recon_image_3, image, 
+                                            recon_text_3, text, lambda_xy=0., lambda_yx=1.)
+
+            test_joint_loss += loss_1.data.cpu().numpy()
+            test_image_loss += loss_2.data.cpu().numpy()
+            test_text_loss += loss_3.data.cpu().numpy()
+
+        test_loss = test_joint_loss + test_image_loss + test_text_loss
+        test_joint_loss /= len(test_loader)
+        test_image_loss /= len(test_loader)
+        test_text_loss /= len(test_loader)
+        test_loss /= len(test_loader)
+
+        for k, weak_perc in enumerate(weak_percs):
+            print('====> [Weak {:.0f}%] Test joint loss: {:.4f}\timage loss: {:.4f}\ttext loss:{:.4f}'.format(
+                100. * weak_perc, test_joint_loss[k], test_image_loss[k], test_text_loss[k]))
+
+        return test_loss, (test_joint_loss, test_image_loss, test_text_loss)
+
+
+    best_losses = [sys.maxint] * n_models
+    for epoch in range(1, epochs + 1):
+        train(epoch)
+        loss, (joint_loss, image_loss, text_loss) = test()
+
+        for k, out_dir in enumerate(out_dirs):
+            is_best = loss[k] < best_losses[k]
+            best_losses[k] = min(loss[k], best_losses[k])
+
+            save_checkpoint({
+                'state_dict': ens.replica_state_dict(k),
+                'best_loss': best_losses[k],
+                'joint_loss': joint_loss[k],
+                'image_loss': image_loss[k],
+                'text_loss': text_loss[k],
+                'optimizer' : ens.replica_optimizer_state_dict(optimizer, k),
+            }, is_best, folder=out_dir)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -191,25 +330,42 @@ if __name__ == "__main__":
                         help='learning rate (default: 1e-3)')
     parser.add_argument('--log_interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of configurations trained at once (default: one per cpu)')
+    parser.add_argument('--ensemble', action='store_true', default=False,
+                        help='train all configurations as one batched ensemble')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
     supervision_dir = './trained_models/weak_paired_supervision'
-    if os.path.isdir(supervision_dir):
-        shutil.rmtree(supervision_dir)
-    os.makedirs(supervision_dir)
-    print('Created directory: %s' % supervision_dir)
-
-    for weak_perc in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]:
-        perc_dir = os.path.join(supervision_dir, 'weak_perc_{}'.format(weak_perc))
-        if os.path.isdir(perc_dir):
-            shutil.rmtree(perc_dir)
-        os.makedirs(perc_dir)
-        print('Created directory: %s' % perc_dir)
-        
-        train_pipeline(perc_dir, weak_perc, n_latents=args.n_latents, 
-                       batch_size=args.batch_size, epochs=args.epochs, lr=args.lr, 
-                       log_interval=args.log_interval, cuda=args.cuda)
-    
+    if not os.path.isdir(supervision_dir):
+        os.makedirs(supervision_dir)
+        print('Created directory: %s' % supervision_dir)
+
+    # the data is loaded once, into shared memory, for every configuration
+    loaders = (mnist_loader('./data', train=True, batch_size=args.batch_size, shuffle=True),
+               mnist_loader('./data', train=False, batch_size=args.batch_size, shuffle=True))
+    configs = [('weak_perc_{}'.format(weak_perc),
+                dict(weak_perc=weak_perc, n_latents=args.n_latents,
+                     batch_size=args.batch_size, epochs=args.epochs, lr=args.lr,
+                     log_interval=args.log_interval, cuda=args.cuda))
+               for weak_perc in [0, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 1.]]
+    if args.ensemble:
+        todo = [(name, kwargs) for name, kwargs in configs
+                if not os.path.isfile(os.path.join(supervision_dir, name, BEST_CHECKPOINT))]
+        out_dirs = [os.path.join(supervision_dir, name) for name, _ in todo]
+        for out_dir in out_dirs:
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+        if todo:
+            train_ensemble_pipeline(out_dirs, [kwargs['weak_perc'] for _, kwargs in todo],
+                                    n_latents=args.n_latents, batch_size=args.batch_size,
+                                    epochs=args.epochs, lr=args.lr, log_interval=args.log_interval,
+                                    cuda=args.cuda, train_loader=loaders[0], test_loader=loaders[1])
+    else:
+        # cuda runs stay in this process
+        run_sweep(train_pipeline, configs, supervision_dir, loaders,
+                  n_workers=1 if args.cuda else args.n_workers)
+    print('Wrote %s.' % write_summary(configs, supervision_dir))
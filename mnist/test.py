@@ -12,6 +12,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torchvision import datasets, transforms
 
+from model import MultimodalVAEEnsemble
 from train import load_checkpoint
 
 
@@ -36,6 +37,37 @@ def test_mnist(model, loader, use_cuda=False, verbose=True):
     return correct / float(len(loader.dataset))
 
 
+def test_mnist_checkpoint(path, loader, use_cuda=False):
+    """test_mnist of the model saved at path."""
+    vae = load_checkpoint(path, use_cuda=use_cuda)
+    return test_mnist(vae, loader, use_cuda=use_cuda, verbose=False)
+
+
+def test_mnist_ensemble(models, loader, use_cuda=False):
+    """test_mnist for several MultimodalVAEs (with the same n_latents) at
+    once: they are run as one MultimodalVAEEnsemble, so every batch is 
+    read once for all of them.
+
+    :return: list of accuracies, one per model
+    """
+    ens = MultimodalVAEEnsemble(models)
+    if use_cuda:
+        ens.cuda()
+    ens.eval()
+    correct = 0
+    for image, text in loader:
+        if use_cuda:
+            image, text = image.cuda(), text.cuda()
+        image = Variable(image, volatile=True)
+        image = image.view(-1, 784)
+
+        _, recon_text, _, _ = ens(image=image)
+        pred = recon_text.data.max(2)[1]
+        correct += pred.eq(text.view(1, -1).expand_as(pred)).long().sum(1).cpu()
+
+    return [n_correct / float(len(loader.dataset)) for n_correct in correct.tolist()]
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
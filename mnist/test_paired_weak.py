@@ -2,19 +2,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from functools import partial
 import numpy as np
 
 import torch
-from torchvision import datasets, transforms
 
-from test import test_mnist
+from datasets import mnist_loader
+from test import test_mnist_checkpoint, test_mnist_ensemble
 from train import load_checkpoint
+from sweep import evaluate_checkpoints, trained_configs, BEST_CHECKPOINT, METRICS_CACHE
 
 
 if __name__ == "__main__":
     import os
     import argparse
-    from glob import glob
 
     import matplotlib
     matplotlib.use('Agg')
@@ -22,26 +23,37 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('models_dir', type=str, help='path to output directory of weak.py')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of checkpoints evaluated at once (default: one per cpu)')
+    parser.add_argument('--ensemble', action='store_true', default=False,
+                        help='evaluate all checkpoints as one batched ensemble')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
-    x, y = [], []
-
-    for dir_path in glob(os.path.join(args.models_dir, '*')):
-        weak_perc = float(os.path.basename(dir_path).split('_')[-1])
-        loader = torch.utils.data.DataLoader(
-            datasets.MNIST('./data', train=False, download=True,
-                           transform=transforms.ToTensor()),
-            batch_size=128, shuffle=True)
-        vae = load_checkpoint(os.path.join(dir_path, 'model_best.pth.tar'), use_cuda=args.cuda)
-        vae.eval()
-        weak_acc = test_mnist(vae, loader, use_cuda=args.cuda, verbose=False)
+    # the test set is loaded once for every checkpoint
+    loader = mnist_loader('./data', train=False, batch_size=128)
+    names = trained_configs(args.models_dir)
+    paths = [os.path.join(args.models_dir, name, BEST_CHECKPOINT) for name in names]
+    eval_fn = partial(test_mnist_checkpoint, use_cuda=args.cuda)
+    batch_fn = None
+    if args.ensemble:
+        batch_fn = lambda paths, loader: test_mnist_ensemble(
+            [load_checkpoint(path, use_cuda=args.cuda) for path in paths], loader, 
+            use_cuda=args.cuda)
+    # cuda runs stay in this process
+    accuracies = evaluate_checkpoints(eval_fn, paths, loader, 
+                                      cache_path=os.path.join(args.models_dir, METRICS_CACHE),
+                                      cache_key='test_mnist', batch_fn=batch_fn,
+                                      n_workers=1 if args.cuda else args.n_workers)
 
+    x, y = [], []
+    for name, weak_acc in zip(names, accuracies):
+        weak_perc = float(name.split('_')[-1])
         x.append(weak_perc)
         y.append(weak_acc)
-        print('Got accuracies for %s.' % dir_path)
+        print('Got accuracies for %s.' % name)
 
     x, y = np.array(x), np.array(y)
     ix = np.argsort(x)
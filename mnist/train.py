@@ -5,15 +5,16 @@ from __future__ import absolute_import
 import os
 import sys
 import shutil
+import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
 
 from model import MultimodalVAE
+from datasets import mnist_loader
 
 
 class AverageMeter(object):
@@ -62,15 +63,34 @@ def load_checkpoint(file_path, use_cuda=False):
 
 
 def loss_function(mu, logvar, recon_image=None, image=None, recon_text=None, text=None,
-                  lambda_xy=1., lambda_yx=1.):
+                  lambda_xy=1., lambda_yx=1., image_mask=None, text_mask=None, 
+                  batch_size=None):
+    """If image_mask/text_mask (float tensors over the rows) are given, the 
+    reconstruction term of a modality only covers the rows with a 1.
+
+    For a mixed batch (see mixed_batch_masks), batch_size is the number of
+    examples it was built from: every term is summed over the rows and 
+    divided by it, so each view counts as if it were its own batch of 
+    batch_size examples, as in separate calls (default: number of rows).
+    """
     image_BCE, text_BCE = 0, 0
-    batch_size = mu.size(0)
+    batch_size = batch_size or mu.size(0)
 
     if recon_image is not None and image is not None:
-        image_BCE = lambda_xy * F.binary_cross_entropy(recon_image, image.view(-1, 784))
+        if image_mask is None:
+            image_BCE = lambda_xy * F.binary_cross_entropy(recon_image, image.view(-1, 784))
+        else:
+            image = image.view(-1, 784)
+            image_BCE = -(image * torch.log(recon_image + 1e-8) + 
+                          (1 - image) * torch.log(1 - recon_image + 1e-8))
+            image_BCE = lambda_xy * torch.sum(torch.mean(image_BCE, dim=1) * image_mask) / batch_size
 
     if recon_text is not None and text is not None:
-        text_BCE = lambda_yx * F.nll_loss(recon_text, text)
+        if text_mask is None:
+            text_BCE = lambda_yx * F.nll_loss(recon_text, text)
+        else:
+            text_NLL = -recon_text.gather(1, text.unsqueeze(1)).squeeze(1)
+            text_BCE = lambda_yx * torch.sum(text_NLL * text_mask) / batch_size
 
     # see Appendix B from VAE paper:
     # Kingma and Welling. Auto-Encoding Variational Bayes. ICLR, 2014
@@ -81,6 +101,104 @@ def loss_function(mu, logvar, recon_image=None, image=None, recon_text=None, tex
     return image_BCE + text_BCE + KLD
 
 
+def mixed_batch_masks(joint, image_only, text_only, paired):
+    """Lay out the joint, image-only and text-only views of a batch as 
+    one mixed batch for MultimodalVAE.forward_masked.
+
+    :param joint: B numpy bool array; examples shown as a joint view
+    :param image_only: B numpy bool array; examples shown as an image-only view
+    :param text_only: B numpy bool array; examples shown as a text-only view
+    :param paired: B numpy bool array; examples whose pairing can be used
+                   to reconstruct text from an image-only view
+    :return index: LongTensor of rows to take from the batch
+    :return expert_masks: (image_mask, text_mask) FloatTensors; which
+                          modalities are experts for each row
+    :return target_masks: (image_mask, text_mask) FloatTensors; which 
+                          modalities are reconstructed for each row
+                          (with loss_function(..., batch_size=B), each
+                          view is weighted as a separate batch of B)
+    """
+    rows = [np.where(joint)[0], np.where(image_only)[0], np.where(text_only)[0]]
+    index = np.concatenate(rows)
+    view = np.concatenate([np.ones(len(r), dtype=int) * i for i, r in enumerate(rows)])
+    image_mask = view != 2
+    text_mask = view != 1
+    text_target_mask = text_mask | ((view == 1) & paired[index])
+
+    to_tensor = lambda x: torch.from_numpy(x.astype(np.float32))
+    return (torch.from_numpy(index).long(), 
+            (to_tensor(image_mask), to_tensor(text_mask)),
+            (to_tensor(image_mask), to_tensor(text_target_mask)))
+
+
+def ensemble_batch_masks(joint, image_only, text_only, paired):
+    """mixed_batch_masks for K replicas of MultimodalVAEEnsemble sharing a
+    batch. The rows are the joint, image-only and text-only views, in that
+    order, of the examples that at least one replica is shown in that view;
+    a replica's mixed batch is the rows with a 1 in its row of row_weights.
+
+    :param joint: K x B numpy bool array; examples shown as a joint view
+    :param image_only: K x B numpy bool array; as for mixed_batch_masks
+    :param text_only: K x B numpy bool array; as for mixed_batch_masks
+    :param paired: K x B numpy bool array; as for mixed_batch_masks
+    :return index: LongTensor of the N rows to take from the batch
+    :return expert_masks: (image_mask, text_mask) N FloatTensors
+    :return row_weights: K x N FloatTensor
+    :return target_masks: (image_mask, text_mask) K x N FloatTensors
+    """
+    rows = [np.where(np.any(shown, axis=0))[0] for shown in (joint, image_only, text_only)]
+    index = np.concatenate(rows)
+    view = np.concatenate([np.ones(len(r), dtype=int) * i for i, r in enumerate(rows)])
+    image_mask = view != 2
+    text_mask = view != 1
+    row_weights = np.concatenate([shown[:, r] for shown, r in zip((joint, image_only, text_only), rows)], 
+                                 axis=1)
+    image_target_mask = row_weights & image_mask
+    text_target_mask = row_weights & (text_mask | ((view == 1) & paired[:, index]))
+
+    to_tensor = lambda x: torch.from_numpy(x.astype(np.float32))
+    return (torch.from_numpy(index).long(),
+            (to_tensor(image_mask), to_tensor(text_mask)),
+            to_tensor(row_weights),
+            (to_tensor(image_target_mask), to_tensor(text_target_mask)))
+
+
+def ensemble_loss_function(mu, logvar, recon_image, image, recon_text, text, 
+                           row_weights=None, image_mask=None, text_mask=None,
+                           lambda_xy=1., lambda_yx=1., batch_size=None):
+    """loss_function for every replica of MultimodalVAEEnsemble, over the
+    rows in its batch (see ensemble_batch_masks).
+
+    :param mu, logvar: K x N x n_latents
+    :param recon_image: K x N x 784
+    :param image: N x 784, shared by all replicas
+    :param recon_text: K x N x 10 log probabilities
+    :param text: N labels, shared by all replicas
+    :param row_weights: K x N; default: all rows
+    :param image_mask, text_mask: K x N target masks; default: row_weights
+    :param batch_size: as for loss_function (default: N)
+    :return: K losses
+    """
+    if row_weights is None:
+        row_weights = Variable(mu.data.new(mu.size(0), mu.size(1)).fill_(1))
+    image_mask = row_weights if image_mask is None else image_mask
+    text_mask = row_weights if text_mask is None else text_mask
+    batch_size = batch_size or mu.size(1)
+
+    image = image.view(1, -1, 784).expand_as(recon_image)
+    image_BCE = -(image * torch.log(recon_image + 1e-8) + 
+                  (1 - image) * torch.log(1 - recon_image + 1e-8))
+    image_BCE = lambda_xy * torch.sum(torch.mean(image_BCE, dim=2) * image_mask, dim=1) / batch_size
+
+    text = text.view(1, -1, 1).expand(recon_text.size(0), recon_text.size(1), 1)
+    text_NLL = -recon_text.gather(2, text).squeeze(2)
+    text_BCE = lambda_yx * torch.sum(text_NLL * text_mask, dim=1) / batch_size
+
+    KLD = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp(), dim=2)
+    KLD = torch.sum(KLD * row_weights, dim=1) / (batch_size * (784 / 3))
+    return image_BCE + text_BCE + KLD
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -100,14 +218,10 @@ if __name__ == "__main__":
     args.cuda = args.cuda and torch.cuda.is_available()
 
     # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=True, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=False, download=True,
-                       transform=transforms.ToTensor()),
-        batch_size=args.batch_size, shuffle=True)
+    train_loader = mnist_loader('./data', train=True, 
+                                batch_size=args.batch_size, shuffle=True)
+    test_loader = mnist_loader('./data', train=False, 
+                               batch_size=args.batch_size, shuffle=True)
 
 
     # load multimodal VAE
@@ -133,9 +247,10 @@ if __name__ == "__main__":
             
             # for each batch, use 3 types of examples (joint, image-only, and text-only)
             # this way, we can hope to reconstruct both modalities from one
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
 
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, lambda_xy=1., lambda_yx=1.)
@@ -174,9 +289,10 @@ if __name__ == "__main__":
             image, text = Variable(image), Variable(text)
             image = image.view(-1, 784)  # flatten image
                 
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
 
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, lambda_xy=1., lambda_yx=1.)
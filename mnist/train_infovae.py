@@ -51,29 +51,82 @@ def loss_function(recon_x, x, z):
                                 torch.ones(batch_size, args.n_latents))
     if z.is_cuda:
         true_samples = true_samples.cuda()
-        true_samples = Variable(true_samples)
-    MMD = compute_mmd(true_samples, z)
+    true_samples = Variable(true_samples)
+    MMD = compute_mmd(true_samples, z, scales=args.kernel_scales,
+                      max_block=args.max_block, n_features=args.n_features)
     return NLL + MMD
 
 
-def compute_kernel(x, y):
-    """Apply Gaussian kernel to the i-th vector of x and j-th vector of y.
+def compute_kernel(x, y, scales=(1.,)):
+    """Apply Gaussian kernel to the i-th vector of x and j-th vector of y,
+    exp(-|x_i - y_j|^2 / (scale * dim^2)) averaged over the scales. The
+    squared distances come from |x_i|^2 + |y_j|^2 - 2 x_i.y_j, one matrix
+    product, instead of tiling x and y into x_size x y_size x dim.
 
     :param x: torch.Tensor (x_size, dim)
     :param y: torch.Tensor (y_size, dim)
+    :param scales: multipliers of the default bandwidth dim^2 (default: (1,))
     """
-    x_size, y_size, dim = x.size(0), y.size(0), x.size(1)
-    tiled_x = x.unsqueeze(1).expand(x_size, y_size, dim)
-    tiled_y = y.unsqueeze(0).expand(x_size, y_size, dim)
-    return torch.exp(-torch.mean(torch.pow(tiled_x - tiled_y, 2), dim=2) / float(dim))
+    dim = x.size(1)
+    sq_dist = torch.sum(torch.pow(x, 2), 1).unsqueeze(1) + \
+        torch.sum(torch.pow(y, 2), 1).unsqueeze(0) - 2 * torch.mm(x, y.t())
+    kernel = 0
+    for scale in scales:
+        kernel = kernel + torch.exp(-sq_dist / float(scale * dim * dim))
+    return kernel / len(scales)
 
 
-def compute_mmd(x, y):
-    """Compute maximum mean discrepancy."""
-    x_kernel = compute_kernel(x, x)
-    y_kernel = compute_kernel(y, y)
-    xy_kernel = compute_kernel(x, y)
-    return torch.mean(x_kernel) + torch.mean(y_kernel) - 2 * torch.mean(xy_kernel)
+def compute_kernel_mean(x, y, scales=(1.,), max_block=2**22):
+    """Mean of compute_kernel(x, y) over all pairs, computed over blocks
+    of rows of x so that no block has more than max_block entries."""
+    rows = max(1, max_block // y.size(0))
+    total = 0
+    for start in xrange(0, x.size(0), rows):
+        total = total + torch.sum(compute_kernel(x[start:start + rows], y, scales))
+    return total / float(x.size(0) * y.size(0))
+
+
+def random_fourier_features(x, weights):
+    """Features whose dot products approximate the Gaussian kernel, for
+    frequencies drawn as in compute_mmd.
+
+    :param x: torch.Tensor (x_size, dim)
+    :param weights: torch.Tensor (dim, n_features) of random frequencies
+    :return: torch.Tensor (x_size, 2 * n_features)
+    """
+    projection = torch.mm(x, weights)
+    return torch.cat([torch.cos(projection), torch.sin(projection)], 1) / \
+        float(weights.size(1)) ** 0.5
+
+
+def compute_mmd(x, y, scales=(1.,), max_block=2**22, n_features=None):
+    """Compute maximum mean discrepancy.
+
+    :param x: torch.Tensor (x_size, dim)
+    :param y: torch.Tensor (y_size, dim)
+    :param scales: bandwidth multipliers of the kernel (see compute_kernel)
+    :param max_block: most kernel entries computed at once (default: 2**22)
+    :param n_features: if set, approximate the kernel with this many random
+                       Fourier features per scale: linear instead of
+                       quadratic in the batch size (default: None)
+    """
+    if n_features is None:
+        return compute_kernel_mean(x, x, scales, max_block) + \
+            compute_kernel_mean(y, y, scales, max_block) - \
+            2 * compute_kernel_mean(x, y, scales, max_block)
+
+    # frequencies of exp(-|d|^2 / (scale * dim^2)) are N(0, 2 / (scale * dim^2))
+    dim = x.size(1)
+    weights = []
+    for scale in scales:
+        std = (2. / (scale * dim * dim)) ** 0.5
+        weights.append(x.data.new(dim, n_features).normal_(0, std))
+    weights = Variable(torch.cat(weights, 1))
+    # the mean of the features of each side; scales share the normalization
+    # so that dot products average over them like compute_kernel
+    diff = torch.mean(random_fourier_features(x, weights), 0) - \
+        torch.mean(random_fourier_features(y, weights), 0)
+    return torch.sum(torch.pow(diff, 2))
 
 
 if __name__ == "__main__":
@@ -89,6 +142,13 @@ if __name__ == "__main__":
                         help='learning rate (default: 1e-3)')
     parser.add_argument('--log_interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status')
+    parser.add_argument('--kernel_scales', type=float, nargs='+', default=[1.],
+                        help='bandwidths of the MMD kernel, as multiples of n_latents^2 (default: 1)')
+    parser.add_argument('--max_block', type=int, default=2**22, metavar='N',
+                        help='most MMD kernel entries computed at once (default: 2^22)')
+    parser.add_argument('--n_features', type=int, default=None, metavar='N',
+                        help='if set, approximate the MMD with N random Fourier features '
+                             'per bandwidth (default: exact)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
     args = parser.parse_args()
@@ -5,7 +5,6 @@ from __future__ import absolute_import
 import os
 import sys
 import shutil
-import numpy as np
 from PIL import Image
 
 import torch
@@ -13,21 +12,24 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import datasets, transforms
 from torchvision.utils import save_image
 
 from model import PixelCNN, PixelCNNv2, GatedPixelCNN
-from model import cross_entropy_by_dim, log_softmax_by_dim
+from model import PixelCNNSampler
+from model import pixelcnn_loss
+from datasets import mnist_loader
 from train import AverageMeter
 
 
-def quantisize(images, levels):
-    """Convert images to N levels from 0 to N.
+def quantize(images, levels):
+    """Convert images in [0, 1] to levels from 0 to levels - 1, the same
+    bins as np.digitize(images, np.arange(levels) / levels) - 1, for a
+    whole batch at once.
 
-    :param images: numpy array
-    :return: numpy array
+    :param images: FloatTensor
+    :return: LongTensor
     """
-    return (np.digitize(images, np.arange(levels) / levels) - 1).astype('i')
+    return torch.clamp(torch.floor(images * levels), 0, levels - 1).long()
 
 
 def save_checkpoint(state, is_best, folder='./', filename='checkpoint.pth.tar'):
@@ -45,10 +47,12 @@ def load_checkpoint(file_path, use_cuda=False):
                                 map_location=lambda storage, location: storage)
     if checkpoint['gated']:
         model = GatedPixelCNN(checkpoint['data_channels'], 
-                              checkpoint['out_dims'])
+                              checkpoint['out_dims'],
+                              checkpoint.get('n_logistics'))
     else:
         model = PixelCNN(checkpoint['data_channels'],
-                         checkpoint['out_dims'])
+                         checkpoint['out_dims'],
+                         checkpoint.get('n_logistics'))
     model.load_state_dict(checkpoint['state_dict'])
     if use_cuda:
         model.cuda()
@@ -64,6 +68,9 @@ if __name__ == "__main__":
                         help='if True, use GatedPixelCNN instead of PixelCNN (default: False)')
     parser.add_argument('--out_dims', type=int, default=8, metavar='N',
                         help='2|4|8|16|...|256 (default: 8)')
+    parser.add_argument('--n_logistics', type=int, default=None, metavar='N',
+                        help='if set, model levels with a mixture of N discretized logistics '
+                             'instead of a softmax over out_dims (default: None)')
     parser.add_argument('--batch_size', type=int, default=32, metavar='N',
                         help='input batch size for training (default: 32)')
     parser.add_argument('--epochs', type=int, default=10, metavar='N',
@@ -72,6 +79,10 @@ if __name__ == "__main__":
                         help='learning rate (default: 1e-3)')
     parser.add_argument('--log_interval', type=int, default=10, metavar='N',
                         help='how many batches to wait before logging training status (default: 10)')
+    parser.add_argument('--sample_batch_size', type=int, default=64, metavar='N',
+                        help='images sampled together each epoch (default: 64)')
+    parser.add_argument('--n_threads', type=int, default=None, metavar='N',
+                        help='CPU threads used for sampling (default: torch default)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training (default: False)')
     args = parser.parse_args()
@@ -91,28 +102,21 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/pixel_cnn'):
         os.makedirs('./results/pixel_cnn')
 
-    def preprocess(x):
-        x = transforms.ToTensor()(x)
-        if args.out_dims < 256:
-            x = quantisize(x.numpy(), args.out_dims).astype('f')
-            x = torch.from_numpy(x) / (args.out_dims - 1)
+    def preprocess(images):
+        """Quantize a batch of images; returns the model input (levels
+        scaled back to [0, 1]) and the target levels."""
+        levels = quantize(images, args.out_dims)
         if args.rgb:
-            x = torch.cat((x, x, x), dim=0)
-        return x
+            levels = levels.repeat(1, 3, 1, 1)
+        return levels.float() / (args.out_dims - 1), levels
 
     # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=True, download=True,
-                       transform=preprocess),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MNIST('./data', train=False, download=True,
-                       transform=preprocess),
-        batch_size=args.batch_size, shuffle=True)
+    train_loader = mnist_loader('./data', train=True, batch_size=args.batch_size, shuffle=True)
+    test_loader = mnist_loader('./data', train=False, batch_size=args.batch_size, shuffle=True)
 
     # load multimodal VAE
-    model = GatedPixelCNN(args.data_channels, args.out_dims) \
-        if args.gated else PixelCNN(args.data_channels, args.out_dims)
+    model = GatedPixelCNN(args.data_channels, args.out_dims, args.n_logistics) \
+        if args.gated else PixelCNN(args.data_channels, args.out_dims, args.n_logistics)
     if args.cuda:
         model.cuda()
 
@@ -124,8 +128,8 @@ if __name__ == "__main__":
         loss_meter = AverageMeter()
 
         for batch_idx, (data, _) in enumerate(train_loader):
-            data = Variable(data)
-            target = Variable((data.data * (args.out_dims - 1)).long())
+            data, target = preprocess(data)
+            data, target = Variable(data), Variable(target)
             
             if args.cuda:
                 data = data.cuda()
@@ -133,7 +137,7 @@ if __name__ == "__main__":
 
             optimizer.zero_grad()
             output = model(data)
-            loss = cross_entropy_by_dim(output, target)
+            loss = pixelcnn_loss(model, output, target)
             loss_meter.update(loss.data[0], len(data))
             
             loss.backward()
@@ -154,15 +158,15 @@ if __name__ == "__main__":
         loss_meter = AverageMeter()
 
         for batch_idx, (data, _) in enumerate(test_loader):
-            data = Variable(data)
-            target = Variable((data.data * (args.out_dims - 1)).long())
+            data, target = preprocess(data)
+            data, target = Variable(data), Variable(target)
             
             if args.cuda:
                 data = data.cuda()
                 target = target.cuda()
 
             output = model(data)
-            loss = cross_entropy_by_dim(output, target)
+            loss = pixelcnn_loss(model, output, target)
             loss_meter.update(loss.data[0], len(data))
         
         print('====> Test Epoch\tLoss: {:.4f}'.format(loss_meter.avg))
@@ -170,20 +174,10 @@ if __name__ == "__main__":
 
 
     def generate(epoch):
-        sample = torch.zeros(64, args.data_channels, 28, 28)
-        if args.cuda:
-            sample = sample.cuda()
-        model.eval() 
-
-        for i in xrange(28):
-            for j in xrange(28):
-                for k in xrange(args.data_channels):
-                    output = model(Variable(sample, volatile=True))
-                    output = torch.exp(log_softmax_by_dim(output, dim=1))
-                    probs = output[:, :, k, i, j].data
-                    sample[:, k, i, j] = torch.multinomial(probs, 1).float() / (args.out_dims - 1)
-
-        save_image(sample, './results/pixel_cnn/sample_{}.png'.format(epoch)) 
+        sampler = PixelCNNSampler(model, 28, 28, use_cuda=args.cuda)
+        sample = sampler.sample(64, batch_size=args.sample_batch_size,
+                                n_threads=args.n_threads)
+        save_image(sample, './results/pixel_cnn/sample_{}.png'.format(epoch))
 
 
     best_loss = sys.maxint
@@ -200,6 +194,7 @@ if __name__ == "__main__":
             'optimizer' : optimizer.state_dict(),
             'data_channels': args.data_channels,
             'out_dims': args.out_dims,
+            'n_logistics': args.n_logistics,
             'gated': args.gated,
         }, is_best, folder='./trained_models/pixel_cnn')     
 
@@ -12,28 +12,56 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
-import random
+import json
+import shutil
+import hashlib
+import multiprocessing
 import numpy as np
 from PIL import Image
-from random import shuffle
-from scipy.misc import imresize
 
 import torch
 import torchvision.datasets as dset
 from torch.utils.data.dataset import Dataset
 
+from utils import max_length, FILL
+
+SEED = 681307
+# bump when the generator or the file format changes, so old variants 
+# are not reused
+FORMAT_VERSION = 1
+# canvases per independently seeded unit of work
+SHARD_SIZE = 5000
+# top left corners (row, col) of the digits in the fixed variant
+FIXED_PADS = [(4, 4), (4, 23), (23, 4), (23, 23)]
+
 
 class MultiMNIST(Dataset):
-    """images with 0 to 4 digits of non-overlapping MNIST numbers."""
+    """images with 0 to 4 digits of non-overlapping MNIST numbers.
+
+    Each split is stored as raw arrays (see save_split) that are 
+    memory-mapped on first access, so opening the dataset reads nothing
+    and forked DataLoader workers share the same pages. The generation
+    parameters are in meta.json next to them.
+
+    Every variant lives in its own folder named by a hash of its 
+    generation parameters (see variant_key), so variants are kept side
+    by side. Keyword arguments pick the variant (see variant_params;
+    default: 0 to 2 resized and translated digits).
+    """
     processed_folder = 'multimnist'
-    training_file = 'training.pt'
-    test_file = 'test.pt'
+    training_file = 'training'
+    test_file = 'test'
+    meta_file = 'meta.json'
 
-    def __init__(self, root, train=True, transform=None, target_transform=None, download=False):
+    def __init__(self, root, train=True, transform=None, target_transform=None, download=False,
+                 **variant):
         self.root = os.path.expanduser(root)
         self.transform = transform
         self.target_transform = target_transform
         self.train = train  # training set or test set
+        self.params = variant_params(**variant)
+        self.processed_folder = os.path.join(MultiMNIST.processed_folder, 
+                                             variant_key(self.params))
 
         if download:
             self.download()
@@ -42,12 +70,21 @@ class MultiMNIST(Dataset):
             raise RuntimeError('Dataset not found.' +
                                ' You can use download=True to download it')
 
-        if self.train:
-            self.train_data, self.train_labels = torch.load(
-                os.path.join(self.root, self.processed_folder, self.training_file))
-        else:
-            self.test_data, self.test_labels = torch.load(
-                os.path.join(self.root, self.processed_folder, self.test_file))
+        split_file = self.training_file if self.train else self.test_file
+        self.split_path = os.path.join(self.root, self.processed_folder, split_file)
+        self._arrays = None
+
+    def arrays(self):
+        """Return the (images, labels, offsets) arrays of the split, 
+        memory-mapping them on first use."""
+        if self._arrays is None:
+            self._arrays = load_split(self.split_path)
+        return self._arrays
+
+    def meta(self):
+        """Return the generation parameters of the dataset."""
+        with open(os.path.join(self.root, self.processed_folder, self.meta_file)) as fp:
+            return json.load(fp)
 
     def __getitem__(self, index):
         """
@@ -56,14 +93,13 @@ class MultiMNIST(Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        if self.train:
-            img, target = self.train_data[index], self.train_labels[index]
-        else:
-            img, target = self.test_data[index], self.test_labels[index]
+        images, labels, offsets = self.arrays()
+        img = np.asarray(images[index])
+        target = labels[offsets[index]:offsets[index + 1]].tolist()
 
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
-        img = Image.fromarray(img.numpy(), mode='L')
+        img = Image.fromarray(img, mode='L')
 
         if self.transform is not None:
             img = self.transform(img)
@@ -74,75 +110,326 @@ class MultiMNIST(Dataset):
         return img, target
 
     def __len__(self):
-        if self.train:
-            return len(self.train_data)
-        else:
-            return len(self.test_data)
+        return len(self.arrays()[0])
+
+    def tensors(self):
+        """Return the N x 50 x 50 uint8 images and the labels as an 
+        N x max_length LongTensor padded with FILL, as charlist_tensor 
+        would make them one by one."""
+        images, labels, offsets = self.arrays()
+        return torch.from_numpy(np.array(images)), label_tensor(labels, offsets)
 
     def _check_exists(self):
-        return os.path.exists(os.path.join(self.root, self.processed_folder, self.training_file)) and \
-            os.path.exists(os.path.join(self.root, self.processed_folder, self.test_file))
+        # meta.json is written last, so it marks a complete dataset
+        return os.path.exists(os.path.join(self.root, self.processed_folder, self.meta_file))
 
     def download(self):
         if self._check_exists():
             return
+        params = dict(self.params)
+        del params['seed'], params['canvas_size'], params['version']
         make_dataset(self.root, self.processed_folder, 
-                     self.training_file, self.test_file)
+                     self.training_file, self.test_file, **params)
+
+
+class BatchLoader(object):
+    """Iterates over (image, text) batches like DataLoader(dataset,
+    batch_size, shuffle) with transforms.ToTensor() and charlist_tensor,
+    but every batch is a single index_select into the whole uint8 image
+    tensor, scaled to [0, 1] in one op, and the same rows of a 
+    precomputed label tensor.
+
+    :param images: N x H x W uint8 tensor
+    :param labels: N x max_length LongTensor
+    :param batch_size: number of examples per batch (default: 1)
+    :param shuffle: if True, reshuffle the examples every epoch
+    :param dataset: object reported as loader.dataset (for len())
+    """
+    def __init__(self, images, labels, batch_size=1, shuffle=False, dataset=None):
+        # shared memory so forked processes can read the same tensors
+        self.images = images.share_memory_()
+        self.labels = labels.share_memory_()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = dataset if dataset is not None else images
+
+    def __iter__(self):
+        n = self.images.size(0)
+        if self.shuffle:
+            order = torch.randperm(n)
+        else:
+            order = torch.arange(0, n).long()
+        for start in xrange(0, n, self.batch_size):
+            index = order[start:start + self.batch_size]
+            image = self.images.index_select(0, index).float().div_(255).unsqueeze(1)
+            yield image, self.labels.index_select(0, index)
+
+    def __len__(self):
+        return (self.images.size(0) + self.batch_size - 1) // self.batch_size
+
+
+def multimnist_loader(root, train=True, batch_size=1, shuffle=False, **variant):
+    """BatchLoader over MultiMNIST; batches are the same as DataLoader(
+    MultiMNIST(..., transform=transforms.ToTensor(), 
+    target_transform=charlist_tensor))."""
+    dataset = MultiMNIST(root, train=train, download=True, **variant)
+    images, labels = dataset.tensors()
+    return BatchLoader(images, labels, batch_size=batch_size,
+                       shuffle=shuffle, dataset=dataset)
+
+
+def variant_params(min_digits=0, max_digits=2, resize=True, translate=True, 
+                   fixed=False, reverse=False, scramble=False, no_repeat=False):
+    """Return the full, normalized generation parameters of a variant;
+    options that a variant ignores are dropped so they do not change 
+    its key. Besides these, the key covers the seed, canvas size and 
+    FORMAT_VERSION."""
+    if no_repeat and not fixed:
+        raise Exception('Must have --fixed if --no_repeat is supplied.')
 
+    if scramble and not fixed:
+        raise Exception('Must have --fixed if --scramble is supplied.')
 
-def sample_one(canvas_size, mnist, resize=True, translate=True):
-    i = np.random.randint(mnist['digits'].shape[0])
-    digit = mnist['digits'][i]
-    label = mnist['labels'][i]
-    if resize:  # resize only if user specified
-        scale = 0.1 * np.random.randn() + 1.3
-        resized = imresize(digit, 1. / scale)
-    else:
-        resized = digit
-    w = resized.shape[0]
-    assert w == resized.shape[1]
-    padding = canvas_size - w
-    if translate:  # translate only if user specified
-        pad_l = np.random.randint(0, padding)
-        pad_r = np.random.randint(0, padding)
-        pad_width = ((pad_l, padding - pad_l), (pad_r, padding - pad_r))
-        positioned = np.pad(resized, pad_width, 'constant', constant_values=0)
-    else:
-        pad_l = padding // 2
-        pad_r = padding // 2
-        pad_width = ((pad_l, padding - pad_l), (pad_r, padding - pad_r))
-        positioned = np.pad(resized, pad_width, 'constant', constant_values=0)
-    return positioned, label
-
-
-def sample_multi(num_digits, canvas_size, mnist, resize=True, translate=True):
-    canvas = np.zeros((canvas_size, canvas_size))
-    labels = []
-    for _ in range(num_digits):
-        positioned_digit, label = sample_one(canvas_size, mnist, resize=resize,
-                                             translate=translate)
-        canvas += positioned_digit
-        labels.append(label)
-    
-    # Crude check for overlapping digits.
-    if np.max(canvas) > 255:
-        return sample_multi(num_digits, canvas_size, mnist, 
-                            resize=resize, translate=translate)
+    if reverse and not fixed:
+        raise Exception('Must have --fixed if --reverse is supplied.')
+
+    if reverse and scramble:
+        print('Found --reversed and --scrambling. Overriding --reversed.')
+        reverse = False
+
+    params = dict(min_digits=min_digits, max_digits=max_digits, seed=SEED, 
+                  canvas_size=50, version=FORMAT_VERSION)
+    if fixed:
+        params.update(fixed=True, reverse=reverse, scramble=scramble, no_repeat=no_repeat)
     else:
-        return canvas, labels
+        params.update(resize=resize, translate=translate)
+    return params
 
 
-def mk_dataset(n, mnist, min_digits, max_digits, canvas_size, 
-               resize=True, translate=True):
-    x = []
-    y = []
-    for _ in range(n):
-        num_digits = np.random.randint(min_digits, max_digits + 1)
-        canvas, labels = sample_multi(num_digits, canvas_size, mnist,
-                                      resize=resize, translate=translate)
-        x.append(canvas)
-        y.append(labels)
-    return np.array(x, dtype=np.uint8), y
+def variant_key(params):
+    """Content hash of the generation parameters of a variant."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def add_variant_args(parser):
+    """Add the command line options that pick a MultiMNIST variant."""
+    parser.add_argument('--min_digits', type=int, default=0, 
+                        help='minimum number of digits to add to an image')
+    parser.add_argument('--max_digits', type=int, default=2,
+                        help='maximum number of digits to add to an image')
+    parser.add_argument('--no_resize', action='store_true', default=False,
+                        help='if True, fix the image to be MNIST size')
+    parser.add_argument('--no_translate', action='store_true', default=False,
+                        help='if True, fix the image to be in the center')
+    parser.add_argument('--fixed', action='store_true', default=False,
+                        help='If True, ignore resize/translate options and generate')
+    parser.add_argument('--scramble', action='store_true', default=False,
+                        help='If True, scramble labels and generate. Only does something if fixed is True.')
+    parser.add_argument('--reverse', action='store_true', default=False, 
+                        help='If True, reverse flips the labels i.e. 4321 instead of 1234 with 0.5 probability.')
+    parser.add_argument('--no_repeat', action='store_true', default=False,
+                        help='If True, do not generate images with multiple of the same label.')
+
+
+def variant_args(args):
+    """Return the keyword arguments for MultiMNIST from options added by 
+    add_variant_args."""
+    return dict(min_digits=args.min_digits, max_digits=args.max_digits,
+                resize=not args.no_resize, translate=not args.no_translate,
+                fixed=args.fixed, reverse=args.reverse, scramble=args.scramble,
+                no_repeat=args.no_repeat)
+
+
+def label_tensor(labels, offsets):
+    """Turn flat labels into an N x max_length LongTensor padded with 
+    FILL; example i has labels[offsets[i]:offsets[i + 1]]."""
+    lengths = np.diff(offsets)
+    tensor = np.ones((len(lengths), max_length), dtype=np.int64) * FILL
+    tensor[np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]] = labels
+    return torch.from_numpy(tensor)
+
+
+def save_split(path, images, labels, offsets):
+    """Save a split as path_images.npy (N x H x W uint8), path_labels.npy
+    (flat int8 labels of all examples) and path_offsets.npy (N + 1 int64;
+    example i has labels[offsets[i]:offsets[i + 1]])."""
+    np.save(path + '_images.npy', images.astype(np.uint8))
+    np.save(path + '_labels.npy', labels.astype(np.int8))
+    np.save(path + '_offsets.npy', offsets.astype(np.int64))
+
+
+def load_split(path):
+    """Memory-map the arrays written by save_split."""
+    return tuple(np.load(path + suffix, mmap_mode='r') 
+                 for suffix in ['_images.npy', '_labels.npy', '_offsets.npy'])
+
+
+def resize_weights(out_size, in_size=28):
+    """Matrix that resizes a length in_size signal to out_size with a 
+    triangle (bilinear) filter, widened when downsampling, as PIL does."""
+    scale = in_size / out_size
+    support = max(scale, 1.)
+    centers = (np.arange(out_size) + 0.5) * scale
+    x = (np.arange(in_size)[np.newaxis, :] + 0.5 - centers[:, np.newaxis]) / support
+    weights = np.maximum(0, 1 - np.abs(x))
+    return weights / np.sum(weights, axis=1, keepdims=True)
+
+
+def resize_digits(digits, widths):
+    """Resize a batch of square digits, each to its own width.
+
+    :param digits: N x 28 x 28 uint8 array
+    :param widths: N int array
+    :return: N x T x T float array of the resized digits in the top left
+             corner of zero tiles, where T is the largest width
+    """
+    size = digits.shape[1]
+    tiles = np.zeros((len(digits), widths.max(), widths.max()))
+    for w in np.unique(widths):
+        ix = np.where(widths == w)[0]
+        if w == size:
+            tiles[ix, :w, :w] = digits[ix]
+            continue
+        weights = resize_weights(w, size)
+        resized = np.matmul(np.matmul(weights, digits[ix].astype(np.float64)), weights.T)
+        tiles[ix, :w, :w] = np.clip(np.round(resized), 0, 255)
+    return tiles
+
+
+def sample_digits(rs, num_digits, canvas_size, mnist, resize=True, translate=True, 
+                  fixed=False, reverse=False, scramble=False, no_repeat=False):
+    """Draw num_digits[b] digits onto canvas b for a whole batch at once,
+    one digit slot at a time. Overlapping digits are not rejected here.
+
+    :param rs: numpy RandomState
+    :param num_digits: B int array
+    :param fixed: if True, ignore resize/translate; place digits of 
+                  scale 1.3 at the FIXED_PADS corners
+    :return canvases: B x canvas_size x canvas_size float array
+    :return labels: B x max(num_digits) int array padded with -1
+    """
+    n = len(num_digits)
+    max_digits = num_digits.max() if n > 0 else 0
+    size = mnist['digits'].shape[1]
+    canvases = np.zeros(n * canvas_size * canvas_size)
+    labels = -np.ones((n, max_digits), dtype=np.int64)
+
+    for k in xrange(max_digits):
+        rows = np.where(num_digits > k)[0]
+        ixs = rs.randint(len(mnist['digits']), size=len(rows))
+        if no_repeat:  # resample only the digits whose label is already on the canvas
+            repeat = np.any(labels[rows, :k] == mnist['labels'][ixs, np.newaxis], axis=1)
+            while np.any(repeat):
+                ixs[repeat] = rs.randint(len(mnist['digits']), size=np.sum(repeat))
+                repeat = np.any(labels[rows, :k] == mnist['labels'][ixs, np.newaxis], axis=1)
+        labels[rows, k] = mnist['labels'][ixs]
+
+        if fixed:
+            scales = np.ones(len(rows)) * 1.3
+        elif resize:
+            scales = 0.1 * rs.randn(len(rows)) + 1.3
+        else:
+            scales = np.ones(len(rows))
+        widths = np.clip((size / scales).astype(int), 1, canvas_size - 1)
+        tiles = resize_digits(mnist['digits'][ixs], widths)
+
+        padding = canvas_size - widths
+        if fixed:
+            pad_l = np.ones(len(rows), dtype=int) * FIXED_PADS[k][0]
+            pad_r = np.ones(len(rows), dtype=int) * FIXED_PADS[k][1]
+        elif translate:
+            pad_l = (rs.rand(len(rows)) * padding).astype(int)
+            pad_r = (rs.rand(len(rows)) * padding).astype(int)
+        else:
+            pad_l = pad_r = padding // 2
+
+        # add every tile onto its canvas in one go; tile entries past the
+        # digit are zero, so clipping their coordinates is harmless
+        offsets = np.arange(tiles.shape[1])
+        tile_rows = np.minimum(pad_l[:, np.newaxis] + offsets, canvas_size - 1)
+        tile_cols = np.minimum(pad_r[:, np.newaxis] + offsets, canvas_size - 1)
+        flat = (rows[:, np.newaxis, np.newaxis] * canvas_size * canvas_size + 
+                tile_rows[:, :, np.newaxis] * canvas_size + tile_cols[:, np.newaxis, :])
+        canvases += np.bincount(flat.ravel(), weights=tiles.ravel(), 
+                                minlength=len(canvases))
+
+    positions = np.arange(max_digits)[np.newaxis, :]
+    valid = positions < num_digits[:, np.newaxis]
+    if reverse:  # flip the labels of half of the canvases
+        flip = rs.rand(n) > 0.5
+        order = np.where(flip[:, np.newaxis] & valid, 
+                         num_digits[:, np.newaxis] - 1 - positions, positions)
+        labels = labels[np.arange(n)[:, np.newaxis], order]
+    if scramble:
+        keys = np.where(valid, rs.rand(n, max_digits), np.inf)
+        labels = labels[np.arange(n)[:, np.newaxis], np.argsort(keys, axis=1)]
+
+    return canvases.reshape(n, canvas_size, canvas_size), labels
+
+
+def sample_multi(rs, num_digits, canvas_size, mnist, **kwargs):
+    """Like sample_digits, but canvases with overlapping digits (a pixel
+    above 255) are resampled until none is left; only the rejected 
+    canvases are drawn again.
+
+    :return canvases: B x canvas_size x canvas_size uint8 array
+    :return labels: B x max(num_digits) int array padded with -1
+    """
+    n = len(num_digits)
+    canvases = np.zeros((n, canvas_size, canvas_size), dtype=np.uint8)
+    labels = -np.ones((n, num_digits.max() if n > 0 else 0), dtype=np.int64)
+    todo = np.arange(n)
+    while len(todo) > 0:
+        canvas, label = sample_digits(rs, num_digits[todo], canvas_size, mnist, **kwargs)
+        ok = np.max(canvas.reshape(len(todo), -1), axis=1) <= 255
+        canvases[todo[ok]] = canvas[ok]
+        labels[todo[ok], :label.shape[1]] = label[ok]
+        todo = todo[~ok]
+    return canvases, labels
+
+
+def _init_shard_worker(mnist):
+    global _shard_mnist
+    _shard_mnist = mnist
+
+
+def _mk_shard(args):
+    seed, shard, n, min_digits, max_digits, canvas_size, kwargs = args
+    rs = np.random.RandomState([seed, shard])
+    num_digits = rs.randint(min_digits, max_digits + 1, size=n)
+    return sample_multi(rs, num_digits, canvas_size, _shard_mnist, **kwargs)
+
+
+def mk_dataset(n, mnist, min_digits, max_digits, canvas_size, seed=SEED,
+               n_workers=None, **kwargs):
+    """Generate n canvases in shards of SHARD_SIZE. Shard i is drawn from
+    its own RandomState seeded with (seed, i), so the output only depends 
+    on seed and not on how many workers ran the shards.
+
+    :param n_workers: number of processes (default: one per cpu)
+    :param kwargs: passed to sample_digits
+    :return x: n x canvas_size x canvas_size uint8 array
+    :return labels: flat array of the labels of all canvases
+    :return offsets: n + 1 array; canvas i has labels[offsets[i]:offsets[i + 1]]
+    """
+    shards = [(seed, i, min(SHARD_SIZE, n - start), min_digits, max_digits, 
+               canvas_size, kwargs) for i, start in enumerate(xrange(0, n, SHARD_SIZE))]
+    n_workers = n_workers or multiprocessing.cpu_count()
+    if n_workers > 1 and len(shards) > 1:
+        pool = multiprocessing.Pool(n_workers, _init_shard_worker, (mnist,))
+        results = pool.map(_mk_shard, shards)
+        pool.close()
+        pool.join()
+    else:
+        _init_shard_worker(mnist)
+        results = [_mk_shard(shard) for shard in shards]
+
+    x = np.concatenate([canvases for canvases, _ in results])
+    width = max(labels.shape[1] for _, labels in results)
+    y = np.concatenate([np.pad(labels, ((0, 0), (0, width - labels.shape[1])), 
+                               'constant', constant_values=-1) for _, labels in results])
+    offsets = np.concatenate(([0], np.cumsum(np.sum(y >= 0, axis=1))))
+    return x, y[y >= 0], offsets
 
 
 def load_mnist():
@@ -154,172 +441,64 @@ def load_mnist():
     
     train_data = {
         'digits': train_loader.dataset.train_data.numpy(),
-        'labels': train_loader.dataset.train_labels
+        'labels': train_loader.dataset.train_labels.numpy()
     }
 
     test_data = {
         'digits': test_loader.dataset.test_data.numpy(),
-        'labels': test_loader.dataset.test_labels
+        'labels': test_loader.dataset.test_labels.numpy()
     }
 
     return train_data, test_data
 
 
 def make_dataset(root, folder, training_file, test_file, min_digits=0, max_digits=2,
-                 resize=True, translate=True):
-    if not os.path.isdir(os.path.join(root, folder)):
-        os.makedirs(os.path.join(root, folder))
+                 n_workers=None, **kwargs):
+    """Generate and save the 60000 training and 10000 test canvases. 
+    Keyword arguments (resize, translate, fixed, reverse, scramble, 
+    no_repeat) are passed to sample_digits.
+
+    The files are written to a temporary folder that is renamed to 
+    folder once complete, so concurrent jobs building the same variant
+    never see half a dataset.
+    """
+    meta = variant_params(min_digits=min_digits, max_digits=max_digits, **kwargs)
+    kwargs = {k: v for k, v in meta.items() 
+              if k in ['resize', 'translate', 'fixed', 'reverse', 'scramble', 'no_repeat']}
+    tmp_folder = '%s.tmp%d' % (folder, os.getpid())
+    if not os.path.isdir(os.path.join(root, tmp_folder)):
+        os.makedirs(os.path.join(root, tmp_folder))
 
-    np.random.seed(681307)
     train_mnist, test_mnist = load_mnist()
-    train_x, train_y = mk_dataset(60000, train_mnist, min_digits, max_digits, 50,
-                                  resize=resize, translate=translate)
-    test_x, test_y = mk_dataset(10000, test_mnist, min_digits, max_digits, 50,
-                                resize=resize, translate=translate)
-    
-    train_x = torch.from_numpy(train_x).byte()
-    test_x = torch.from_numpy(test_x).byte()
-
-    training_set = (train_x, train_y)
-    test_set = (test_x, test_y)
-
-    with open(os.path.join(root, folder, training_file), 'wb') as f:
-        torch.save(training_set, f)
-
-    with open(os.path.join(root, folder, test_file), 'wb') as f:
-        torch.save(test_set, f)
-
-
-def sample_one_fixed(canvas_size, mnist, pad_l, pad_r, scale=1.3):
-    i = np.random.randint(mnist['digits'].shape[0])
-    digit = mnist['digits'][i]
-    label = mnist['labels'][i]
-    resized = imresize(digit, 1. / scale)
-    w = resized.shape[0]
-    assert w == resized.shape[1]
-    padding = canvas_size - w
-    pad_width = ((pad_l, padding - pad_l), (pad_r, padding - pad_r))
-    positioned = np.pad(resized, pad_width, 'constant', constant_values=0)
-    return positioned, label
-
-
-def sample_multi_fixed(num_digits, canvas_size, mnist, reverse=False, 
-                       scramble=False, no_repeat=False):
-    canvas = np.zeros((canvas_size, canvas_size))
-    labels = []
-    pads = [(4, 4), (4, 23), (23, 4), (23, 23)]
-    for i in range(num_digits):
-        if no_repeat:  # keep trying to generate examples that are 
-                       # not already in previously generated labels
-            while True:
-                positioned_digit, label = sample_one_fixed(
-                    canvas_size, mnist, pads[i][0], pads[i][1])
-                if label not in labels:
-                    break
-        else:
-            positioned_digit, label = sample_one_fixed(
-                canvas_size, mnist, pads[i][0], pads[i][1])
-        
-        canvas += positioned_digit
-        labels.append(label)
-    
-    if reverse and random.random() > 0.5:
-        labels = labels[::-1]
-
-    if scramble:
-        random.shuffle(labels)
-
-    # Crude check for overlapping digits.
-    if np.max(canvas) > 255:
-        return sample_multi_fixed(num_digits, canvas_size, mnist, reverse=reverse, 
-                                  scramble=scramble, no_repeat=no_repeat)
-    else:
-        return canvas, labels
-
-
-def mk_dataset_fixed(n, mnist, min_digits, max_digits, canvas_size, 
-                     reverse=False, scramble=False, no_repeat=False):
-    x = []
-    y = []
-    for _ in range(n):
-        num_digits = np.random.randint(min_digits, max_digits + 1)
-        canvas, labels = sample_multi_fixed(num_digits, canvas_size, mnist, reverse=reverse, 
-                                            scramble=scramble, no_repeat=no_repeat)
-        x.append(canvas)
-        y.append(labels)
-    return np.array(x, dtype=np.uint8), y
+    for n, mnist, seed, split_file in [(60000, train_mnist, SEED, training_file),
+                                       (10000, test_mnist, SEED + 1, test_file)]:
+        x, labels, offsets = mk_dataset(n, mnist, min_digits, max_digits, 50,
+                                        seed=seed, n_workers=n_workers, **kwargs)
+        save_split(os.path.join(root, tmp_folder, split_file), x, labels, offsets)
 
-
-def make_dataset_fixed(root, folder, training_file, test_file, 
-                       min_digits=0, max_digits=3, reverse=False, 
-                       scramble=False, no_repeat=False):
-    if not os.path.isdir(os.path.join(root, folder)):
-        os.makedirs(os.path.join(root, folder))
-
-    np.random.seed(681307)
-    train_mnist, test_mnist = load_mnist()
-    train_x, train_y = mk_dataset_fixed(60000, train_mnist, min_digits, max_digits, 50, 
-                                        reverse=reverse, scramble=scramble, no_repeat=no_repeat)
-    test_x, test_y = mk_dataset_fixed(10000, test_mnist, min_digits, max_digits, 50, 
-                                      reverse=reverse, scramble=scramble, no_repeat=no_repeat)
-    
-    train_x = torch.from_numpy(train_x).byte()
-    test_x = torch.from_numpy(test_x).byte()
-
-    training_set = (train_x, train_y)
-    test_set = (test_x, test_y)
-
-    with open(os.path.join(root, folder, training_file), 'wb') as f:
-        torch.save(training_set, f)
-
-    with open(os.path.join(root, folder, test_file), 'wb') as f:
-        torch.save(test_set, f)
+    with open(os.path.join(root, tmp_folder, MultiMNIST.meta_file), 'w') as fp:
+        json.dump(meta, fp, indent=2, sort_keys=True)
+    try:
+        os.rename(os.path.join(root, tmp_folder), os.path.join(root, folder))
+    except OSError:  # another job finished the same variant first
+        shutil.rmtree(os.path.join(root, tmp_folder))
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--min_digits', type=int, default=0, 
-                        help='minimum number of digits to add to an image')
-    parser.add_argument('--max_digits', type=int, default=2,
-                        help='maximum number of digits to add to an image')
-    parser.add_argument('--no_resize', action='store_true', default=False,
-                        help='if True, fix the image to be MNIST size')
-    parser.add_argument('--no_translate', action='store_true', default=False,
-                        help='if True, fix the image to be in the center')
-    parser.add_argument('--fixed', action='store_true', default=False,
-                        help='If True, ignore resize/translate options and generate')
-    parser.add_argument('--scramble', action='store_true', default=False,
-                        help='If True, scramble labels and generate. Only does something if fixed is True.')
-    parser.add_argument('--reverse', action='store_true', default=False, 
-                        help='If True, reverse flips the labels i.e. 4321 instead of 1234 with 0.5 probability.')
-    parser.add_argument('--no_repeat', action='store_true', default=False,
-                        help='If True, do not generate images with multiple of the same label.')
+    add_variant_args(parser)
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of processes to generate with (default: one per cpu)')
     args = parser.parse_args()
-    args.resize = not args.no_resize
-    args.translate = not args.no_translate
-    
-    if args.no_repeat and not args.fixed:
-        raise Exception('Must have --fixed if --no_repeat is supplied.')
-
-    if args.scramble and not args.fixed:
-        raise Exception('Must have --fixed if --scramble is supplied.')
-
-    if args.reverse and not args.fixed:
-        raise Exception('Must have --fixed if --reverse is supplied.')
 
-    if args.reverse and args.scramble:
-        print('Found --reversed and --scrambling. Overriding --reversed.')
-        args.reverse = False
-
-    # Generate the training set and dump it to disk. (Note, this will
-    # always generate the same data, else error out.)
-    if args.fixed:
-        make_dataset_fixed('./data', 'multimnist', 'training.pt', 'test.pt',
-                           min_digits=args.min_digits, max_digits=args.max_digits,
-                           reverse=args.reverse, scramble=args.scramble, 
-                           no_repeat=args.no_repeat)
-    else:  # if not fixed, then make classific MultiMNIST dataset
-        make_dataset('./data', 'multimnist', 'training.pt', 'test.pt',
-                     min_digits=args.min_digits, max_digits=args.max_digits,
-                     resize=args.resize, translate=args.translate)
+    # Generate the variant once and keep it under its own key. (Note, 
+    # this will always generate the same data, else error out.)
+    params = variant_params(**variant_args(args))
+    folder = os.path.join(MultiMNIST.processed_folder, variant_key(params))
+    if os.path.exists(os.path.join('./data', folder, MultiMNIST.meta_file)):
+        print('Variant already built in ./data/%s' % folder)
+    else:
+        make_dataset('./data', folder, MultiMNIST.training_file, MultiMNIST.test_file,
+                     n_workers=args.n_workers, **variant_args(args))
+        print('Built variant in ./data/%s' % folder)
@@ -18,7 +18,7 @@ from utils import charlist_tensor
 
 
 def compute_nll(model, loader, image_only=False, text_only=False, 
-                n_samples=1, use_cuda=False):
+                n_samples=1, chunk_size=100, use_cuda=False):
     assert not (image_only and text_only)
 
     model.eval()
@@ -38,24 +38,24 @@ def compute_nll(model, loader, image_only=False, text_only=False,
             _, _, mu, logvar = model(text=text)
 
         batch_size, n_latents = mu.size(0), mu.size(1)
-        sample = Variable(torch.randn(n_samples, n_latents))
-
-        if use_cuda:
-            sample = sample.cuda()
-
         std = logvar.mul(0.5).exp_()
-        mu = mu.unsqueeze(1).repeat(1, n_samples, 1)
-        std = std.unsqueeze(1).repeat(1, n_samples, 1)
-
-        sample = sample.unsqueeze(0).repeat(batch_size, 1, 1)
-        sample = sample.mul(std).add_(mu)
 
+        # decode the samples chunk_size at a time, each chunk as a single
+        # (n_chunk * batch_size) batch, sample major
         image_nll, text_nll = 0, 0
-        for i in xrange(n_samples):
-            recon_image = model.decode_image(sample[:, i])
-            recon_text = model.decode_text(sample[:, i])
-            image_nll += F.binary_cross_entropy(recon_image, image, size_average=False)
-            text_nll += F.nll_loss(recon_text, text, size_average=False)
+        for start in xrange(0, n_samples, chunk_size):
+            n_chunk = min(chunk_size, n_samples - start)
+            sample = Variable(mu.data.new(n_chunk, batch_size, n_latents).normal_(),
+                              volatile=True)
+            sample = sample.mul(std.unsqueeze(0).expand_as(sample))
+            sample = sample.add_(mu.unsqueeze(0).expand_as(sample))
+            sample = sample.view(n_chunk * batch_size, n_latents)
+
+            recon_image = model.decode_image(sample)
+            recon_text = model.decode_text(sample)
+            image_nll += F.binary_cross_entropy(recon_image, repeat_batch(image, n_chunk),
+                                                size_average=False)
+            text_nll += F.nll_loss(recon_text, repeat_batch(text, n_chunk), size_average=False)
 
         test_image_nll += (image_nll / n_samples)
         test_text_nll += (text_nll / n_samples)
@@ -69,6 +69,125 @@ def compute_nll(model, loader, image_only=False, text_only=False,
     return test_image_nll, test_text_nll
 
 
+def repeat_batch(x, n):
+    """n copies of a batch one after another, as one batch."""
+    x = x.unsqueeze(0).expand(n, *x.size()).contiguous()
+    return x.view(n * x.size(1), *x.size()[2:])
+
+
+def compute_iwae(model, loader, image_only=False, text_only=False, n_samples=100,
+                 chunk_size=100, max_samples=None, std_error=None, use_cuda=False):
+    """Importance weighted estimate of the negative log-likelihood of the
+    modalities the posterior is conditioned on (image, text or both), using
+    K samples z_k from the product of experts q(z|x):
+
+        log p(x) ~= log 1/K sum_k p(x|z_k) p(z_k) / q(z_k|x)
+
+    Samples are drawn chunk_size at a time. Without std_error every example
+    gets n_samples. With std_error, an example keeps getting chunks after
+    its first n_samples until the standard error of its estimate is below
+    std_error (in nats) or it has max_samples, so the samples go to the
+    examples whose importance weights disagree.
+
+    :return: (average NLL per example, average number of samples used)
+    """
+    assert not (image_only and text_only)
+    if std_error is None:
+        max_samples = n_samples
+    max_samples = max(max_samples or n_samples, n_samples)
+
+    model.eval()
+    test_nll, test_n_used = 0, 0
+
+    for batch_idx, (image, text) in enumerate(loader):
+        if use_cuda:
+            image, text = image.cuda(), text.cuda()
+        image = Variable(image, volatile=True)
+        text = Variable(text, volatile=True)
+
+        if not image_only and not text_only:
+            _, _, mu, logvar = model(image, text)
+        elif image_only:
+            _, _, mu, logvar = model(image=image)
+        elif text_only:
+            _, _, mu, logvar = model(text=text)
+
+        # log weights of each example, one column per sample (-inf if not drawn)
+        batch_size = mu.size(0)
+        log_w = mu.data.new(batch_size, max_samples).fill_(-float('inf'))
+        n_used = mu.data.new(batch_size).zero_()
+        active = torch.arange(0, batch_size).long()
+        if use_cuda:
+            active = active.cuda()
+
+        n_drawn = 0
+        while n_drawn < max_samples:
+            n_chunk = min(chunk_size, max_samples - n_drawn)
+            index = Variable(active, volatile=True)
+            chunk_log_w = log_weights(model, image.index_select(0, index),
+                                      text.index_select(0, index),
+                                      mu.index_select(0, index), logvar.index_select(0, index),
+                                      n_chunk, image_only=image_only, text_only=text_only)
+            log_w.narrow(1, n_drawn, n_chunk).index_copy_(0, active, chunk_log_w.t().contiguous())
+            n_used.index_fill_(0, active, n_drawn + n_chunk)
+            n_drawn += n_chunk
+
+            if std_error is not None and n_drawn >= n_samples:
+                error = standard_error(log_w.index_select(0, active)[:, :n_drawn])
+                active = active.masked_select(error > std_error)
+                if active.numel() == 0:
+                    break
+
+        # log mean exp of the weights drawn for each example
+        max_log_w = log_w.max(1, keepdim=True)[0]
+        log_p = max_log_w.squeeze(1) + torch.log(
+            torch.exp(log_w - max_log_w.expand_as(log_w)).sum(1) / n_used)
+        test_nll += -float(log_p.sum())
+        test_n_used += float(n_used.sum())
+
+        print('Evaluating: [{}/{} ({:.0f}%)]'.format(batch_idx * len(image), len(loader.dataset),
+                                                     100. * batch_idx / len(loader)))
+
+    return test_nll / len(loader.dataset), test_n_used / len(loader.dataset)
+
+
+def log_weights(model, image, text, mu, logvar, n_samples, image_only=False, text_only=False):
+    """log p(x|z) + log p(z) - log q(z|x) for n_samples samples z ~ q(z|x)
+    of each example, as an n_samples x batch_size tensor. x is the image,
+    the text or both, as for the posterior.
+    """
+    batch_size, n_latents = mu.size(0), mu.size(1)
+    eps = Variable(mu.data.new(n_samples, batch_size, n_latents).normal_(), volatile=True)
+    std = logvar.mul(0.5).exp_()
+    z = eps.mul(std.unsqueeze(0).expand_as(eps)).add_(mu.unsqueeze(0).expand_as(eps))
+    # log N(z; 0, I) - log N(z; mu, std^2); the log(2 pi) terms cancel
+    log_w = (eps.pow(2) - z.pow(2) + logvar.unsqueeze(0).expand_as(eps)).sum(2) * 0.5
+    z = z.view(n_samples * batch_size, n_latents)
+
+    if not text_only:
+        recon_image = model.decode_image(z).view(n_samples, batch_size, -1)
+        target = image.view(1, batch_size, -1).expand_as(recon_image)
+        log_w = log_w + bernoulli_log_prob(recon_image, target).sum(2)
+    if not image_only:
+        # p(text|z) of the ground truth, so decode with teacher forcing
+        recon_text = model.decode_text(z, text=repeat_batch(text, n_samples))
+        target = repeat_batch(text, n_samples).unsqueeze(2)
+        log_p_text = recon_text.gather(2, target).squeeze(2).sum(1)
+        log_w = log_w + log_p_text.view(n_samples, batch_size)
+    return log_w.data
+
+
+def bernoulli_log_prob(p, x, eps=1e-7):
+    return x * torch.log(p + eps) + (1 - x) * torch.log(1 - p + eps)
+
+
+def standard_error(log_w):
+    """Delta method standard error of the log mean of the importance
+    weights (one row of log weights per example)."""
+    w = torch.exp(log_w - log_w.max(1, keepdim=True)[0].expand_as(log_w))
+    return w.std(1) / (w.mean(1) * log_w.size(1) ** 0.5)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -80,8 +199,18 @@ if __name__ == "__main__":
                         help='compute NLL of test data using reconstructions from text only')
     parser.add_argument('--n_samples', type=int, default=100, 
                         help='number of samples to use to estimate the ELBO')
+    parser.add_argument('--chunk_size', type=int, default=100,
+                        help='number of samples to decode at once (default: 100)')
+    parser.add_argument('--iwae', action='store_true', default=False,
+                        help='estimate -log p(x) by importance sampling instead')
+    parser.add_argument('--std_error', type=float, default=None,
+                        help='with --iwae, sample each example until its standard error '
+                             'is below this (default: always use n_samples)')
+    parser.add_argument('--max_samples', type=int, default=1000,
+                        help='with --std_error, most samples per example (default: 1000)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
@@ -92,16 +221,24 @@ if __name__ == "__main__":
     loader = torch.utils.data.DataLoader(
         datasets.MultiMNIST('./data', train=False, download=True,
                             transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
+                            target_transform=charlist_tensor,
+                            **datasets.variant_args(args)),
         batch_size=64, shuffle=True)
 
     vae = load_checkpoint(args.model_path, use_cuda=args.cuda)
     vae.eval()
 
-    image_nll, text_nll = compute_nll(vae, loader, use_cuda=args.cuda, n_samples=args.n_samples,
-                                      image_only=args.image_only, text_only=args.text_only)
-
-    image_nll = image_nll.cpu().data[0]
-    text_nll = text_nll.cpu().data[0]
-    print('\nTest Image NLL: {:.4f}\tTest Text NLL: {:.4f}'.format(image_nll, text_nll))
-    
+    if args.iwae:
+        nll, n_used = compute_iwae(vae, loader, use_cuda=args.cuda, n_samples=args.n_samples,
+                                   chunk_size=args.chunk_size, max_samples=args.max_samples,
+                                   std_error=args.std_error, image_only=args.image_only,
+                                   text_only=args.text_only)
+        print('\nTest NLL (IWAE): {:.4f}\tSamples per example: {:.1f}'.format(nll, n_used))
+    else:
+        image_nll, text_nll = compute_nll(vae, loader, use_cuda=args.cuda, n_samples=args.n_samples,
+                                          chunk_size=args.chunk_size,
+                                          image_only=args.image_only, text_only=args.text_only)
+
+        image_nll = image_nll.cpu().data[0]
+        text_nll = text_nll.cpu().data[0]
+        print('\nTest Image NLL: {:.4f}\tTest Text NLL: {:.4f}'.format(image_nll, text_nll))
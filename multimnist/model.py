@@ -47,8 +47,8 @@ class MultimodalVAE(nn.Module):
     def encode_text(self, x):
         return self.text_encoder(x)
 
-    def decode_text(self, z):
-        return self.text_decoder(z)
+    def decode_text(self, z, text=None):
+        return self.text_decoder(z, text=text)
 
     def prior(self, size, use_cuda=False):
         mu = Variable(torch.zeros(size))
@@ -59,7 +59,7 @@ class MultimodalVAE(nn.Module):
 
         return mu, logvar
 
-    def forward(self, image=None, text=None):
+    def forward(self, image=None, text=None, teacher_forcing=False):
         # can't just put nothing
         assert image is not None or text is not None
         
@@ -88,10 +88,74 @@ class MultimodalVAE(nn.Module):
         z = self.reparametrize(mu, logvar)
         # reconstruct inputs based on that gaussian
         image_recon = self.decode_image(z)
-        text_recon = self.decode_text(z)
+        text_recon = self.decode_text(z, text=text if teacher_forcing else None)
 
         return image_recon, text_recon, mu, logvar
 
+    def forward_subsets(self, image, text, teacher_forcing=False):
+        """Equivalent to calling forward with (image, text), (image) and
+        (text) but each encoder runs only once and the latents of all
+        three subsets are decoded together as one concatenated batch.
+
+        :param image: batch of images
+        :param text: batch of texts
+        :param teacher_forcing: if True, decode text with the ground truth
+                                as input (default: False)
+        :return: list of (image_recon, text_recon, mu, logvar) tuples for
+                 the joint, image-only and text-only subsets (in that order)
+        """
+        batch_size = image.size(0)
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        # product of experts for every subset of modalities; shares the
+        # encoder outputs rather than recomputing them per subset
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        joint_mu, joint_logvar = self.experts(mu, logvar)
+        image_mu, image_logvar = self.experts(image_mu.unsqueeze(0),
+                                              image_logvar.unsqueeze(0))
+        text_mu, text_logvar = self.experts(text_mu.unsqueeze(0),
+                                            text_logvar.unsqueeze(0))
+        mu = torch.cat((joint_mu, image_mu, text_mu), dim=0)
+        logvar = torch.cat((joint_logvar, image_logvar, text_logvar), dim=0)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # one decoder call per modality over all subsets at once
+        image_recon = torch.split(self.decode_image(z), batch_size, dim=0)
+        text_in = torch.cat((text, text, text), dim=0) if teacher_forcing else None
+        text_recon = torch.split(self.decode_text(z, text=text_in), batch_size, dim=0)
+        mu = torch.split(mu, batch_size, dim=0)
+        logvar = torch.split(logvar, batch_size, dim=0)
+        return list(zip(image_recon, text_recon, mu, logvar))
+
+    def forward_masked(self, image, text, image_mask, text_mask, prior_expert=False,
+                       teacher_forcing=False):
+        """Like forward but each example chooses which modalities enter the
+        product of experts, so a single batch can mix paired, image-only 
+        and text-only examples in one pass.
+
+        :param image: batch of images; ignored where image_mask is 0
+        :param text: batch of texts; ignored where text_mask is 0
+        :param image_mask: B float tensor; 1 if the image is observed
+        :param text_mask: B float tensor; 1 if the text is observed
+        :param prior_expert: if True, add p(z) as an expert (default: False)
+        :param teacher_forcing: if True, decode text with the ground truth
+                                as input (default: False)
+        """
+        image_mu, image_logvar = self.encode_image(image)
+        text_mu, text_logvar = self.encode_text(text)
+        mu = torch.stack((image_mu, text_mu), dim=0)
+        logvar = torch.stack((image_logvar, text_logvar), dim=0)
+        mask = torch.stack((image_mask, text_mask), dim=0)
+        # product of the observed experts only
+        mu, logvar = self.experts(mu, logvar, mask=mask, prior_expert=prior_expert)
+        # reparametrization trick to sample
+        z = self.reparametrize(mu, logvar)
+        # reconstruct inputs based on that gaussian
+        image_recon = self.decode_image(z)
+        text_recon = self.decode_text(z, text=text if teacher_forcing else None)
+        return image_recon, text_recon, mu, logvar
+
 
 class ImageVAE(nn.Module):
     def __init__(self, n_latents=20):
@@ -138,13 +202,13 @@ class TextVAE(nn.Module):
         else:  # return mean during inference
             return mu
 
-    def decode(self, z):
-        return self.decoder(z)
+    def decode(self, z, x=None):
+        return self.decoder(z, text=x)
 
-    def forward(self, x):
+    def forward(self, x, teacher_forcing=False):
         mu, logvar = self.encode(x)
         z = self.reparametrize(mu, logvar)
-        return self.decode(z), mu, logvar
+        return self.decode(z, x if teacher_forcing else None), mu, logvar
 
 
 class ImageEncoder(nn.Module):
@@ -265,7 +329,13 @@ class TextDecoder(nn.Module):
         self.n_latents = n_latents
         self.n_characters = n_characters
 
-    def forward(self, z):
+    def forward(self, z, text=None):
+        """Free-running decoding where each step is fed the previous 
+        step's most likely character. If text is given, decode with 
+        teacher forcing instead (see forward_teacher)."""
+        if text is not None:
+            return self.forward_teacher(z, text)
+
         n_latents = self.n_latents
         n_characters = self.n_characters
         batch_size = z.size(0)
@@ -287,6 +357,31 @@ class TextDecoder(nn.Module):
 
         return words  # (batch_size, seq_len, ...)
 
+    def forward_teacher(self, z, text):
+        """Teacher-forced decoding for training: the ground truth shifted
+        right by one (starting with SOS) is the input at every position,
+        so the whole sequence runs through the GRU in a single call. 
+        Matches step() applied position by position to the same inputs.
+
+        :param z: batch_size x n_latents
+        :param text: batch_size x seq_len LongTensor of ground truth
+        """
+        batch_size, seq_len = text.size(0), text.size(1)
+        sos = Variable(text.data.new(batch_size, 1).fill_(SOS))
+        c_in = torch.cat((sos, text[:, :-1]), dim=1)
+        c_in = swish(self.embed(c_in))
+        z_seq = z.unsqueeze(1).expand(batch_size, seq_len, z.size(1))
+        c_in = torch.cat((c_in, z_seq), dim=2)
+        c_in = c_in.transpose(0, 1)  # GRU expects (seq_len, batch, ...)
+        # get hiddens from latents
+        h = self.z2h(z).unsqueeze(0).repeat(2, 1, 1)
+        c_out, _ = self.gru(c_in, h)
+        c_out = c_out.transpose(0, 1)
+        c_out = torch.cat((c_out, z_seq), dim=2).contiguous()
+        c_out = self.h2o(c_out.view(batch_size * seq_len, -1))
+        c_out = F.log_softmax(c_out)
+        return c_out.view(batch_size, seq_len, self.n_characters)
+
     def generate(self, z):
         """Like, but we are not given an input text"""
         words = self.forward(z)
@@ -349,14 +444,45 @@ class ProductOfExperts(nn.Module):
     """Return parameters for product of independent experts.
     See https://arxiv.org/pdf/1410.7827.pdf for equations.
 
-    :param mu: M x D for M experts
-    :param logvar: M x D for M experts
+    The product is precision-weighted and computed in log space, 
+    so a missing expert can be dropped per example via the mask.
+
+    :param mu: M x B x D for M experts
+    :param logvar: M x B x D for M experts
+    :param mask: M x B; 1 if the expert is observed for that example,
+                 0 if it should be left out of the product; an example 
+                 with no observed expert gets the prior p(z) = N(0, I)
+                 (default: None)
+    :param prior_expert: if True, add p(z) = N(0, I) as an extra expert;
+                         regularizes for missing modalities (default: False)
     """
-    def forward(self, mu, logvar, eps=1e-8):
-        var = torch.exp(logvar) + eps
-        pd_mu = torch.sum(mu * var, dim=0) / torch.sum(var, dim=0)
-        pd_var = 1 / torch.sum(1 / var, dim=0)
-        pd_logvar = torch.log(pd_var)
+    def forward(self, mu, logvar, mask=None, prior_expert=False):
+        if prior_expert or mask is not None:
+            prior_size = (1, mu.size(1), mu.size(2))
+            prior_mu = Variable(mu.data.new(*prior_size).zero_())
+            prior_logvar = Variable(logvar.data.new(*prior_size).zero_())
+            mu = torch.cat((mu, prior_mu), dim=0)
+            logvar = torch.cat((logvar, prior_logvar), dim=0)
+            if mask is not None:
+                if prior_expert:
+                    prior_mask = Variable(mask.data.new(1, mask.size(1)).fill_(1))
+                else:
+                    # only examples with no observed expert use the prior
+                    prior_mask = mask.sum(0, keepdim=True).eq(0).float()
+                mask = torch.cat((mask, prior_mask), dim=0)
+
+        # log precision is log(1 / var) = -logvar
+        log_precision = -logvar
+        if mask is not None:
+            mask = mask.unsqueeze(2).expand_as(logvar)
+            # missing experts get a vanishing precision
+            log_precision = log_precision * mask + (mask - 1) * 1e10
+        # logsumexp over experts: sum of precisions is the product precision
+        max_log_precision = torch.max(log_precision, dim=0, keepdim=True)[0]
+        weights = torch.exp(log_precision - max_log_precision)
+        sum_weights = torch.sum(weights, dim=0)
+        pd_mu = torch.sum(mu * weights, dim=0) / sum_weights
+        pd_logvar = -(max_log_precision.squeeze(0) + torch.log(sum_weights))
         return pd_mu, pd_logvar
 
 
@@ -21,14 +21,15 @@ from utils import char_tensor, charlist_tensor, tensor_to_string
 EMPTY = '{}'
 
 
-def fetch_multimnist_image(_label):
+def fetch_multimnist_image(_label, **variant):
     if _label == EMPTY:
         _label = ''
 
     loader = torch.utils.data.DataLoader(
         datasets.MultiMNIST('./data', train=False, download=True,
                             transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
+                            target_transform=charlist_tensor,
+                            **variant),
         batch_size=1, shuffle=True)
 
     images = []
@@ -68,6 +69,7 @@ if __name__ == "__main__":
                         help='If True, generate images conditioned on a text.')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
@@ -87,7 +89,8 @@ if __name__ == "__main__":
 
     # mode 2: generate conditioned on image
     elif args.condition_on_image and not args.condition_on_text:
-        image = fetch_multimnist_image(args.condition_on_image)
+        image = fetch_multimnist_image(args.condition_on_image, 
+                                       **datasets.variant_args(args))
         if args.cuda:
             image = image.cuda()
         mu, logvar = vae.encode_image(image)
@@ -103,7 +106,8 @@ if __name__ == "__main__":
 
     # mode 4: generate conditioned on image and text
     elif args.condition_on_text and args.condition_on_image:
-        image = fetch_multimnist_image(args.condition_on_image)
+        image = fetch_multimnist_image(args.condition_on_image, 
+                                       **datasets.variant_args(args))
         text = fetch_multimnist_text(args.condition_on_text)
         if args.cuda:
             image = image.cuda()
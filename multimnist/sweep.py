@@ -0,0 +1,193 @@
+"""Run the configurations of a weak supervision sweep side by side. The
+data is loaded once, in the parent, into shared memory; forked worker
+processes train one configuration at a time each, with an equal share
+of the cores for their intra-op threads. Configurations that already
+have a model_best.pth.tar are not trained again, so a sweep can be
+restarted or extended in place.
+
+Trained checkpoints are evaluated the same way, against one test set
+held in memory; metrics are cached by checkpoint content, so only new
+or retrained checkpoints are evaluated again.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import hashlib
+import multiprocessing
+
+import torch
+
+BEST_CHECKPOINT = 'model_best.pth.tar'
+SUMMARY_LOSSES = ['best_loss', 'joint_loss', 'image_loss', 'text_loss']
+METRICS_CACHE = 'metrics.json'
+
+
+def _init_sweep_worker(train_fn, out_dir, loaders, n_threads):
+    global _sweep
+    _sweep = (train_fn, out_dir, loaders)
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+
+def _run_config(config):
+    train_fn, out_dir, (train_loader, test_loader) = _sweep
+    name, kwargs = config
+    config_dir = os.path.join(out_dir, name)
+    if not os.path.isdir(config_dir):
+        os.makedirs(config_dir)
+    train_fn(config_dir, train_loader=train_loader, test_loader=test_loader, **kwargs)
+    return name
+
+
+def run_sweep(train_fn, configs, out_dir, loaders, n_workers=None):
+    """Train every configuration that has no best checkpoint yet.
+
+    :param train_fn: train_pipeline(out_dir, train_loader=..., test_loader=..., **kwargs)
+    :param configs: list of (name, kwargs); configuration name is trained
+                    into out_dir/name
+    :param out_dir: directory of the sweep
+    :param loaders: (train_loader, test_loader) shared by all configurations
+    :param n_workers: number of processes (default: one per configuration,
+                      at most one per cpu); 1 trains in this process
+    :return: names of the configurations trained by this call
+    """
+    todo = []
+    for name, kwargs in configs:
+        if os.path.isfile(os.path.join(out_dir, name, BEST_CHECKPOINT)):
+            print('Skipping %s: already trained.' % name)
+        else:
+            todo.append((name, kwargs))
+    n_cpus = multiprocessing.cpu_count()
+    n_workers = min(n_workers or n_cpus, len(todo))
+
+    if n_workers > 1:
+        pool = multiprocessing.Pool(n_workers, _init_sweep_worker,
+                                    (train_fn, out_dir, loaders, max(1, n_cpus // n_workers)))
+        try:
+            for name in pool.imap_unordered(_run_config, todo):
+                print('Finished %s.' % name)
+            pool.close()
+        finally:
+            pool.terminate()
+        pool.join()
+    else:
+        _init_sweep_worker(train_fn, out_dir, loaders, None)
+        for config in todo:
+            print('Finished %s.' % _run_config(config))
+    return [name for name, _ in todo]
+
+
+def write_summary(configs, out_dir, path=None):
+    """Write a tab separated table with the parameters of every trained
+    configuration and the test losses stored in its best checkpoint.
+
+    :param configs: list of (name, kwargs) as given to run_sweep
+    :param out_dir: directory of the sweep
+    :param path: output file (default: out_dir/summary.tsv)
+    :return: path of the table
+    """
+    path = path or os.path.join(out_dir, 'summary.tsv')
+    keys = sorted(set(key for _, kwargs in configs for key in kwargs))
+    with open(path, 'w') as fp:
+        fp.write('\t'.join(['name'] + keys + SUMMARY_LOSSES) + '\n')
+        for name, kwargs in configs:
+            checkpoint_path = os.path.join(out_dir, name, BEST_CHECKPOINT)
+            if not os.path.isfile(checkpoint_path):
+                continue
+            checkpoint = torch.load(checkpoint_path,
+                                    map_location=lambda storage, location: storage)
+            row = [name] + [str(kwargs.get(key, '')) for key in keys] + \
+                ['%.4f' % checkpoint[loss] for loss in SUMMARY_LOSSES]
+            fp.write('\t'.join(row) + '\n')
+    return path
+
+
+def trained_configs(out_dir):
+    """Names of the configurations in a sweep directory that have a best
+    checkpoint, in sorted order."""
+    return sorted(name for name in os.listdir(out_dir)
+                  if os.path.isfile(os.path.join(out_dir, name, BEST_CHECKPOINT)))
+
+
+def checkpoint_hash(path, block_size=2**20):
+    """sha1 of the contents of a checkpoint file."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _init_eval_worker(eval_fn, loader, n_threads):
+    global _evaluation
+    _evaluation = (eval_fn, loader)
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+
+def _eval_checkpoint(path):
+    eval_fn, loader = _evaluation
+    return eval_fn(path, loader)
+
+
+def evaluate_checkpoints(eval_fn, paths, loader, cache_path=None, cache_key='',
+                         n_workers=None, batch_fn=None):
+    """Evaluate checkpoints against one test loader, reusing the metrics
+    cached for checkpoints whose contents did not change.
+
+    :param eval_fn: eval_fn(path, loader) -> metrics (a number or a tuple
+                    of numbers) of the checkpoint at path
+    :param paths: checkpoint files
+    :param loader: test loader shared by all checkpoints; built once, in
+                   the parent, and read by forked workers
+    :param cache_path: json file of cached metrics (default: no cache)
+    :param cache_key: name of the evaluation (test function, dataset
+                      variant); metrics are cached per key and file hash
+    :param n_workers: number of processes (default: one per checkpoint,
+                      at most one per cpu); 1 evaluates in this process
+    :param batch_fn: if given, batch_fn(paths, loader) -> list of metrics
+                     evaluates all uncached checkpoints at once in this
+                     process instead of eval_fn
+    :return: list of metrics, in the order of paths
+    """
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path) as fp:
+            cache = json.load(fp)
+    keys = ['%s:%s' % (cache_key, checkpoint_hash(path)) for path in paths]
+    todo = [i for i, key in enumerate(keys) if key not in cache]
+    todo_paths = [paths[i] for i in todo]
+    n_cpus = multiprocessing.cpu_count()
+    n_workers = min(n_workers or n_cpus, len(todo))
+
+    if batch_fn is not None and todo:
+        metrics = batch_fn(todo_paths, loader)
+    elif n_workers > 1:
+        pool = multiprocessing.Pool(n_workers, _init_eval_worker,
+                                    (eval_fn, loader, max(1, n_cpus // n_workers)))
+        try:
+            metrics = pool.map(_eval_checkpoint, todo_paths)
+            pool.close()
+        finally:
+            pool.terminate()
+        pool.join()
+    else:
+        _init_eval_worker(eval_fn, loader, None)
+        metrics = [_eval_checkpoint(path) for path in todo_paths]
+
+    for i, value in zip(todo, metrics):
+        cache[keys[i]] = value
+    if cache_path is not None and todo:
+        # written under another name first so a half written cache is 
+        # never read
+        tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+        with open(tmp_path, 'w') as fp:
+            json.dump(cache, fp, indent=2, sort_keys=True)
+        os.rename(tmp_path, cache_path)
+    # json gives back lists where the eval_fn returned tuples
+    results = [cache[key] for key in keys]
+    return [tuple(value) if isinstance(value, list) else value for value in results]
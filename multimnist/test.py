@@ -59,19 +59,27 @@ def test_multimnist(model, loader, use_cuda=False, verbose=True):
     return _char_correct, _len_correct
 
 
+def test_multimnist_checkpoint(path, loader, use_cuda=False):
+    """test_multimnist of the model saved at path."""
+    vae = load_checkpoint(path, use_cuda=use_cuda)
+    return test_multimnist(vae, loader, use_cuda=use_cuda, verbose=False)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('model_path', type=str, help='path to trained model file')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
     loader = torch.utils.data.DataLoader(
         datasets.MultiMNIST('./data', train=False, download=True,
                             transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
+                            target_transform=charlist_tensor,
+                            **datasets.variant_args(args)),
         batch_size=128, shuffle=True)
 
     vae = load_checkpoint(args.model_path, use_cuda=args.cuda)
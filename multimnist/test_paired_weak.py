@@ -2,21 +2,19 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from functools import partial
 import numpy as np
 
 import torch
-from torchvision import transforms
 
 import datasets
-from test import test_multimnist
-from train import load_checkpoint
-from utils import charlist_tensor
+from test import test_multimnist_checkpoint
+from sweep import evaluate_checkpoints, trained_configs, BEST_CHECKPOINT, METRICS_CACHE
 
 
 if __name__ == "__main__":
     import os
     import argparse
-    from glob import glob
 
     import matplotlib
     matplotlib.use('Agg')
@@ -24,28 +22,33 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('models_dir', type=str, help='path to output directory of weak.py')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='number of checkpoints evaluated at once (default: one per cpu)')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
-    x, y1, y2 = [], [], []
+    # the test set is loaded once for every checkpoint
+    variant = datasets.variant_args(args)
+    loader = datasets.multimnist_loader('./data', train=False, batch_size=128, **variant)
+    names = trained_configs(args.models_dir)
+    paths = [os.path.join(args.models_dir, name, BEST_CHECKPOINT) for name in names]
+    # cuda runs stay in this process
+    accuracies = evaluate_checkpoints(
+        partial(test_multimnist_checkpoint, use_cuda=args.cuda), paths, loader,
+        cache_path=os.path.join(args.models_dir, METRICS_CACHE),
+        cache_key='test_multimnist_%s' % datasets.variant_key(datasets.variant_params(**variant)),
+        n_workers=1 if args.cuda else args.n_workers)
 
-    for dir_path in glob(os.path.join(args.models_dir, '*')):
-        weak_perc = float(os.path.basename(dir_path).split('_')[-1])
-        loader = torch.utils.data.DataLoader(
-            datasets.MultiMNIST('./data', train=False, download=True,
-                                transform=transforms.ToTensor(),
-                                target_transform=charlist_tensor),
-            batch_size=128, shuffle=True)
-        vae = load_checkpoint(os.path.join(dir_path, 'model_best.pth.tar'), use_cuda=args.cuda)
-        vae.eval()
-        weak_char_acc, weak_len_acc = test_multimnist(vae, loader, 
-                                                      use_cuda=args.cuda, verbose=False)
+    x, y1, y2 = [], [], []
+    for name, (weak_char_acc, weak_len_acc) in zip(names, accuracies):
+        weak_perc = float(name.split('_')[-1])
         x.append(weak_perc)
         y1.append(weak_char_acc)
         y2.append(weak_len_acc)
-        print('Got accuracies for %s.' % dir_path)
+        print('Got accuracies for %s.' % name)
 
     x, y1, y2 = np.array(x), np.array(y1), np.array(y2)
     ix = np.argsort(x)
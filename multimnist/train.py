@@ -5,20 +5,20 @@ from __future__ import absolute_import
 import os
 import sys
 import shutil
+import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms
 from torchvision.utils import save_image
 
 import datasets
 from model import MultimodalVAE
 
 from utils import n_characters, max_length
-from utils import tensor_to_string, charlist_tensor
+from utils import tensor_to_string
 
 DEFAULT_N_LATENTS = 100
 
@@ -67,16 +67,36 @@ def load_checkpoint(file_path, use_cuda=False):
 
 
 def loss_function(mu, logvar, recon_image=None, image=None, recon_text=None, text=None,  
-                  kl_lambda=1e-3, lambda_xy=1., lambda_yx=1.):
-    batch_size = mu.size(0)
+                  kl_lambda=1e-3, lambda_xy=1., lambda_yx=1., image_mask=None, text_mask=None,
+                  batch_size=None):
+    """If image_mask/text_mask (float tensors over the rows) are given, the 
+    reconstruction term of a modality only covers the rows with a 1.
+
+    For a mixed batch (see mixed_batch_masks), batch_size is the number of
+    examples it was built from: every term is summed over the rows and 
+    divided by it, so each view counts as if it were its own batch of 
+    batch_size examples, as in separate calls (default: number of rows).
+    """
+    batch_size = batch_size or mu.size(0)
     image_BCE, text_BCE = 0, 0
     
     if recon_image is not None and image is not None:
-        image_BCE = lambda_xy * F.binary_cross_entropy(recon_image.view(-1, 1 * 50 * 50), 
-                                                       image.view(-1, 1 * 50 * 50))
+        if image_mask is None:
+            image_BCE = lambda_xy * F.binary_cross_entropy(recon_image.view(-1, 1 * 50 * 50), 
+                                                           image.view(-1, 1 * 50 * 50))
+        else:
+            recon_image = recon_image.view(-1, 1 * 50 * 50)
+            image = image.view(-1, 1 * 50 * 50)
+            image_BCE = -(image * torch.log(recon_image + 1e-8) + 
+                          (1 - image) * torch.log(1 - recon_image + 1e-8))
+            image_BCE = lambda_xy * torch.sum(torch.mean(image_BCE, dim=1) * image_mask) / batch_size
 
     if recon_text is not None and text is not None:
-        text_BCE = lambda_yx * F.nll_loss(recon_text.view(-1, recon_text.size(2)), text.view(-1))
+        if text_mask is None:
+            text_BCE = lambda_yx * F.nll_loss(recon_text.view(-1, recon_text.size(2)), text.view(-1))
+        else:
+            text_NLL = -recon_text.gather(2, text.unsqueeze(2)).squeeze(2)
+            text_BCE = lambda_yx * torch.sum(torch.mean(text_NLL, dim=1) * text_mask) / batch_size
 
     # see Appendix B from VAE paper:
     # Kingma and Welling. Auto-Encoding Variational Bayes. ICLR, 2014
@@ -87,6 +107,36 @@ def loss_function(mu, logvar, recon_image=None, image=None, recon_text=None, tex
     return image_BCE + text_BCE + KLD
 
 
+def mixed_batch_masks(joint, image_only, text_only, paired):
+    """Lay out the joint, image-only and text-only views of a batch as 
+    one mixed batch for MultimodalVAE.forward_masked.
+
+    :param joint: B numpy bool array; examples shown as a joint view
+    :param image_only: B numpy bool array; examples shown as an image-only view
+    :param text_only: B numpy bool array; examples shown as a text-only view
+    :param paired: B numpy bool array; examples whose pairing can be used
+                   to reconstruct text from an image-only view
+    :return index: LongTensor of rows to take from the batch
+    :return expert_masks: (image_mask, text_mask) FloatTensors; which
+                          modalities are experts for each row
+    :return target_masks: (image_mask, text_mask) FloatTensors; which 
+                          modalities are reconstructed for each row
+                          (with loss_function(..., batch_size=B), each
+                          view is weighted as a separate batch of B)
+    """
+    rows = [np.where(joint)[0], np.where(image_only)[0], np.where(text_only)[0]]
+    index = np.concatenate(rows)
+    view = np.concatenate([np.ones(len(r), dtype=int) * i for i, r in enumerate(rows)])
+    image_mask = view != 2
+    text_mask = view != 1
+    text_target_mask = text_mask | ((view == 1) & paired[index])
+
+    to_tensor = lambda x: torch.from_numpy(x.astype(np.float32))
+    return (torch.from_numpy(index).long(), 
+            (to_tensor(image_mask), to_tensor(text_mask)),
+            (to_tensor(image_mask), to_tensor(text_target_mask)))
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
@@ -104,22 +154,21 @@ if __name__ == "__main__":
                         help='if True, use a fixed interval of doubling the KL term')
     parser.add_argument('--anneal_lr', action='store_true', default=False,
                         help='If True, half learning rate every 5 epochs')
+    parser.add_argument('--teacher_forcing', action='store_true', default=False,
+                        help='if True, decode text from the ground truth during training')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
     # create loaders for MNIST
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=True, download=True,
-                            transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=False, download=True,
-                            transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
-        batch_size=args.batch_size, shuffle=True)
+    train_loader = datasets.multimnist_loader('./data', train=True, 
+                                              batch_size=args.batch_size, shuffle=True,
+                                              **datasets.variant_args(args))
+    test_loader = datasets.multimnist_loader('./data', train=False, 
+                                             batch_size=args.batch_size, shuffle=True,
+                                             **datasets.variant_args(args))
 
     # load multimodal VAE
     vae = MultimodalVAE(args.n_latents, use_cuda=args.cuda)
@@ -151,9 +200,10 @@ if __name__ == "__main__":
             
             # for each batch, use 3 types of examples (joint, image-only, and text-only)
             # this way, we can hope to reconstruct both modalities from one
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text, teacher_forcing=args.teacher_forcing)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, kl_lambda=kl_lambda, 
@@ -194,9 +244,10 @@ if __name__ == "__main__":
                 image, text = image.cuda(), text.cuda()
             image, text = Variable(image), Variable(text)
                 
-            recon_image_1, recon_text_1, mu_1, logvar_1 = vae(image, text)
-            recon_image_2, recon_text_2, mu_2, logvar_2 = vae(image=image)
-            recon_image_3, recon_text_3, mu_3, logvar_3 = vae(text=text)
+            outputs = vae.forward_subsets(image, text)
+            recon_image_1, recon_text_1, mu_1, logvar_1 = outputs[0]
+            recon_image_2, recon_text_2, mu_2, logvar_2 = outputs[1]
+            recon_image_3, recon_text_3, mu_3, logvar_3 = outputs[2]
             
             loss_1 = loss_function(mu_1, logvar_1, recon_image=recon_image_1, image=image, 
                                    recon_text=recon_text_1, text=text, kl_lambda=kl_lambda, 
@@ -11,7 +11,6 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms
 from torchvision.utils import save_image
 
 import datasets
@@ -57,6 +56,7 @@ if __name__ == "__main__":
                         help='if True, use a fixed interval of doubling the KL term')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
@@ -72,14 +72,12 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/image_only'):
         os.makedirs('./results/image_only')
 
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=True, download=True,
-                            transform=transforms.ToTensor()),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=False, download=True, 
-                            transform=transforms.ToTensor()),
-        batch_size=args.batch_size, shuffle=True)
+    train_loader = datasets.multimnist_loader('./data', train=True, 
+                                              batch_size=args.batch_size, shuffle=True,
+                                              **datasets.variant_args(args))
+    test_loader = datasets.multimnist_loader('./data', train=False, 
+                                             batch_size=args.batch_size, shuffle=True,
+                                             **datasets.variant_args(args))
 
     vae = ImageVAE(n_latents=args.n_latents)
     if args.cuda:
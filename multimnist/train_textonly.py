@@ -12,11 +12,10 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
-from torchvision import transforms
 
 import datasets
 from utils import n_characters, max_length
-from utils import tensor_to_string, charlist_tensor
+from utils import tensor_to_string
 from model import TextVAE
 from train import loss_function, AverageMeter
 
@@ -57,8 +56,11 @@ if __name__ == "__main__":
                         help='how many batches to wait before logging training status')
     parser.add_argument('--anneal_kl', action='store_true', default=False, 
                         help='if True, use a fixed interval of doubling the KL term')
+    parser.add_argument('--teacher_forcing', action='store_true', default=False,
+                        help='if True, decode text from the ground truth during training')
     parser.add_argument('--cuda', action='store_true', default=False,
                         help='enables CUDA training')
+    datasets.add_variant_args(parser)
     args = parser.parse_args()
     args.cuda = args.cuda and torch.cuda.is_available()
 
@@ -74,16 +76,12 @@ if __name__ == "__main__":
     if not os.path.isdir('./results/text_only'):
         os.makedirs('./results/text_only')
 
-    train_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=True, download=True,
-                            transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
-        batch_size=args.batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(
-        datasets.MultiMNIST('./data', train=False, download=True, 
-                            transform=transforms.ToTensor(),
-                            target_transform=charlist_tensor),
-        batch_size=args.batch_size, shuffle=True)
+    train_loader = datasets.multimnist_loader('./data', train=True, 
+                                              batch_size=args.batch_size, shuffle=True,
+                                              **datasets.variant_args(args))
+    test_loader = datasets.multimnist_loader('./data', train=False, 
+                                             batch_size=args.batch_size, shuffle=True,
+                                             **datasets.variant_args(args))
 
     vae = TextVAE(args.n_latents, use_cuda=args.cuda)
     if args.cuda:
@@ -101,7 +99,7 @@ if __name__ == "__main__":
             if args.cuda:
                 data = data.cuda()
             optimizer.zero_grad()
-            recon_batch, mu, logvar = vae(data)
+            recon_batch, mu, logvar = vae(data, teacher_forcing=args.teacher_forcing)
             loss = loss_function(mu, logvar, recon_text=recon_batch, text=data, 
                                  kl_lambda=kl_lambda, lambda_yx=1.)
             loss.backward()